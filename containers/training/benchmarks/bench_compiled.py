@@ -0,0 +1,108 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Latency of the compiled NumPy predictor against `Booster.inplace_predict`.
+
+Trains a multi-class model on synthetic data, compiles it with
+`compiled_model.export` (which verifies the margins bit for bit) and times both
+predictors for several batch sizes, from single rows to large batches.
+
+    python benchmarks/bench_compiled.py --rounds 100 --max_depth 6
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import xgboost as xgb
+
+TRAINER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "trainer")
+sys.path.insert(0, TRAINER_DIR)
+
+import compiled_model  # noqa: E402
+
+
+def timed(predict, X, repeats: int) -> float:
+    """Median seconds of `predict(X)`."""
+    predict(X)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predict(X)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--features", type=int, default=20)
+    parser.add_argument("--num_class", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=100)
+    parser.add_argument("--max_depth", type=int, default=6)
+    parser.add_argument("--nthread", type=int, default=1)
+    parser.add_argument("--batch_sizes", type=str, default="1,16,256,4096")
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    X = rng.normal(size=(args.rows, args.features)).astype(np.float32)
+    y = np.argmax(X @ rng.normal(size=(args.features, args.num_class)), axis=1)
+    params = {
+        "objective": "multi:softmax",
+        "num_class": args.num_class,
+        "max_depth": args.max_depth,
+        "tree_method": "hist",
+        "nthread": args.nthread,
+    }
+    booster = xgb.train(params, xgb.DMatrix(X, label=y), num_boost_round=args.rounds)
+
+    model_dir = tempfile.mkdtemp()
+    booster.save_model(os.path.join(model_dir, "model.bst"))
+    compiled = compiled_model.CompiledModel.load(
+        compiled_model.export(booster, model_dir, X[:10_000])
+    )
+    print(
+        json.dumps(
+            {
+                "model_bst_bytes": os.path.getsize(os.path.join(model_dir, "model.bst")),
+                "compiled_bytes": os.path.getsize(
+                    os.path.join(model_dir, compiled_model.COMPILED_MODEL_FILENAME)
+                ),
+            }
+        )
+    )
+
+    for batch_size in [int(b) for b in args.batch_sizes.split(",")]:
+        batch = X[:batch_size]
+        repeats = max(3, args.repeats * 16 // max(batch_size, 16))
+        booster_s = timed(booster.inplace_predict, batch, repeats)
+        compiled_s = timed(compiled.predict, batch, repeats)
+        print(
+            json.dumps(
+                {
+                    "batch_size": batch_size,
+                    "booster_ms": round(booster_s * 1000, 3),
+                    "compiled_ms": round(compiled_s * 1000, 3),
+                    "booster_rows_per_s": round(batch_size / booster_s),
+                    "compiled_rows_per_s": round(batch_size / compiled_s),
+                }
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares the CSV round-trip and the Arrow path for loading training data.
+
+A local Parquet file stands in for the BigQuery table. Each path runs in a fresh
+subprocess so that the reported peak RSS belongs to that path only.
+
+    python benchmarks/bench_data_loading.py --rows 2000000
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+TRAINER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "trainer")
+sys.path.insert(0, TRAINER_DIR)
+
+
+def generate_parquet(path: str, rows: int, features: int) -> None:
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(42)
+    df = pd.DataFrame(
+        rng.normal(size=(rows, features)),
+        columns=[f"feature_{i}" for i in range(features)],
+    )
+    df["target"] = rng.integers(0, 3, size=rows).astype("float64")
+    df.to_parquet(path, index=False)
+
+
+def run_csv_path(path: str):
+    """Mirrors `load_data_from_bq` + `load_data`: DataFrame -> CSV -> DataFrame."""
+    import pandas as pd
+
+    df = pd.read_parquet(path)  # stands in for `query().to_dataframe()`
+    temp_file_path = tempfile.NamedTemporaryFile(delete=False, suffix=".csv").name
+    df.to_csv(temp_file_path, index=False)
+    del df
+    df = pd.read_csv(temp_file_path)
+    os.remove(temp_file_path)
+    return df.shape
+
+
+def run_arrow_path(path: str):
+    import data_sources
+
+    df = data_sources.load_frame(path)
+    return df.shape
+
+
+def run_single(mode: str, path: str) -> None:
+    start = time.perf_counter()
+    shape = run_csv_path(path) if mode == "csv" else run_arrow_path(path)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is reported in KiB on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        json.dumps(
+            {
+                "mode": mode,
+                "rows": shape[0],
+                "wall_time_s": round(elapsed, 3),
+                "peak_rss_mb": round(peak_rss_mb, 1),
+            }
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--features", type=int, default=20)
+    parser.add_argument("--data_path", type=str, default=None)
+    parser.add_argument("--mode", type=str, choices=["csv", "arrow"], default=None)
+    args = parser.parse_args()
+
+    if args.mode:
+        run_single(args.mode, args.data_path)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path = os.path.join(tmp_dir, "table.parquet")
+        print(f"Generating {args.rows} x {args.features} rows into {data_path}")
+        generate_parquet(data_path, args.rows, args.features)
+
+        for mode in ["csv", "arrow"]:
+            subprocess.run(
+                [sys.executable, __file__, "--mode", mode, "--data_path", data_path],
+                check=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
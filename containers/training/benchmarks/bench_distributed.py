@@ -0,0 +1,84 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Scaling curve of distributed training, with local worker processes.
+
+Runs `train.py --distributed` with 1, 2, 4, ... local workers on the same
+synthetic Parquet file and reports the wall time and the test accuracy.
+Threads are split evenly between the workers, so this measures the
+communication overhead on one machine rather than a real speedup; run it with
+`--nthread` fixed to compare per-worker throughput.
+
+    python benchmarks/bench_distributed.py --rows 1000000 --workers 1 2 4
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+TRAINER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "trainer")
+sys.path.insert(0, TRAINER_DIR)
+
+from bench_data_loading import generate_parquet  # noqa: E402
+import distributed  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--features", type=int, default=20)
+    parser.add_argument("--n_estimators", type=int, default=50)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--nthread", type=int, default=None)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path = os.path.join(tmp_dir, "table.parquet")
+        print(f"Generating {args.rows} x {args.features} rows into {data_path}")
+        generate_parquet(data_path, args.rows, args.features)
+
+        for num_workers in args.workers:
+            model_dir = os.path.join(tmp_dir, f"model_{num_workers}")
+            elapsed = distributed.launch_local(
+                num_workers,
+                [
+                    "--data_path",
+                    data_path,
+                    "--model_dir",
+                    model_dir,
+                    "--n_estimators",
+                    str(args.n_estimators),
+                    "--early_stopping_rounds",
+                    "0",
+                ],
+                nthread=args.nthread,
+                cwd=tmp_dir,
+            )
+            with open(os.path.join(model_dir, "metrics.json")) as f:
+                accuracy = json.load(f)["accuracy"]
+            results.append(
+                {
+                    "workers": num_workers,
+                    "wall_time_s": round(elapsed, 3),
+                    "accuracy": accuracy,
+                }
+            )
+
+    for result in results:
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
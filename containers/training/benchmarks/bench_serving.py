@@ -0,0 +1,148 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Latency and throughput of the prediction server, with and without batching.
+
+Trains a small multi-class model, serves it with `serve.py` in-process and
+sends small requests from concurrent keep-alive clients:
+
+- per_request: `Booster.predict` on a DMatrix in every request thread, like the
+  stock XGBoost prediction container,
+- unbatched: the batching thread with batches of a single request,
+- batched: micro-batches of concurrent requests.
+
+    python benchmarks/bench_serving.py --clients 32 --requests 200
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import xgboost as xgb
+
+TRAINER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "trainer")
+sys.path.insert(0, TRAINER_DIR)
+
+import serve  # noqa: E402
+
+
+def train_model(features: int, num_class: int, rounds: int) -> str:
+    rng = np.random.default_rng(42)
+    X = rng.normal(size=(20_000, features)).astype(np.float32)
+    y = np.argmax(X @ rng.normal(size=(features, num_class)), axis=1)
+    params = {"objective": "multi:softmax", "num_class": num_class, "max_depth": 6}
+    booster = xgb.train(params, xgb.DMatrix(X, label=y), num_boost_round=rounds)
+    model_dir = tempfile.mkdtemp()
+    booster.save_model(os.path.join(model_dir, "model.bst"))
+    return model_dir
+
+
+class PerRequestPredictor:
+    def __init__(self, booster: xgb.Booster):
+        self.booster = booster
+
+    def predict(self, instances: np.ndarray) -> np.ndarray:
+        return self.booster.predict(xgb.DMatrix(instances))
+
+
+def start_server(booster: xgb.Booster, mode: str, rows: int, max_latency_ms: float):
+    if mode == "per_request":
+        batcher = PerRequestPredictor(booster)
+        handler = serve.make_handler(batcher, "/predict", "/health")
+        server = serve.PredictionServer(("127.0.0.1", 0), handler)
+    elif mode == "unbatched":
+        server, batcher = serve.make_server(
+            booster, 0, host="127.0.0.1", max_batch_size=rows, max_latency_ms=0
+        )
+    else:
+        server, batcher = serve.make_server(
+            booster, 0, host="127.0.0.1", max_latency_ms=max_latency_ms
+        )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, batcher
+
+
+def run_clients(port: int, clients: int, requests: int, rows: int, features: int):
+    rng = np.random.default_rng(0)
+    body = json.dumps(
+        {"instances": rng.normal(size=(rows, features)).round(3).tolist()}
+    ).encode("utf-8")
+    latencies = [[] for _ in range(clients)]
+
+    def client(i: int) -> None:
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        for _ in range(requests):
+            start = time.perf_counter()
+            connection.request(
+                "POST", "/predict", body, {"Content-Type": "application/json"}
+            )
+            response = connection.getresponse()
+            assert response.status == 200, response.read()
+            assert len(json.loads(response.read())["predictions"]) == rows
+            latencies[i].append(time.perf_counter() - start)
+        connection.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, np.concatenate(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--features", type=int, default=4)
+    parser.add_argument("--num_class", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=100)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--rows", type=int, default=6, help="Instances per request.")
+    parser.add_argument(
+        "--max_latency_ms", type=float, default=serve.DEFAULT_MAX_LATENCY_MS
+    )
+    args = parser.parse_args()
+
+    model_dir = train_model(args.features, args.num_class, args.rounds)
+    booster = serve.load_booster(model_dir)
+    for mode in ["per_request", "unbatched", "batched"]:
+        server, batcher = start_server(booster, mode, args.rows, args.max_latency_ms)
+        seconds, latencies = run_clients(
+            server.server_address[1], args.clients, args.requests, args.rows, args.features
+        )
+        server.shutdown()
+        server.server_close()
+        rows_per_batch = args.rows
+        if isinstance(batcher, serve.MicroBatcher):
+            rows_per_batch = batcher.rows / batcher.batches
+        print(
+            json.dumps(
+                {
+                    "mode": mode,
+                    "requests_per_s": round(len(latencies) / seconds),
+                    "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+                    "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 2),
+                    "rows_per_batch": round(rows_per_batch, 1),
+                }
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
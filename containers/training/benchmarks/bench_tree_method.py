@@ -0,0 +1,102 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares XGBoost tree methods and thread counts on synthetic data.
+
+Trains the same multi-class model with exact/approx/hist and reports the wall
+time per configuration. The hist runs train on a QuantileDMatrix, like
+`XGBClassifier.fit` does in the trainer.
+
+    python benchmarks/bench_tree_method.py --rows 1000000 --rounds 50
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import xgboost as xgb
+
+TRAINER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "trainer")
+sys.path.insert(0, TRAINER_DIR)
+
+import resources  # noqa: E402
+
+
+def make_data(rows: int, features: int, num_class: int):
+    rng = np.random.default_rng(42)
+    X = rng.normal(size=(rows, features)).astype(np.float32)
+    weights = rng.normal(size=(features, num_class))
+    y = np.argmax(X @ weights + rng.normal(scale=0.5, size=(rows, num_class)), axis=1)
+    return X, y.astype(np.float32)
+
+
+def run(X, y, num_class, tree_method, max_bin, nthread, rounds):
+    params = {
+        "objective": "multi:softmax",
+        "num_class": num_class,
+        "max_depth": 6,
+        "tree_method": tree_method,
+        "nthread": nthread,
+    }
+    start = time.perf_counter()
+    if tree_method == "hist":
+        params["max_bin"] = max_bin
+        dtrain = xgb.QuantileDMatrix(X, label=y, max_bin=max_bin, nthread=nthread)
+    else:
+        dtrain = xgb.DMatrix(X, label=y, nthread=nthread)
+    build_s = time.perf_counter() - start
+    xgb.train(params, dtrain, num_boost_round=rounds)
+    total_s = time.perf_counter() - start
+    print(
+        json.dumps(
+            {
+                "tree_method": tree_method,
+                "max_bin": max_bin if tree_method == "hist" else None,
+                "nthread": nthread,
+                "dmatrix_s": round(build_s, 3),
+                "total_s": round(total_s, 3),
+            }
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--features", type=int, default=20)
+    parser.add_argument("--num_class", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--max_bin", type=int, default=256)
+    parser.add_argument(
+        "--tree_methods", type=str, nargs="+", default=["exact", "approx", "hist"]
+    )
+    args = parser.parse_args()
+
+    cpus = resources.available_cpus()
+    print(
+        f"os.cpu_count()={os.cpu_count()}, available_cpus()={cpus}, "
+        f"cgroup quota={resources.cgroup_cpu_limit()}"
+    )
+    X, y = make_data(args.rows, args.features, args.num_class)
+
+    for tree_method in args.tree_methods:
+        run(X, y, args.num_class, tree_method, args.max_bin, cpus, args.rounds)
+    # Oversubscription: as many threads as the host reports
+    if (os.cpu_count() or 1) > cpus:
+        run(X, y, args.num_class, "hist", args.max_bin, os.cpu_count(), args.rounds)
+
+
+if __name__ == "__main__":
+    main()
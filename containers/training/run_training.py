@@ -28,11 +28,14 @@ def create_custom_job_on_persistent_resource_sample(
     service_account: Optional[str] = None,
     tensorboard: Optional[str] = None,
     training_args: Optional[List[str]] = [],
+    replica_count: int = 1,
 ) -> None:
     aiplatform.init(project=project, location=location, staging_bucket=staging_bucket)
     args = ["train"]
     if training_args:
         args = args + training_args
+    if replica_count > 1 and "--distributed" not in args:
+        args.append("--distributed")
 
     worker_pool_specs = [
         {
@@ -49,6 +52,11 @@ def create_custom_job_on_persistent_resource_sample(
             },
         }
     ]
+    if replica_count > 1:
+        # workerpool0 holds the single rank 0 replica, the others go to workerpool1
+        worker_pool_specs.append(
+            dict(worker_pool_specs[0], replica_count=replica_count - 1)
+        )
 
     pr = None
     if persistent_resource_id:
@@ -105,6 +113,12 @@ def get_args():
         "--service-account", type=str, help="Service account email (optional)."
     )
     parser.add_argument("--tensorboard", type=str, required=False)
+    parser.add_argument(
+        "--replica-count",
+        type=int,
+        default=1,
+        help="Replicas training one model together (distributed XGBoost).",
+    )
     parser.add_argument(
         "--training-args",
         nargs="*",  # 0 or more arguments
@@ -132,6 +146,7 @@ if __name__ == "__main__":
         service_account=args.service_account,
         tensorboard=args.tensorboard,
         training_args=args.training_args,
+        replica_count=args.replica_count,
     )
 
     print("Training job created successfully!")
@@ -0,0 +1,59 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Rank and world size of this replica, read from the Vertex AI environment.
+
+Vertex AI sets CLUSTER_SPEC for every replica of a multi-replica custom job
+(and TF_CONFIG for compatibility). Replicas are ordered by worker pool, then by
+index, so the workerpool0 replica is always rank 0.
+"""
+import json
+import os
+from typing import List, NamedTuple
+
+# Pool order used to rank replicas (CLUSTER_SPEC, then TF_CONFIG names)
+POOL_ORDER = ["workerpool0", "workerpool1", "workerpool2", "workerpool3"]
+TF_POOL_ORDER = ["chief", "master", "worker"]
+
+
+class ClusterInfo(NamedTuple):
+    rank: int
+    world_size: int
+    hosts: List[str]  # "host:port" of every replica, in rank order
+
+
+def get_cluster_info() -> ClusterInfo:
+    """Returns this replica's rank, the world size and the replica addresses.
+
+    Falls back to a single replica (rank 0 of 1) when neither CLUSTER_SPEC nor
+    TF_CONFIG is set, e.g. when running locally.
+    """
+    if os.environ.get("CLUSTER_SPEC"):
+        spec = json.loads(os.environ["CLUSTER_SPEC"])
+        pool_order = POOL_ORDER
+    elif os.environ.get("TF_CONFIG"):
+        spec = json.loads(os.environ["TF_CONFIG"])
+        pool_order = TF_POOL_ORDER
+    else:
+        return ClusterInfo(rank=0, world_size=1, hosts=[])
+
+    cluster = spec.get("cluster", {})
+    task = spec.get("task", {})
+    hosts = []
+    rank = 0
+    for pool in pool_order:
+        if pool == task.get("type"):
+            rank = len(hosts) + int(task.get("index", 0))
+        hosts.extend(cluster.get(pool, []))
+
+    return ClusterInfo(rank=rank, world_size=max(len(hosts), 1), hosts=hosts)
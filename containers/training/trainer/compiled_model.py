@@ -0,0 +1,293 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compiles `model.bst` into flat node arrays with a NumPy predictor.
+
+All trees are concatenated into one node table (feature, threshold, default
+direction, children, leaf value) saved as `model_compiled.npz`. The predictor
+walks every tree of every row at once, one level per step, so a batch costs
+`max_depth` vectorized gathers; it needs NumPy only, not XGBoost.
+
+Margins are bit-exact with `Booster.inplace_predict`: splits compare float32
+values with `<`, missing values follow the default direction and the leaf
+values are added to the base margin in float32, tree by tree, like the XGBoost
+CPU predictor; the base margin is read from XGBoost itself. `export` checks
+this before writing the artifact, on the given rows and on values placed
+exactly at every split threshold.
+
+Only numerical splits of `gbtree` models are supported.
+"""
+import json
+import os
+from typing import Optional
+
+import numpy as np
+
+COMPILED_MODEL_FILENAME = "model_compiled.npz"
+
+_ARRAYS = ("feature", "threshold", "default_left", "left", "right", "value")
+
+
+def _base_margin(model: dict) -> np.float32:
+    """The base score in margin space, exactly as XGBoost computes it.
+
+    It is the prediction of the same model without trees; the float32 rounding
+    of the objective's link function is XGBoost's own.
+    """
+    import copy
+
+    import xgboost as xgb
+
+    model = copy.deepcopy(model)
+    trees = model["learner"]["gradient_booster"]["model"]
+    trees["trees"], trees["tree_info"] = [], []
+    trees["gbtree_model_param"]["num_trees"] = "0"
+    empty = xgb.Booster()
+    empty.load_model(bytearray(json.dumps(model).encode("utf-8")))
+    num_feature = int(model["learner"]["learner_model_param"]["num_feature"])
+    margin = empty.inplace_predict(
+        np.zeros((1, num_feature), dtype=np.float32), predict_type="margin"
+    )
+    return np.float32(np.ravel(margin)[0])
+
+
+class CompiledModel:
+    def __init__(
+        self,
+        feature: np.ndarray,
+        threshold: np.ndarray,
+        default_left: np.ndarray,
+        left: np.ndarray,
+        right: np.ndarray,
+        value: np.ndarray,
+        roots: np.ndarray,
+        tree_group: np.ndarray,
+        base_margin: float,
+        num_feature: int,
+        max_depth: int,
+        objective: str,
+    ):
+        """Node arrays of all trees; leaves are their own children."""
+        self.feature = feature
+        self.threshold = threshold
+        self.default_left = default_left
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.tree_group = tree_group
+        self.base_margin = np.float32(base_margin)
+        self.num_feature = int(num_feature)
+        self.max_depth = int(max_depth)
+        self.objective = objective
+        self.num_group = int(tree_group.max()) + 1 if len(tree_group) else 1
+        self._group_trees = [
+            np.flatnonzero(tree_group == g) for g in range(self.num_group)
+        ]
+        # children[2 * node + go_left]: one gather per level instead of two
+        self._children = np.stack([right, left], axis=1).ravel()
+
+    @classmethod
+    def from_booster(cls, booster) -> "CompiledModel":
+        model = json.loads(booster.save_raw("json"))
+        learner = model["learner"]
+        gradient_booster = learner["gradient_booster"]
+        if gradient_booster["name"] != "gbtree":
+            raise NotImplementedError(
+                f"Only gbtree models can be compiled, got {gradient_booster['name']}"
+            )
+        trees = gradient_booster["model"]["trees"]
+        columns = {name: [] for name in _ARRAYS}
+        roots, max_depth, offset = [], 0, 0
+        for tree in trees:
+            if any(tree["split_type"]):
+                raise NotImplementedError("Categorical splits cannot be compiled")
+            left = np.asarray(tree["left_children"], dtype=np.int32)
+            right = np.asarray(tree["right_children"], dtype=np.int32)
+            nodes = np.arange(len(left), dtype=np.int32)
+            is_leaf = left == -1
+            # Leaves point to themselves, extra steps leave the row in place
+            columns["left"].append(np.where(is_leaf, nodes, left) + offset)
+            columns["right"].append(np.where(is_leaf, nodes, right) + offset)
+            columns["feature"].append(
+                np.where(is_leaf, 0, tree["split_indices"]).astype(np.int32)
+            )
+            # For leaves, split_conditions holds the leaf value
+            conditions = np.asarray(tree["split_conditions"], dtype=np.float32)
+            columns["threshold"].append(conditions)
+            columns["value"].append(
+                np.where(is_leaf, conditions, 0).astype(np.float32)
+            )
+            columns["default_left"].append(
+                np.asarray(tree["default_left"], dtype=bool)
+            )
+            roots.append(offset)
+            max_depth = max(max_depth, _depth(left, right))
+            offset += len(left)
+
+        objective = learner["objective"]["name"]
+        params = learner["learner_model_param"]
+        return cls(
+            **{name: np.concatenate(arrays) for name, arrays in columns.items()},
+            roots=np.asarray(roots, dtype=np.int32),
+            tree_group=np.asarray(
+                gradient_booster["model"]["tree_info"], dtype=np.int32
+            ),
+            base_margin=_base_margin(model),
+            num_feature=int(params["num_feature"]),
+            max_depth=max_depth,
+            objective=objective,
+        )
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                **{name: getattr(self, name) for name in _ARRAYS},
+                roots=self.roots,
+                tree_group=self.tree_group,
+                meta=np.asarray(
+                    json.dumps(
+                        {
+                            "base_margin": float(self.base_margin),
+                            "num_feature": self.num_feature,
+                            "max_depth": self.max_depth,
+                            "objective": self.objective,
+                        }
+                    )
+                ),
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "CompiledModel":
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            return cls(
+                **{name: data[name] for name in _ARRAYS},
+                roots=data["roots"],
+                tree_group=data["tree_group"],
+                **meta,
+            )
+
+    def num_features(self) -> int:
+        return self.num_feature
+
+    def leaf_values(self, X: np.ndarray) -> np.ndarray:
+        """Leaf value of every (row, tree)."""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        flat = X.ravel()
+        row_offsets = (np.arange(len(X)) * self.num_feature)[:, None]
+        node = np.broadcast_to(self.roots, (len(X), len(self.roots)))
+        for _ in range(self.max_depth):
+            x = flat[row_offsets + self.feature[node]]
+            # NaN < threshold is False: missing values go right unless default_left
+            go_left = x < self.threshold[node]
+            missing = np.isnan(x)
+            if missing.any():
+                go_left |= missing & self.default_left[node]
+            node = self._children[2 * node + go_left]
+        return self.value[node]
+
+    def predict_margin(self, X: np.ndarray) -> np.ndarray:
+        """Raw margins, shape (rows,) or (rows, groups)."""
+        leaves = self.leaf_values(X)
+        margin = np.empty((len(leaves), self.num_group), dtype=np.float32)
+        for group, trees in enumerate(self._group_trees):
+            # accumulate adds left to right, in tree order; a sum would not
+            terms = np.empty((len(leaves), len(trees) + 1), dtype=np.float32)
+            terms[:, 0] = self.base_margin
+            terms[:, 1:] = leaves[:, trees]
+            margin[:, group] = np.add.accumulate(terms, axis=1)[:, -1]
+        return margin[:, 0] if self.num_group == 1 else margin
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        """Predictions as `Booster.predict` returns them for the objective."""
+        margin = self.predict_margin(X)
+        if self.objective == "multi:softmax":
+            return np.argmax(margin, axis=1).astype(np.float32)
+        if self.objective == "multi:softprob":
+            exp = np.exp(margin - margin.max(axis=1, keepdims=True))
+            return exp / exp.sum(axis=1, keepdims=True)
+        if self.objective in ("binary:logistic", "reg:logistic"):
+            return 1.0 / (1.0 + np.exp(-margin))
+        if self.objective in ("count:poisson", "reg:gamma", "reg:tweedie"):
+            return np.exp(margin)
+        return margin
+
+
+def _depth(left: np.ndarray, right: np.ndarray) -> int:
+    depth, level = 0, [0]
+    while level:
+        children = [c for n in level for c in (left[n], right[n]) if c != -1]
+        if children:
+            depth += 1
+        level = children
+    return depth
+
+
+def boundary_sample(model: CompiledModel, rows: int = 1024, seed: int = 0) -> np.ndarray:
+    """Rows whose values sit exactly on, or just below, split thresholds, or are
+    missing: where a wrong comparison would change the leaf."""
+    rng = np.random.default_rng(seed)
+    is_split = model.left != np.arange(len(model.left))
+    X = rng.normal(size=(rows, model.num_feature)).astype(np.float32)
+    for feature in range(model.num_feature):
+        thresholds = model.threshold[is_split & (model.feature == feature)]
+        if len(thresholds):
+            values = rng.choice(thresholds, size=rows)
+            below = rng.random(rows) < 0.5
+            X[:, feature] = np.where(
+                below, np.nextafter(values, np.float32(-np.inf)), values
+            )
+    X[rng.random(X.shape) < 0.05] = np.nan
+    return X
+
+
+def verify(model: CompiledModel, booster, X: np.ndarray) -> None:
+    """Raises ValueError unless the margins equal the booster's bit for bit."""
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    expected = booster.inplace_predict(X, predict_type="margin")
+    actual = model.predict_margin(X)
+    mismatched = np.flatnonzero(
+        (expected.view(np.uint32) != actual.view(np.uint32))
+        .reshape(len(X), -1)
+        .any(axis=1)
+    )
+    if len(mismatched):
+        raise ValueError(
+            f"{len(mismatched)} of {len(X)} rows differ from model.bst, e.g. row "
+            f"{mismatched[0]}: {actual[mismatched[0]]} != {expected[mismatched[0]]}"
+        )
+
+
+def export(booster, model_dir: str, X: Optional[np.ndarray] = None) -> str:
+    """Compiles `booster`, verifies it on `X` and boundary rows, and writes
+    model_compiled.npz to `model_dir`.
+
+    Returns:
+        The path of the compiled model.
+    """
+    model = CompiledModel.from_booster(booster)
+    samples = [boundary_sample(model)]
+    if X is not None:
+        samples.append(np.asarray(X, dtype=np.float32))
+    for sample in samples:
+        verify(model, booster, sample)
+    path = os.path.join(model_dir, COMPILED_MODEL_FILENAME)
+    model.save(path)
+    print(
+        f"Compiled model saved to {path}: {len(model.roots)} trees, "
+        f"{len(model.left)} nodes, {os.path.getsize(path)} bytes, verified on "
+        f"{sum(len(s) for s in samples)} rows"
+    )
+    return path
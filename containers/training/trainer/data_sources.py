@@ -0,0 +1,279 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Columnar (Arrow) data sources for the trainer.
+
+BigQuery tables are read through the BigQuery Storage Read API as Arrow record
+batches, so the data goes straight into memory without the temporary CSV used
+by `train.load_data_from_bq`. Parquet files are read the same way and act as a
+local stand-in for a BigQuery table.
+"""
+import datetime
+import os
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DEFAULT_BATCH_SIZE = 65536
+PARQUET_SUFFIXES = (".parquet", ".pq")
+# Columns added by the storage trigger when appending uploads to the
+# partitioned training table (see functions/storage_trigger/ingest.py)
+NON_FEATURE_COLUMNS = ("source_file", "ingested_at")
+
+
+def parse_bq_uri(bq_uri: str) -> Tuple[str, str]:
+    """Parses a bq://[project.]dataset.table URI.
+
+    Returns:
+        Tuple[str, str]: The project ID and the fully qualified table reference.
+    """
+    parts = bq_uri.replace("bq://", "").split(".")
+    if len(parts) == 3:
+        project_id = parts[0]
+    elif len(parts) == 2:
+        project_id = os.environ.get("CLOUD_ML_PROJECT_ID")
+        if project_id is None:
+            raise ValueError(
+                "Project ID must be provided in the URI or environment variable."
+            )
+        parts = [project_id] + parts
+    else:
+        raise ValueError(f"Invalid BigQuery URI: {bq_uri}")
+
+    return project_id, ".".join(parts)
+
+
+def split_features(
+    df: pd.DataFrame, label_column: str = "target", drop_columns: Sequence[str] = ()
+) -> Tuple[pd.DataFrame, pd.Series]:
+    """Splits rows into features and labels, without the label, the
+    `NON_FEATURE_COLUMNS` and the extra `drop_columns` (e.g. a watermark)."""
+    extra_columns = [
+        c for c in tuple(drop_columns) + NON_FEATURE_COLUMNS if c in df.columns
+    ]
+    return df.drop([label_column] + extra_columns, axis=1), df[label_column]
+
+
+def is_bq_uri(data_path: str) -> bool:
+    return bool(data_path) and data_path.startswith("bq://")
+
+
+def is_parquet_path(data_path: str) -> bool:
+    return bool(data_path) and data_path.lower().endswith(PARQUET_SUFFIXES)
+
+
+def is_columnar_source(data_path: str) -> bool:
+    """Returns True if the data can be read as Arrow record batches."""
+    return is_bq_uri(data_path) or is_parquet_path(data_path)
+
+
+def shard_filter(rank: int, world_size: int) -> str:
+    """SQL condition selecting shard `rank` of `world_size`, by row content hash.
+
+    The table must be aliased as `t` in the query.
+    """
+    return f"MOD(ABS(FARM_FINGERPRINT(TO_JSON_STRING(t))), {world_size}) = {rank}"
+
+
+def partition_date(value: Union[str, datetime.date]) -> datetime.date:
+    """Parses a YYYY-MM-DD partition date.
+
+    Raises:
+        ValueError: `value` is not a date.
+    """
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.date.fromisoformat(value.strip())
+    except (AttributeError, ValueError):
+        raise ValueError(
+            f"Invalid partition date {value!r}, expected YYYY-MM-DD"
+        ) from None
+
+
+def partition_filter(
+    window_days: int = 0,
+    start: Optional[Union[str, datetime.date]] = None,
+    end: Optional[Union[str, datetime.date]] = None,
+) -> Optional[str]:
+    """SQL condition selecting partitions of an ingestion-time partitioned table.
+
+    Args:
+        window_days (int): Only the last `window_days` daily partitions (0: all).
+        start (str, optional): First partition date (YYYY-MM-DD), inclusive.
+        end (str, optional): Last partition date (YYYY-MM-DD), inclusive.
+
+    Returns:
+        The condition on `_PARTITIONTIME`, which lets BigQuery prune the other
+        partitions, or None if no partition is excluded.
+
+    Raises:
+        ValueError: `start` or `end` is not a date.
+    """
+    conditions = []
+    if window_days:
+        conditions.append(
+            "_PARTITIONTIME >= "
+            f"TIMESTAMP(DATE_SUB(CURRENT_DATE(), INTERVAL {int(window_days) - 1} DAY))"
+        )
+    # Only the normalized dates reach the SQL, never the raw values
+    if start:
+        start = partition_date(start).isoformat()
+        conditions.append(f"_PARTITIONTIME >= TIMESTAMP('{start}')")
+    if end:
+        end = partition_date(end).isoformat()
+        conditions.append(
+            f"_PARTITIONTIME < TIMESTAMP(DATE_ADD(DATE '{end}', INTERVAL 1 DAY))"
+        )
+    return " AND ".join(conditions) or None
+
+
+def iter_bq_record_batches(
+    bq_uri: str,
+    columns: Optional[List[str]] = None,
+    row_filter: Optional[str] = None,
+    shard: Optional[Tuple[int, int]] = None,
+) -> Iterator[pa.RecordBatch]:
+    """Streams a BigQuery table as Arrow record batches (Storage Read API).
+
+    Args:
+        bq_uri (str): bq://[project.]dataset.table URI.
+        columns (List[str], optional): Columns to read, all if None.
+        row_filter (str, optional): SQL condition. If set, the table is read
+            through a query with this WHERE clause; the query results are still
+            downloaded with the Storage Read API.
+        shard (Tuple[int, int], optional): (rank, world_size). Only the rows of
+            this shard are read, the filter is pushed down into the query.
+    """
+    from google.cloud import bigquery
+    from google.cloud import bigquery_storage
+
+    project_id, table_ref = parse_bq_uri(bq_uri)
+    bq_client = bigquery.Client(project=project_id)
+    read_client = bigquery_storage.BigQueryReadClient()
+
+    if shard and shard[1] > 1:
+        conditions = [row_filter, shard_filter(*shard)]
+        row_filter = " AND ".join(f"({c})" for c in conditions if c)
+    if row_filter:
+        select = ", ".join(f"t.`{c}`" for c in columns) if columns else "t.*"
+        sql = f"SELECT {select} FROM `{table_ref}` AS t WHERE {row_filter}"
+        print(f"SQL query: {sql}")
+        rows = bq_client.query(sql).result()
+        yield from rows.to_arrow_iterable(bqstorage_client=read_client)
+        return
+
+    table = bq_client.get_table(table_ref)
+    selected_fields = None
+    if columns:
+        selected_fields = [field for field in table.schema if field.name in columns]
+
+    print(f"Reading {table_ref} ({table.num_rows} rows) with the Storage Read API")
+    rows = bq_client.list_rows(table, selected_fields=selected_fields)
+    yield from rows.to_arrow_iterable(bqstorage_client=read_client)
+
+
+def iter_parquet_record_batches(
+    path: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    columns: Optional[List[str]] = None,
+    shard: Optional[Tuple[int, int]] = None,
+) -> Iterator[pa.RecordBatch]:
+    """Streams a Parquet file as Arrow record batches.
+
+    With `shard=(rank, world_size)`, only that shard's row groups are read. If
+    the file has fewer row groups than shards, rows are assigned by position.
+    """
+    if path.startswith("gs://"):
+        path = path.replace("gs://", "/gcs/")
+    parquet_file = pq.ParquetFile(path)
+    if not shard or shard[1] <= 1:
+        yield from parquet_file.iter_batches(batch_size=batch_size, columns=columns)
+        return
+
+    rank, world_size = shard
+    if parquet_file.num_row_groups >= world_size:
+        row_groups = list(range(rank, parquet_file.num_row_groups, world_size))
+        yield from parquet_file.iter_batches(
+            batch_size=batch_size, columns=columns, row_groups=row_groups
+        )
+        return
+
+    offset = 0
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        positions = np.arange(offset, offset + batch.num_rows)
+        offset += batch.num_rows
+        yield batch.filter(pa.array(positions % world_size == rank))
+
+
+def iter_record_batches(
+    data_path: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    columns: Optional[List[str]] = None,
+    row_filter: Optional[str] = None,
+    shard: Optional[Tuple[int, int]] = None,
+) -> Iterator[pa.RecordBatch]:
+    """Streams a BigQuery table or Parquet file as Arrow record batches.
+
+    `row_filter` is a SQL condition and is only supported for BigQuery.
+    `shard=(rank, world_size)` restricts the read to one shard of the rows.
+    """
+    if is_bq_uri(data_path):
+        return iter_bq_record_batches(
+            data_path, columns=columns, row_filter=row_filter, shard=shard
+        )
+    if row_filter:
+        raise ValueError("row_filter is only supported for bq:// sources")
+    if is_parquet_path(data_path):
+        return iter_parquet_record_batches(
+            data_path, batch_size=batch_size, columns=columns, shard=shard
+        )
+    raise ValueError(f"Not a columnar data source: {data_path}")
+
+
+def record_batches_to_frame(batches: Iterator[pa.RecordBatch]) -> pd.DataFrame:
+    """Assembles record batches into a DataFrame, releasing Arrow memory as it goes.
+
+    `self_destruct` frees each Arrow column once it has been converted, so the
+    peak footprint stays close to a single copy of the data.
+    """
+    batches = list(batches)
+    if not batches:
+        return pd.DataFrame()
+    table = pa.Table.from_batches(batches)
+    del batches
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def load_frame(
+    data_path: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    columns: Optional[List[str]] = None,
+    row_filter: Optional[str] = None,
+    shard: Optional[Tuple[int, int]] = None,
+) -> pd.DataFrame:
+    """Loads a BigQuery table or Parquet file into a DataFrame without a CSV."""
+    return record_batches_to_frame(
+        iter_record_batches(
+            data_path,
+            batch_size=batch_size,
+            columns=columns,
+            row_filter=row_filter,
+            shard=shard,
+        )
+    )
@@ -0,0 +1,220 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cache of preprocessed datasets, keyed by a fingerprint of their source.
+
+Each entry holds the preprocessed features and labels as uncompressed Arrow IPC
+(Feather v2) files, which are opened memory-mapped on a hit. Entries are evicted
+least-recently-used once the cache grows beyond `max_bytes`.
+"""
+import base64
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Callable, Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+import data_sources
+
+# Bump when `preprocess_data` changes, so stale entries are not reused.
+PREPROCESS_VERSION = 1
+DEFAULT_MAX_BYTES = 10 * 1024**3
+INDEX_FILE = "index.json"
+FEATURES_FILE = "features.arrow"
+LABELS_FILE = "labels.arrow"
+
+
+def _md5_of_file(path: str, block_size: int = 8 * 1024 * 1024) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def fingerprint_source(data_path: str) -> str:
+    """Returns a string that changes whenever the source data changes.
+
+    bq:// tables use their last-modified time and row count. Files are keyed by
+    their content only, the md5 of a local file or of a gs:// object, so the
+    same data reached through another path (e.g. /gcs/ or a local copy) hits
+    the same entry.
+    """
+    if data_sources.is_bq_uri(data_path):
+        from google.cloud import bigquery
+
+        project_id, table_ref = data_sources.parse_bq_uri(data_path)
+        table = bigquery.Client(project=project_id).get_table(table_ref)
+        source = f"{table_ref}|{table.modified.isoformat()}|{table.num_rows}"
+    elif data_path.startswith("gs://"):
+        from google.cloud import storage
+
+        bucket_name, blob_name = data_path.replace("gs://", "").split("/", 1)
+        blob = storage.Client().bucket(bucket_name).get_blob(blob_name)
+        if blob is None:
+            raise FileNotFoundError(data_path)
+        if blob.md5_hash:
+            # GCS reports the md5 base64-encoded
+            source = f"md5|{base64.b64decode(blob.md5_hash).hex()}"
+        else:
+            # Composite objects only have a crc32c
+            source = f"crc32c|{blob.crc32c}"
+    else:
+        source = f"md5|{_md5_of_file(data_path)}"
+
+    return f"v{PREPROCESS_VERSION}|{source}"
+
+
+class DatasetCache:
+    """LRU cache of preprocessed (X, y) pairs stored as memory-mappable Arrow files.
+
+    Args:
+        cache_dir (str): Local directory holding the entries. Prefer a local disk
+            over a GCSFuse path, since entries are memory-mapped.
+        max_bytes (int): Total size above which the least recently used entries
+            are evicted.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index = self._read_index()
+
+    def _read_index(self) -> dict:
+        index_path = os.path.join(self.cache_dir, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return {}
+        with open(index_path) as f:
+            index = json.load(f)
+        # Drop entries whose files were removed behind our back
+        return {
+            key: entry
+            for key, entry in index.items()
+            if os.path.isdir(os.path.join(self.cache_dir, key))
+        }
+
+    def _write_index(self) -> None:
+        index_path = os.path.join(self.cache_dir, INDEX_FILE)
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._index, f, indent=2)
+        os.replace(tmp_path, index_path)
+
+    @staticmethod
+    def key_for(fingerprint: str) -> str:
+        return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:32]
+
+    def total_bytes(self) -> int:
+        return sum(entry["size_bytes"] for entry in self._index.values())
+
+    def get(self, key: str) -> Optional[Tuple[pd.DataFrame, pd.Series]]:
+        """Opens a cached entry memory-mapped, or returns None on a miss."""
+        if key not in self._index:
+            self.misses += 1
+            return None
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        features = feather.read_table(
+            os.path.join(entry_dir, FEATURES_FILE), memory_map=True
+        )
+        labels = feather.read_table(os.path.join(entry_dir, LABELS_FILE), memory_map=True)
+        # Numeric columns without nulls are converted without copying the buffers
+        X = features.to_pandas(split_blocks=True)
+        y = labels.column(0).to_pandas().rename(labels.column_names[0])
+
+        self._index[key]["last_access"] = time.time()
+        self._write_index()
+        self.hits += 1
+        return X, y
+
+    def put(self, key: str, X: pd.DataFrame, y: pd.Series, source: str = "") -> None:
+        """Stores an entry, then evicts older entries if the cache is over size."""
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = f"{entry_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        feather.write_feather(
+            pa.Table.from_pandas(X, preserve_index=False),
+            os.path.join(tmp_dir, FEATURES_FILE),
+            compression="uncompressed",
+        )
+        feather.write_feather(
+            pa.Table.from_pandas(y.to_frame(), preserve_index=False),
+            os.path.join(tmp_dir, LABELS_FILE),
+            compression="uncompressed",
+        )
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+
+        size_bytes = sum(
+            os.path.getsize(os.path.join(entry_dir, name))
+            for name in (FEATURES_FILE, LABELS_FILE)
+        )
+        now = time.time()
+        self._index[key] = {
+            "source": source,
+            "size_bytes": size_bytes,
+            "created": now,
+            "last_access": now,
+        }
+        self._evict(keep=key)
+        self._write_index()
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        by_last_access = sorted(
+            (k for k in self._index if k != keep),
+            key=lambda k: self._index[k]["last_access"],
+        )
+        while self.total_bytes() > self.max_bytes and by_last_access:
+            key = by_last_access.pop(0)
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            del self._index[key]
+            self.evictions += 1
+            print(f"[dataset_cache] Evicted {key}")
+
+    def load_or_build(
+        self, data_path: str, build: Callable[[], Tuple[pd.DataFrame, pd.Series]]
+    ) -> Tuple[pd.DataFrame, pd.Series]:
+        """Returns the cached (X, y) for `data_path`, calling `build` on a miss."""
+        fingerprint = fingerprint_source(data_path)
+        key = self.key_for(fingerprint)
+
+        cached = self.get(key)
+        if cached is not None:
+            print(f"[dataset_cache] HIT {key} for {data_path}")
+            X, y = cached
+        else:
+            print(f"[dataset_cache] MISS {key} for {data_path}")
+            X, y = build()
+            self.put(key, X, y, source=fingerprint)
+
+        self.report()
+        return X, y
+
+    def report(self) -> None:
+        print(
+            f"[dataset_cache] hits={self.hits} misses={self.misses} "
+            f"evictions={self.evictions} entries={len(self._index)} "
+            f"size={self.total_bytes() / 1024**2:.1f}MiB/"
+            f"{self.max_bytes / 1024**2:.1f}MiB"
+        )
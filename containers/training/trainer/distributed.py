@@ -0,0 +1,244 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Multi-worker XGBoost training over the replicas of a Vertex AI custom job.
+
+Rank 0 (the workerpool0 replica) starts XGBoost's Rabit tracker on
+`tracker_port`, and every replica, rank 0 included, joins the collective
+communicator through it. Each replica only reads its shard of the data; the
+histograms, evaluation metrics and label count are all-reduced, so all
+replicas end up with the same model and only rank 0 writes the artifacts.
+
+The same code runs locally as N subprocesses on one machine:
+
+    python distributed.py --num_workers 4 -- --data_path data.csv --model_dir model
+"""
+import argparse
+import contextlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+from xgboost import collective
+from xgboost.tracker import RabitTracker
+
+import cluster
+import data_sources
+import metrics
+import resources
+
+DEFAULT_TRACKER_PORT = 9091
+
+
+def _legacy_tracker() -> bool:
+    """xgboost < 2.1 ships the Python tracker, with a different interface."""
+    return not hasattr(RabitTracker, "worker_args")
+
+
+def start_tracker(world_size: int, port: int) -> RabitTracker:
+    """Starts the Rabit tracker for `world_size` workers, listening on `port`."""
+    # Keyword arguments: the positional order changed in xgboost 2.1
+    tracker = RabitTracker(
+        host_ip="0.0.0.0", n_workers=world_size, port=port, sortby="task"
+    )
+    if _legacy_tracker():
+        tracker.start(world_size)
+    else:
+        tracker.start()
+    print(f"Rabit tracker listening on port {port} for {world_size} workers")
+    return tracker
+
+
+def communicator_args(tracker_host: str, port: int, rank: int) -> Dict[str, Any]:
+    """Arguments of `collective.CommunicatorContext` for the given xgboost version.
+
+    The task ID makes the tracker assign ranks in the order of the cluster spec.
+    """
+    if _legacy_tracker():
+        return {
+            "DMLC_TRACKER_URI": tracker_host,
+            "DMLC_TRACKER_PORT": port,
+            "DMLC_TASK_ID": str(rank),
+        }
+    return {
+        "dmlc_tracker_uri": tracker_host,
+        "dmlc_tracker_port": port,
+        "dmlc_task_id": str(rank),
+    }
+
+
+@contextlib.contextmanager
+def distributed_context(
+    info: cluster.ClusterInfo, port: int = DEFAULT_TRACKER_PORT
+) -> Iterator[None]:
+    """Joins the collective communicator; rank 0 also runs the tracker."""
+    tracker_host = info.hosts[0].rsplit(":", 1)[0]
+    tracker = start_tracker(info.world_size, port) if info.rank == 0 else None
+
+    with collective.CommunicatorContext(
+        **communicator_args(tracker_host, port, info.rank)
+    ):
+        print(
+            f"Joined the communicator as rank {collective.get_rank()} "
+            f"of {collective.get_world_size()}"
+        )
+        yield
+
+    if tracker is not None:
+        if _legacy_tracker():
+            tracker.join()
+        else:
+            tracker.wait_for()
+
+
+def load_shard(
+    data_path: str,
+    rank: int,
+    world_size: int,
+    chunk_size: int = 100_000,
+    row_filter: Optional[str] = None,
+) -> pd.DataFrame:
+    """Loads the rows of shard `rank` out of `world_size`.
+
+    BigQuery and Parquet sources only read their shard (see `data_sources`). CSV
+    files are streamed in chunks and rows are assigned by position, so a worker
+    never holds more than its shard plus one chunk. `row_filter` is a SQL
+    condition and is only supported for BigQuery.
+    """
+    shard = (rank, world_size)
+    if data_sources.is_columnar_source(data_path):
+        df = data_sources.load_frame(
+            data_path, batch_size=chunk_size, row_filter=row_filter, shard=shard
+        )
+    elif row_filter:
+        raise ValueError("row_filter is only supported for bq:// sources")
+    else:
+        if data_path.startswith("gs://"):
+            data_path = data_path.replace("gs://", "/gcs/")
+        parts = []
+        offset = 0
+        for chunk in pd.read_csv(data_path, chunksize=chunk_size):
+            positions = np.arange(offset, offset + len(chunk))
+            offset += len(chunk)
+            parts.append(chunk[positions % world_size == rank])
+        df = pd.concat(parts, ignore_index=True)
+    print(f"Rank {rank}/{world_size} loaded its shard of {data_path}: {df.shape}")
+    return df
+
+
+def allreduce_max(value: float) -> float:
+    result = collective.allreduce(np.array([value], np.float64), collective.Op.MAX)
+    return float(result[0])
+
+
+def _allreduce_sum(array: np.ndarray) -> np.ndarray:
+    # allreduce returns a flat array
+    return collective.allreduce(array, collective.Op.SUM).reshape(array.shape)
+
+
+def allreduce_metrics(state: metrics.EvaluationMetrics) -> metrics.EvaluationMetrics:
+    """Sums the metric states of all workers (slices and latencies stay local)."""
+    state.confusion = _allreduce_sum(state.confusion)
+    state.bin_count = _allreduce_sum(state.bin_count)
+    state.bin_confidence = _allreduce_sum(state.bin_confidence)
+    state.bin_correct = _allreduce_sum(state.bin_correct)
+    state.log_loss_sum = float(_allreduce_sum(np.array([state.log_loss_sum]))[0])
+    return state
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def local_cluster_spec(rank: int, world_size: int) -> str:
+    """A Vertex AI style CLUSTER_SPEC for replica `rank` of a local cluster."""
+    spec = {
+        "cluster": {
+            "workerpool0": ["127.0.0.1:2222"],
+            "workerpool1": ["127.0.0.1:2222"] * (world_size - 1),
+        },
+        "task": {
+            "type": "workerpool0" if rank == 0 else "workerpool1",
+            "index": 0 if rank == 0 else rank - 1,
+        },
+    }
+    return json.dumps(spec)
+
+
+def launch_local(
+    num_workers: int,
+    train_args: List[str],
+    nthread: Optional[int] = None,
+    cwd: Optional[str] = None,
+) -> float:
+    """Runs `train.py --distributed` as `num_workers` local processes.
+
+    The CPUs are split between the workers unless `nthread` is given. The
+    workers run in `cwd`, where they write their TensorBoard `runs/`.
+
+    Returns:
+        float: Wall time in seconds.
+    """
+    train_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "train.py")
+    nthread = nthread or max(resources.available_cpus() // num_workers, 1)
+    port = _free_port()
+
+    start = time.perf_counter()
+    processes = []
+    for rank in range(num_workers):
+        env = dict(os.environ, CLUSTER_SPEC=local_cluster_spec(rank, num_workers))
+        env.pop("TF_CONFIG", None)
+        processes.append(
+            subprocess.Popen(
+                [sys.executable, train_py, "--distributed"]
+                + ["--tracker_port", str(port), "--nthread", str(nthread)]
+                + train_args,
+                env=env,
+                cwd=cwd,
+            )
+        )
+    return_codes = [process.wait() for process in processes]
+    elapsed = time.perf_counter() - start
+    if any(return_codes):
+        raise RuntimeError(f"Local distributed training failed: {return_codes}")
+    print(f"{num_workers} local workers finished in {elapsed:.2f}s")
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run distributed training as local subprocesses."
+    )
+    parser.add_argument("--num_workers", type=int, default=2)
+    parser.add_argument(
+        "--nthread",
+        type=int,
+        default=None,
+        help="Threads per worker (default: the available CPUs split evenly).",
+    )
+    parser.add_argument(
+        "train_args", nargs=argparse.REMAINDER, help="Arguments for train.py"
+    )
+    args = parser.parse_args()
+    train_args = args.train_args
+    if train_args and train_args[0] == "--":
+        train_args = train_args[1:]
+    launch_local(args.num_workers, train_args, nthread=args.nthread)
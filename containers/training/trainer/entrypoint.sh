@@ -21,9 +21,14 @@
 # Get the script name for usage messages
 SCRIPT_NAME=$(basename "$0")
 
+# Vertex AI prediction containers start the image without arguments
+if [ -z "$1" ] && [ -n "$AIP_HTTP_PORT" ]; then
+  set -- serve
+fi
+
 # Check if any arguments are provided
 if [ -z "$1" ]; then
-  echo "Usage: $SCRIPT_NAME [train|eval] [arguments...]"
+  echo "Usage: $SCRIPT_NAME [train|eval|serve] [arguments...]"
   exit 1
 fi
 
@@ -43,9 +48,13 @@ case "$COMMAND" in
     echo "Starting evaluation..."
     python evaluation.py "$@"  # Pass all remaining arguments to eval.py
     ;;
+  "serve")
+    echo "Starting prediction server..."
+    exec python serve.py "$@"  # Replaces the shell, so it receives SIGTERM
+    ;;
   *)
     echo "Invalid command: $COMMAND"
-    echo "Usage: $SCRIPT_NAME [train|eval] [arguments...]"
+    echo "Usage: $SCRIPT_NAME [train|eval|serve] [arguments...]"
     exit 1
     ;;
 esac
@@ -11,14 +11,43 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+"""Evaluates a saved model on one or more data files.
+
+The native engine loads `model.bst` once and streams the evaluation data in
+fixed-size batches straight into `Booster.inplace_predict`, updating the
+streaming metrics of `metrics.py` as it goes, so the data is never materialized
+as Python lists. Several files can be evaluated in parallel on a process pool;
+the per-file metric states are merged. The `predictor` engine keeps the previous path
+through the Vertex AI `XgboostPredictor`.
+
+Without a data path, the holdout the trainer saved in the model directory is
+used (see holdout.py). It is memory-mapped once per process, so
+`evaluate_candidates` scores many models on it without reloading the data.
+"""
 import argparse
+import functools
+import json
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
 import numpy as np
 import logging
 import pandas as pd
 import xgboost as xgb
 from sklearn.metrics import accuracy_score  # Or any other relevant metric
+import data_sources
+import holdout
+import metrics
 from train import preprocess_data  # Import the preprocessing function
 
+DEFAULT_BATCH_SIZE = 65536
+
+# Booster of a pool worker, loaded once by `_init_worker`
+_BOOSTER = None
+
 
 def load_predictor(model_dir: str) -> xgb.XGBClassifier:  # or xgb.XGBRegressor
     from google.cloud.aiplatform.prediction.xgboost.predictor import XgboostPredictor
@@ -28,26 +57,137 @@ def load_predictor(model_dir: str) -> xgb.XGBClassifier:  # or xgb.XGBRegressor
     return predictor
 
 
-def evaluate(model_dir: str, data_path: str) -> None:
-    """Evaluates the model on the given data."""
+def load_booster(model_dir: str) -> xgb.Booster:
+    """Loads model.bst from `model_dir` (gs:// paths are read through GCSFuse)."""
+    if model_dir.startswith("gs://"):
+        model_dir = model_dir.replace("gs://", "/gcs/")
+    model_path = os.path.join(model_dir, "model.bst")
+    print(f"Loading model from {model_path}")
+    booster = xgb.Booster()
+    booster.load_model(model_path)
+    return booster
 
-    print("Starting evaluation...")
-    print(f"Model directory: {model_dir}")
-    print(f"Data path: {data_path}")
-    from sklearn.datasets import load_iris
 
-    if not data_path:
-        print("Data path not provided... will create something")
-        iris = load_iris()
-        iris_df = pd.DataFrame(
-            data=np.c_[iris["data"], iris["target"]],
-            columns=iris["feature_names"] + ["target"],
+def get_num_classes(booster: xgb.Booster) -> int:
+    config = json.loads(booster.save_config())
+    return max(int(config["learner"]["learner_model_param"]["num_class"]), 2)
+
+
+def iter_eval_batches(
+    data_path: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    slice_column: Optional[str] = None,
+) -> Iterator[Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]]:
+    """Streams (features, labels, slice values) NumPy batches from a holdout
+    directory, a CSV, Parquet or bq:// source."""
+    if holdout.is_holdout(data_path):
+        yield from holdout.iter_batches(data_path, batch_size, slice_column)
+        return
+    if data_sources.is_columnar_source(data_path):
+        frames = (
+            batch.to_pandas()
+            for batch in data_sources.iter_record_batches(
+                data_path, batch_size=batch_size
+            )
         )
-        iris_df.to_csv("iris.csv", index=False)
+    else:
+        if data_path.startswith("gs://"):
+            data_path = data_path.replace("gs://", "/gcs/")
+        frames = pd.read_csv(data_path, chunksize=batch_size)
 
-        data_path = "iris.csv"
-        print(f"Will use {data_path}")
+    for df in frames:
+        X, y = preprocess_data(df)
+        if len(X):
+            slice_values = None
+            if slice_column:
+                slice_values = df.loc[X.index, slice_column].to_numpy()
+            yield X.to_numpy(dtype=np.float32), y.to_numpy(), slice_values
+
+
+def evaluate_file(
+    booster: xgb.Booster,
+    data_path: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    slice_column: Optional[str] = None,
+) -> metrics.EvaluationMetrics:
+    """Returns the metrics state of `booster` on one data file."""
+    state = metrics.EvaluationMetrics(get_num_classes(booster))
+    for X, y, slice_values in iter_eval_batches(
+        data_path, batch_size=batch_size, slice_column=slice_column
+    ):
+        with state.time_batch(len(X)):
+            margin = booster.inplace_predict(X, predict_type="margin")
+        state.update(y, margin, slice_values=slice_values)
+    print(f"Evaluated {data_path}: {state.count} rows")
+    return state
+
+
+def _init_worker(model_dir: str) -> None:
+    global _BOOSTER
+    _BOOSTER = load_booster(model_dir)
+    # Files are evaluated in parallel, so one thread per worker
+    _BOOSTER.set_param({"nthread": 1})
+
+
+def _evaluate_file_in_worker(
+    data_path: str, batch_size: int, slice_column: Optional[str]
+) -> metrics.EvaluationMetrics:
+    return evaluate_file(
+        _BOOSTER, data_path, batch_size=batch_size, slice_column=slice_column
+    )
 
+
+def evaluate_native(
+    model_dir: str,
+    data_paths: List[str],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    num_workers: int = 1,
+    slice_column: Optional[str] = None,
+) -> metrics.EvaluationMetrics:
+    """Metrics over all `data_paths`, using a process pool if num_workers > 1.
+
+    Each file yields a partial metrics state; the states are merged.
+    """
+    if num_workers <= 1 or len(data_paths) <= 1:
+        booster = load_booster(model_dir)
+        states = [
+            evaluate_file(booster, path, batch_size, slice_column)
+            for path in data_paths
+        ]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=min(num_workers, len(data_paths)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(model_dir,),
+        ) as pool:
+            states = list(
+                pool.map(
+                    _evaluate_file_in_worker,
+                    data_paths,
+                    [batch_size] * len(data_paths),
+                    [slice_column] * len(data_paths),
+                )
+            )
+    return functools.reduce(lambda a, b: a.merge(b), states)
+
+
+def evaluate_candidates(
+    model_dirs: List[str],
+    data_path: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    slice_column: Optional[str] = None,
+) -> List[metrics.EvaluationMetrics]:
+    """Metrics of several models on the same data, e.g. a holdout directory,
+    which is opened once for all of them."""
+    return [
+        evaluate_native(model_dir, data_path.split(","), batch_size, 1, slice_column)
+        for model_dir in model_dirs
+    ]
+
+
+def evaluate_with_predictor(model_dir: str, data_path: str) -> float:
+    """Previous evaluation path, through the Vertex AI prediction container code."""
     print("Will load predictor")
     # Load the model
     predictor = load_predictor(model_dir)
@@ -67,7 +207,68 @@ def evaluate(model_dir: str, data_path: str) -> None:
     # Evaluate the model
     y_pred = predictor.predict(preprocessed)
 
-    accuracy = accuracy_score(y_eval, y_pred)
+    return accuracy_score(y_eval, y_pred)
+
+
+def evaluate(
+    model_dir: str,
+    data_path: Optional[str],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    num_workers: int = 1,
+    engine: str = "native",
+    slice_column: Optional[str] = None,
+    metrics_output: Optional[str] = None,
+) -> float:
+    """Evaluates the model on the given data.
+
+    Args:
+        data_path (str): A data file, or several separated by commas. If
+            None, the holdout saved in `model_dir` (if any).
+        slice_column (str, optional): Column whose values define the slices for
+            per-slice metrics (native engine).
+        metrics_output (str, optional): Where to write the metrics report as
+            JSON (native engine).
+    """
+
+    print("Starting evaluation...")
+    print(f"Model directory: {model_dir}")
+    print(f"Data path: {data_path}")
+    from sklearn.datasets import load_iris
+
+    if not data_path and holdout.is_holdout(holdout.holdout_dir(model_dir)):
+        data_path = holdout.holdout_dir(model_dir)
+        print(f"Data path not provided, will use the holdout {data_path}")
+
+    if not data_path:
+        print("Data path not provided... will create something")
+        iris = load_iris()
+        iris_df = pd.DataFrame(
+            data=np.c_[iris["data"], iris["target"]],
+            columns=iris["feature_names"] + ["target"],
+        )
+        # Not in the working directory, which may be the source tree
+        data_path = os.path.join(tempfile.mkdtemp(), "iris.csv")
+        iris_df.to_csv(data_path, index=False)
+        print(f"Will use {data_path}")
+
+    if engine == "predictor":
+        accuracy = evaluate_with_predictor(model_dir, data_path)
+    else:
+        state = evaluate_native(
+            model_dir,
+            data_path.split(","),
+            batch_size=batch_size,
+            num_workers=num_workers,
+            slice_column=slice_column,
+        )
+        report = state.to_dict()
+        print(f"Confusion matrix:\n{state.confusion}")
+        print(f"Metrics: {json.dumps(metrics.scalar_metrics(report), indent=2)}")
+        if metrics_output:
+            with open(metrics_output, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"Metrics written to {metrics_output}")
+        accuracy = report["accuracy"]
 
     print(f"Evaluation complete. Accuracy: {accuracy}")
     return accuracy
@@ -75,7 +276,6 @@ def evaluate(model_dir: str, data_path: str) -> None:
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Evaluate an XGBoost model.")
-    import os
 
     parser.add_argument(
         "--model_dir",
@@ -86,9 +286,51 @@ if __name__ == "__main__":
     parser.add_argument(
         "--data_path",
         type=str,
-        required=True,
-        help="Path to the evaluation data (CSV).",
+        default=None,
+        help="Path to the evaluation data (CSV, Parquet, bq:// or a holdout "
+        "directory). Several files can be given separated by commas. Default: "
+        "the holdout saved in --model_dir.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Rows per prediction batch.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="Processes used to evaluate several files in parallel.",
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["native", "predictor"],
+        default="native",
+        help="native: streaming Booster.inplace_predict. predictor: Vertex AI "
+        "XgboostPredictor on the whole file.",
+    )
+    parser.add_argument(
+        "--slice_column",
+        type=str,
+        default=None,
+        help="Column used to slice the per-slice metrics.",
+    )
+    parser.add_argument(
+        "--metrics_output",
+        type=str,
+        default=None,
+        help="Path of the JSON metrics report.",
     )
     args = parser.parse_args()
 
-    evaluate(args.model_dir, args.data_path)
+    evaluate(
+        args.model_dir,
+        args.data_path,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        engine=args.engine,
+        slice_column=args.slice_column,
+        metrics_output=args.metrics_output,
+    )
@@ -0,0 +1,225 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Out-of-core training for tables larger than the worker's memory.
+
+Data is streamed in chunks of `chunk_size` rows from a CSV file, a Parquet file
+or a BigQuery table into an external-memory `xgb.DMatrix`, whose pages are
+cached on local disk. Rows are assigned to the train or test split by hashing
+their content, so the split is deterministic and never needs the whole table.
+"""
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+import data_sources
+import metrics
+
+DEFAULT_CHUNK_SIZE = 100_000
+HASH_BUCKETS = 10_000
+
+
+def iter_chunks(
+    data_path: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    columns: Optional[List[str]] = None,
+    row_filter: Optional[str] = None,
+) -> Iterator[pd.DataFrame]:
+    """Yields the data as DataFrames of at most `chunk_size` rows.
+
+    `row_filter` is a SQL condition and is only supported for BigQuery.
+    """
+    if data_sources.is_columnar_source(data_path):
+        for batch in data_sources.iter_record_batches(
+            data_path, batch_size=chunk_size, columns=columns, row_filter=row_filter
+        ):
+            yield batch.to_pandas()
+    elif row_filter:
+        raise ValueError("row_filter is only supported for bq:// sources")
+    else:
+        yield from pd.read_csv(data_path, chunksize=chunk_size, usecols=columns)
+
+
+def in_test_split(X: pd.DataFrame, y: pd.Series, test_fraction: float) -> np.ndarray:
+    """Returns True for rows that belong to the test split.
+
+    The decision only depends on the row's features and label, so a row lands
+    in the same split regardless of chunk boundaries, read order or training
+    mode, and in every run over a growing table.
+    """
+    rows = pd.concat([X, y], axis=1)
+    hashes = pd.util.hash_pandas_object(rows, index=False).to_numpy()
+    return (hashes % HASH_BUCKETS) < int(test_fraction * HASH_BUCKETS)
+
+
+class ChunkedDataIter(xgb.DataIter):
+    """Feeds one split of a chunked data source to XGBoost.
+
+    Args:
+        data_path (str): CSV path, Parquet path or bq:// URI.
+        subset (str): "train" or "test".
+        chunk_size (int): Maximum number of rows held in memory at once.
+        test_fraction (float): Fraction of rows that go to the test split.
+        cache_prefix (str, optional): Prefix for the on-disk DMatrix pages.
+            If None, the iterator builds an in-memory DMatrix.
+        label_column (str): Name of the label column.
+        row_filter (str, optional): SQL condition on the rows of a bq:// source.
+    """
+
+    def __init__(
+        self,
+        data_path: str,
+        subset: str = "train",
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        test_fraction: float = 0.2,
+        cache_prefix: Optional[str] = None,
+        label_column: str = "target",
+        row_filter: Optional[str] = None,
+    ):
+        if subset not in ("train", "test"):
+            raise ValueError(f"Unknown subset: {subset}")
+        self.data_path = data_path
+        self.subset = subset
+        self.chunk_size = chunk_size
+        self.test_fraction = test_fraction
+        self.label_column = label_column
+        self.row_filter = row_filter
+        self._chunks = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def iter_xy(self) -> Iterator[Tuple[pd.DataFrame, pd.Series]]:
+        """Yields preprocessed (X, y) chunks of this iterator's split."""
+        for chunk in iter_chunks(
+            self.data_path, self.chunk_size, row_filter=self.row_filter
+        ):
+            X, y = data_sources.split_features(chunk.dropna(), self.label_column)
+            mask = in_test_split(X, y, self.test_fraction)
+            if self.subset == "train":
+                mask = ~mask
+            if not mask.any():
+                continue
+            yield X[mask], y[mask]
+
+    def next(self, input_data) -> int:
+        if self._chunks is None:
+            self._chunks = self.iter_xy()
+        for X, y in self._chunks:
+            input_data(data=X, label=y)
+            return 1
+        return 0
+
+    def reset(self) -> None:
+        self._chunks = None
+
+
+def count_classes(
+    data_path: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    label_column: str = "target",
+    row_filter: Optional[str] = None,
+) -> int:
+    """Counts the distinct labels with a label-only pass over the data."""
+    labels = set()
+    for chunk in iter_chunks(
+        data_path, chunk_size, columns=[label_column], row_filter=row_filter
+    ):
+        labels.update(chunk[label_column].dropna().unique().tolist())
+    return len(labels)
+
+
+def train_external_memory(
+    params: Dict[str, Any],
+    data_path: str,
+    num_boost_round: int,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    test_fraction: float = 0.2,
+    cache_dir: Optional[str] = None,
+    xgb_model: Optional[xgb.Booster] = None,
+    callbacks: Optional[List[xgb.callback.TrainingCallback]] = None,
+    row_filter: Optional[str] = None,
+) -> xgb.Booster:
+    """Trains a booster on an external-memory DMatrix built chunk by chunk."""
+    cache_dir = cache_dir or os.path.join(os.getcwd(), "xgb_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    train_iter = ChunkedDataIter(
+        data_path,
+        subset="train",
+        chunk_size=chunk_size,
+        test_fraction=test_fraction,
+        cache_prefix=os.path.join(cache_dir, "train"),
+        row_filter=row_filter,
+    )
+    test_iter = ChunkedDataIter(
+        data_path,
+        subset="test",
+        chunk_size=chunk_size,
+        test_fraction=test_fraction,
+        cache_prefix=os.path.join(cache_dir, "test"),
+        row_filter=row_filter,
+    )
+    dtrain = xgb.DMatrix(train_iter)
+    dtest = xgb.DMatrix(test_iter)
+    print(
+        f"External-memory DMatrix built: {dtrain.num_row()} train rows, "
+        f"{dtest.num_row()} test rows (chunk size {chunk_size})"
+    )
+
+    booster = xgb.train(
+        params,
+        dtrain,
+        num_boost_round=num_boost_round,
+        evals=[(dtest, "test")],
+        xgb_model=xgb_model,
+        callbacks=callbacks,
+        verbose_eval=False,
+    )
+    print("XGBoost model trained successfully (external memory).")
+    return booster
+
+
+def evaluate_external_memory(
+    booster: xgb.Booster,
+    data_path: str,
+    num_classes: int,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    test_fraction: float = 0.2,
+    row_filter: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Computes the test metrics chunk by chunk.
+
+    Returns:
+        Dict[str, Any]: The metrics report, see `metrics.EvaluationMetrics.to_dict`.
+    """
+    test_iter = ChunkedDataIter(
+        data_path,
+        subset="test",
+        chunk_size=chunk_size,
+        test_fraction=test_fraction,
+        row_filter=row_filter,
+    )
+    state = metrics.EvaluationMetrics(num_classes)
+    for X, y in test_iter.iter_xy():
+        with state.time_batch(len(X)):
+            margin = booster.inplace_predict(X, predict_type="margin")
+        state.update(y.to_numpy(), margin)
+
+    report = state.to_dict()
+    print(
+        f"Model evaluation complete. Accuracy: {report['accuracy']} "
+        f"({state.count} test rows)"
+    )
+    return report
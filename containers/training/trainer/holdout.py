@@ -0,0 +1,149 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""The trainer's held-out split, persisted next to the model.
+
+`save_holdout` writes the test features and labels once, as `.npy` shards
+(float32 C-ordered feature matrices, label vectors) under `<model_dir>/holdout/`
+with a `manifest.json`, written last so a reader never sees a partial holdout.
+
+`open_holdout` opens the shards memory-mapped and keeps them open for the
+process, so evaluating many models on the same holdout never reloads or
+reparses the data; the batches are views that `Booster.inplace_predict` reads
+without copying.
+"""
+import functools
+import json
+import os
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+HOLDOUT_DIR = "holdout"
+MANIFEST_FILE = "manifest.json"
+DEFAULT_SHARD_ROWS = 1_000_000
+
+
+class Holdout(NamedTuple):
+    feature_names: List[str]
+    # (features, labels) per shard, memory-mapped
+    shards: List[Tuple[np.ndarray, np.ndarray]]
+
+    @property
+    def rows(self) -> int:
+        return sum(len(labels) for _, labels in self.shards)
+
+
+def _local_path(path: str) -> str:
+    """gs:// paths are read and written through GCSFuse."""
+    return path.replace("gs://", "/gcs/") if path.startswith("gs://") else path
+
+
+def holdout_dir(model_dir: str) -> str:
+    return os.path.join(_local_path(model_dir), HOLDOUT_DIR)
+
+
+def is_holdout(path: str) -> bool:
+    """Whether `path` is a complete holdout directory."""
+    return os.path.exists(os.path.join(_local_path(path), MANIFEST_FILE))
+
+
+def save_holdout(
+    model_dir: str,
+    X: pd.DataFrame,
+    y: pd.Series,
+    shard_rows: int = DEFAULT_SHARD_ROWS,
+) -> str:
+    """Writes the held-out split to `<model_dir>/holdout/`.
+
+    Returns:
+        The holdout directory.
+    """
+    directory = holdout_dir(model_dir)
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    # A rewritten holdout is incomplete until its new manifest exists
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    features = X.to_numpy(dtype=np.float32)
+    labels = y.to_numpy()
+    shards = []
+    for index, start in enumerate(range(0, max(len(features), 1), shard_rows)):
+        names = {
+            "features": f"features-{index:05d}.npy",
+            "labels": f"labels-{index:05d}.npy",
+        }
+        np.save(
+            os.path.join(directory, names["features"]),
+            np.ascontiguousarray(features[start : start + shard_rows]),
+        )
+        shard_labels = labels[start : start + shard_rows]
+        np.save(os.path.join(directory, names["labels"]), shard_labels)
+        shards.append({**names, "rows": len(shard_labels)})
+
+    with open(manifest_path, "w") as f:
+        json.dump(
+            {
+                "feature_names": [str(c) for c in X.columns],
+                "label_name": str(y.name),
+                "rows": len(labels),
+                "shards": shards,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Saved a holdout of {len(labels)} rows ({len(shards)} shards) to {directory}")
+    return directory
+
+
+def _manifest_mtime(path: str) -> float:
+    return os.path.getmtime(os.path.join(path, MANIFEST_FILE))
+
+
+@functools.lru_cache(maxsize=8)
+def _open(path: str, mtime: float) -> Holdout:
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    shards = [
+        (
+            np.load(os.path.join(path, shard["features"]), mmap_mode="r"),
+            np.load(os.path.join(path, shard["labels"]), mmap_mode="r"),
+        )
+        for shard in manifest["shards"]
+    ]
+    print(f"Opened the holdout {path}: {manifest['rows']} rows, memory-mapped")
+    return Holdout(feature_names=manifest["feature_names"], shards=shards)
+
+
+def open_holdout(path: str) -> Holdout:
+    """Opens a holdout directory; repeated calls return the same mapping
+    (until the holdout is rewritten)."""
+    path = os.path.abspath(_local_path(path))
+    return _open(path, _manifest_mtime(path))
+
+
+def iter_batches(
+    path: str, batch_size: int, slice_column: Optional[str] = None
+) -> Iterator[Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]]:
+    """Streams (features, labels, slice values) views of the holdout."""
+    holdout = open_holdout(path)
+    slice_index = None
+    if slice_column:
+        slice_index = holdout.feature_names.index(slice_column)
+    for features, labels in holdout.shards:
+        for start in range(0, len(labels), batch_size):
+            X = features[start : start + batch_size]
+            slice_values = X[:, slice_index] if slice_index is not None else None
+            yield X, labels[start : start + batch_size], slice_values
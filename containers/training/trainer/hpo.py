@@ -0,0 +1,404 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Hyperparameter search around `create_model_architecture`.
+
+Candidates come from a grid, random sampling, or successive halving/Hyperband,
+and are trained on a local process pool. The train/validation split is written
+once as .npy files; each pool worker memory-maps them and builds its DMatrix a
+single time, then reuses it for every trial it runs. On a multi-replica Vertex AI
+job, every replica searches its share of the candidates and rank 0 merges the
+partial leaderboards.
+"""
+import gc
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+import cluster
+import resources
+
+LEADERBOARD_FILE = "leaderboard.json"
+DEFAULT_SEARCH_SPACE = {
+    "max_depth": [3, 5, 7],
+    "learning_rate": {"min": 0.01, "max": 0.3, "log": True},
+    "subsample": {"min": 0.6, "max": 1.0},
+}
+
+# Per-process state of the pool workers, set by `_init_worker`
+_DTRAIN = None
+_DVALID = None
+_Y_VALID = None
+_NTHREAD = 1
+
+
+GRID_POINTS = 3
+
+
+def _grid_values(values: Any, points: int = GRID_POINTS) -> List[Any]:
+    """The listed values, or `points` evenly spaced values of a range."""
+    if isinstance(values, list):
+        return values
+    low, high = values["min"], values["max"]
+    if values.get("log"):
+        grid = np.geomspace(low, high, points)
+    else:
+        grid = np.linspace(low, high, points)
+    if isinstance(low, int) and isinstance(high, int):
+        return sorted({int(round(value)) for value in grid})
+    return [float(value) for value in grid]
+
+
+def grid_candidates(space: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Every combination of the listed values; ranges are discretized into
+    `GRID_POINTS` values (log-spaced if "log")."""
+    names = sorted(space)
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(*(_grid_values(space[name]) for name in names))
+    ]
+
+
+def _sample(values: Any, rng: random.Random) -> Any:
+    if isinstance(values, list):
+        return rng.choice(values)
+    low, high = values["min"], values["max"]
+    if values.get("log"):
+        value = math.exp(rng.uniform(math.log(low), math.log(high)))
+    else:
+        value = rng.uniform(low, high)
+    if isinstance(low, int) and isinstance(high, int):
+        return int(round(value))
+    return value
+
+
+def random_candidates(
+    space: Dict[str, Any], num_trials: int, seed: int = 42
+) -> List[Dict[str, Any]]:
+    """`num_trials` samples. Lists are sampled uniformly, ranges as
+    {"min", "max", "log"}."""
+    rng = random.Random(seed)
+    return [
+        {name: _sample(values, rng) for name, values in sorted(space.items())}
+        for _ in range(num_trials)
+    ]
+
+
+def _init_worker(
+    data_dir: str, nthread: int, tree_method: Optional[str], max_bin: int
+) -> None:
+    """Builds the shared train/validation DMatrix once per pool worker.
+
+    With the hist tree method this is a QuantileDMatrix, and the validation
+    matrix reuses the training quantile cuts.
+    """
+    global _DTRAIN, _DVALID, _Y_VALID, _NTHREAD
+
+    def load(name):
+        return np.load(os.path.join(data_dir, f"{name}.npy"), mmap_mode="r")
+
+    _NTHREAD = nthread
+    _Y_VALID = np.asarray(load("y_valid"))
+    if tree_method == "hist":
+        _DTRAIN = xgb.QuantileDMatrix(
+            load("X_train"), label=load("y_train"), nthread=nthread, max_bin=max_bin
+        )
+        _DVALID = xgb.QuantileDMatrix(
+            load("X_valid"), label=_Y_VALID, nthread=nthread, ref=_DTRAIN
+        )
+    else:
+        _DTRAIN = xgb.DMatrix(load("X_train"), label=load("y_train"), nthread=nthread)
+        _DVALID = xgb.DMatrix(load("X_valid"), label=_Y_VALID, nthread=nthread)
+
+
+def _run_trial(
+    trial_id: int,
+    params: Dict[str, Any],
+    base_params: Dict[str, Any],
+    num_boost_round: int,
+    early_stopping_rounds: Optional[int],
+) -> Dict[str, Any]:
+    """Trains one candidate on the worker's shared DMatrix."""
+    start = time.time()
+    booster = xgb.train(
+        {**base_params, **params, "nthread": _NTHREAD},
+        _DTRAIN,
+        num_boost_round=num_boost_round,
+        evals=[(_DVALID, "validation")],
+        early_stopping_rounds=early_stopping_rounds,
+        verbose_eval=False,
+    )
+    best_iteration = getattr(booster, "best_iteration", booster.num_boosted_rounds() - 1)
+    y_pred = booster.predict(_DVALID, iteration_range=(0, best_iteration + 1))
+    if y_pred.ndim > 1:
+        y_pred = np.argmax(y_pred, axis=1)
+    result = {
+        "trial_id": trial_id,
+        "params": params,
+        "rounds": best_iteration + 1,
+        "score": float(booster.best_score)
+        if hasattr(booster, "best_score")
+        else None,
+        "accuracy": float(np.mean(y_pred == _Y_VALID)),
+        "seconds": round(time.time() - start, 3),
+    }
+    # Release the trial's model right away; only its summary leaves the worker
+    del booster
+    gc.collect()
+    return result
+
+
+def _rank(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Sorts by validation loss (lower is better), then by accuracy."""
+    return sorted(
+        results,
+        key=lambda r: (r["score"] if r["score"] is not None else math.inf, -r["accuracy"]),
+    )
+
+
+class SearchRunner:
+    """Runs trials on a process pool whose workers share one pre-built DMatrix."""
+
+    def __init__(
+        self,
+        X_train: pd.DataFrame,
+        y_train: pd.Series,
+        X_valid: pd.DataFrame,
+        y_valid: pd.Series,
+        base_params: Dict[str, Any],
+        num_workers: int = 0,
+        early_stopping_rounds: Optional[int] = 10,
+    ):
+        self.base_params = base_params
+        self.early_stopping_rounds = early_stopping_rounds
+        self.num_workers = num_workers or max(resources.available_cpus() // 2, 1)
+        self._next_trial_id = 0
+
+        self._data_dir = tempfile.TemporaryDirectory(prefix="hpo_")
+        for name, value in [
+            ("X_train", X_train),
+            ("y_train", y_train),
+            ("X_valid", X_valid),
+            ("y_valid", y_valid),
+        ]:
+            np.save(
+                os.path.join(self._data_dir.name, f"{name}.npy"),
+                np.ascontiguousarray(np.asarray(value, dtype=np.float32)),
+            )
+
+        nthread = max(resources.available_cpus() // self.num_workers, 1)
+        # spawn: forking a process that already initialized OpenMP can deadlock
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(
+                self._data_dir.name,
+                nthread,
+                base_params.get("tree_method"),
+                base_params.get("max_bin", 256),
+            ),
+        )
+
+    def run(
+        self, candidates: List[Dict[str, Any]], num_boost_round: int
+    ) -> List[Dict[str, Any]]:
+        futures = []
+        for params in candidates:
+            futures.append(
+                self._pool.submit(
+                    _run_trial,
+                    self._next_trial_id,
+                    params,
+                    self.base_params,
+                    num_boost_round,
+                    self.early_stopping_rounds,
+                )
+            )
+            self._next_trial_id += 1
+        results = [future.result() for future in futures]
+        for result in results:
+            print(f"[hpo] trial {json.dumps(result)}")
+        return results
+
+    def successive_halving(
+        self,
+        candidates: List[Dict[str, Any]],
+        min_rounds: int,
+        max_rounds: int,
+        eta: int = 3,
+    ) -> List[Dict[str, Any]]:
+        """Trains all candidates on a small budget, keeps the best 1/eta, repeats
+        with eta times the budget until `max_rounds`."""
+        results = []
+        rounds = min_rounds
+        while candidates:
+            rung = self.run(candidates, num_boost_round=min(rounds, max_rounds))
+            results.extend(rung)
+            if rounds >= max_rounds or len(candidates) == 1:
+                break
+            keep = max(len(candidates) // eta, 1)
+            candidates = [r["params"] for r in _rank(rung)[:keep]]
+            rounds *= eta
+        return results
+
+    def hyperband(
+        self,
+        space: Dict[str, Any],
+        min_rounds: int,
+        max_rounds: int,
+        eta: int = 3,
+        seed: int = 42,
+    ) -> List[Dict[str, Any]]:
+        """Runs successive halving brackets trading off #candidates vs budget."""
+        s_max = int(math.log(max_rounds / min_rounds, eta) + 1e-9)
+        results = []
+        for s in reversed(range(s_max + 1)):
+            num_candidates = int(math.ceil((s_max + 1) / (s + 1) * eta**s))
+            bracket_min_rounds = max(int(max_rounds / eta**s), 1)
+            candidates = random_candidates(space, num_candidates, seed=seed + s)
+            print(
+                f"[hpo] Hyperband bracket s={s}: {num_candidates} candidates "
+                f"from {bracket_min_rounds} rounds"
+            )
+            results.extend(
+                self.successive_halving(
+                    candidates, bracket_min_rounds, max_rounds, eta=eta
+                )
+            )
+        return results
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
+        self._data_dir.cleanup()
+
+
+def _to_gcsfuse(path: str) -> str:
+    return path.replace("gs://", "/gcs/") if path.startswith("gs://") else path
+
+
+def write_leaderboard(
+    model_dir: str, results: List[Dict[str, Any]], file_name: str = LEADERBOARD_FILE
+) -> str:
+    model_dir = _to_gcsfuse(model_dir)
+    os.makedirs(model_dir, exist_ok=True)
+    path = os.path.join(model_dir, file_name)
+    with open(path, "w") as f:
+        json.dump({"trials": _rank(results)}, f, indent=2)
+    print(f"Leaderboard with {len(results)} trials saved to {path}")
+    return path
+
+
+def merge_partial_leaderboards(
+    model_dir: str, world_size: int, timeout: float = 3600, poll_interval: float = 10
+) -> List[Dict[str, Any]]:
+    """Waits for every replica's partial leaderboard and merges them (rank 0)."""
+    model_dir = _to_gcsfuse(model_dir)
+    paths = [
+        os.path.join(model_dir, f"leaderboard-rank{rank}.json")
+        for rank in range(world_size)
+    ]
+    deadline = time.time() + timeout
+    while not all(os.path.exists(p) for p in paths):
+        if time.time() > deadline:
+            missing = [p for p in paths if not os.path.exists(p)]
+            raise TimeoutError(f"Partial leaderboards not written: {missing}")
+        time.sleep(poll_interval)
+
+    results = []
+    for path in paths:
+        with open(path) as f:
+            results.extend(json.load(f)["trials"])
+    return results
+
+
+def run_search(
+    strategy: str,
+    X_train: pd.DataFrame,
+    y_train: pd.Series,
+    X_valid: pd.DataFrame,
+    y_valid: pd.Series,
+    base_params: Dict[str, Any],
+    model_dir: str,
+    search_space: Optional[Dict[str, Any]] = None,
+    num_trials: int = 20,
+    max_rounds: int = 100,
+    min_rounds: int = 10,
+    eta: int = 3,
+    num_workers: int = 0,
+) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Runs the search and writes `leaderboard.json` to `model_dir`.
+
+    Args:
+        strategy (str): "grid", "random", "halving" or "hyperband".
+        base_params (Dict[str, Any]): Fixed XGBoost params (objective, num_class...).
+
+    Returns:
+        Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]: The best trial
+        (None on replicas other than rank 0) and all trial results.
+    """
+    space = search_space or DEFAULT_SEARCH_SPACE
+    info = cluster.get_cluster_info()
+
+    if strategy == "grid":
+        candidates = grid_candidates(space)
+    elif strategy in ("random", "halving"):
+        candidates = random_candidates(space, num_trials)
+    elif strategy == "hyperband":
+        candidates = None
+    else:
+        raise ValueError(f"Unknown search strategy: {strategy}")
+
+    if candidates is not None and info.world_size > 1:
+        candidates = candidates[info.rank :: info.world_size]
+    print(
+        f"[hpo] {strategy} search on replica {info.rank}/{info.world_size}: "
+        f"{len(candidates) if candidates is not None else 'hyperband'} candidates"
+    )
+
+    runner = SearchRunner(
+        X_train, y_train, X_valid, y_valid, base_params, num_workers=num_workers
+    )
+    try:
+        if strategy in ("grid", "random"):
+            results = runner.run(candidates, num_boost_round=max_rounds)
+        elif strategy == "halving":
+            results = runner.successive_halving(candidates, min_rounds, max_rounds, eta)
+        else:
+            results = runner.hyperband(
+                space, min_rounds, max_rounds, eta, seed=42 + info.rank
+            )
+    finally:
+        runner.close()
+
+    if info.world_size > 1:
+        write_leaderboard(model_dir, results, f"leaderboard-rank{info.rank}.json")
+        if info.rank != 0:
+            return None, results
+        results = merge_partial_leaderboards(model_dir, info.world_size)
+
+    write_leaderboard(model_dir, results)
+    best = _rank(results)[0]
+    print(f"[hpo] Best trial: {json.dumps(best)}")
+    return best, results
@@ -0,0 +1,260 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Incremental (append-only) retraining on top of the checkpoint.
+
+Next to `model.bst`, the checkpoint directory holds a `watermark.json` that
+records, per data source, how many rows (or up to which value of a watermark
+column) have already been ingested. An incremental run only loads the rows past
+the watermark and keeps boosting the checkpointed model on them. A configurable
+policy decides when to rebuild the model from the full history instead.
+"""
+import datetime
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+import xgboost as xgb
+
+import data_sources
+
+WATERMARK_FILE = "watermark.json"
+
+
+def _to_gcsfuse(path: str) -> str:
+    return path.replace("gs://", "/gcs/") if path.startswith("gs://") else path
+
+
+def load_watermark(checkpoint_dir: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Loads the watermark stored next to the checkpoint, if any."""
+    if not checkpoint_dir:
+        return None
+    path = os.path.join(_to_gcsfuse(checkpoint_dir), WATERMARK_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        watermark = json.load(f)
+    print(f"Watermark loaded from {path}: {json.dumps(watermark)}")
+    return watermark
+
+
+def save_watermark(checkpoint_dir: Optional[str], watermark: Dict[str, Any]) -> None:
+    if not checkpoint_dir:
+        return
+    checkpoint_dir = _to_gcsfuse(checkpoint_dir)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    path = os.path.join(checkpoint_dir, WATERMARK_FILE)
+    watermark["updated_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    with open(path, "w") as f:
+        json.dump(watermark, f, indent=2)
+    print(f"Watermark saved to {path}")
+
+
+def new_watermark() -> Dict[str, Any]:
+    return {
+        "sources": {},
+        "runs_since_rebuild": 0,
+        "rows_at_rebuild": 0,
+        "rows_since_rebuild": 0,
+        "last_accuracy": None,
+    }
+
+
+def _sql_literal(value: Any) -> str:
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'{}'".format(str(value).replace("'", "\\'"))
+
+
+def _json_value(value: Any) -> Any:
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+
+def load_delta(
+    data_path: str,
+    watermark: Dict[str, Any],
+    watermark_column: Optional[str] = None,
+    load_data=None,
+    row_filter: Optional[str] = None,
+) -> Tuple[pd.DataFrame, Dict[str, Any]]:
+    """Loads only the rows of `data_path` that are past the watermark.
+
+    With a `watermark_column` (e.g. an ingestion timestamp), rows with a greater
+    value are new; on BigQuery the filter is pushed down into the query, so only
+    the new rows are read. Otherwise the source is treated as append-only and
+    the rows after the previously ingested row count are new. BigQuery reads
+    have no stable row order, so a BigQuery source needs a `watermark_column`
+    once some of its rows have been ingested. `row_filter` is a SQL condition
+    (e.g. a partition window) and is only supported for BigQuery.
+
+    Raises:
+        ValueError: A row count watermark on an already ingested BigQuery source.
+
+    Returns:
+        Tuple[pd.DataFrame, Dict[str, Any]]: The new rows and the updated
+        watermark entry for this source.
+    """
+    source_state = watermark["sources"].get(data_path, {"rows": 0, "max_value": None})
+    last_value = source_state.get("max_value")
+    if (
+        not watermark_column
+        and data_sources.is_bq_uri(data_path)
+        and source_state.get("rows", 0)
+    ):
+        raise ValueError(
+            f"Cannot load the new rows of {data_path} by row count, BigQuery reads "
+            "are not ordered; set --watermark_column (e.g. ingested_at)"
+        )
+
+    if watermark_column and data_sources.is_bq_uri(data_path):
+        conditions = [row_filter]
+        if last_value is not None:
+            conditions.append(f"`{watermark_column}` > {_sql_literal(last_value)}")
+        df = data_sources.load_frame(
+            data_path,
+            row_filter=" AND ".join(f"({c})" for c in conditions if c) or None,
+        )
+        total_rows = source_state.get("rows", 0) + len(df)
+    else:
+        if load_data:
+            df = load_data(data_path, row_filter=row_filter)
+        elif row_filter:
+            raise ValueError("row_filter is only supported for bq:// sources")
+        else:
+            df = pd.read_csv(data_path)
+        total_rows = len(df)
+        if watermark_column and last_value is not None:
+            threshold = last_value
+            if pd.api.types.is_datetime64_any_dtype(df[watermark_column]):
+                threshold = pd.Timestamp(last_value)
+            df = df[df[watermark_column] > threshold]
+        elif not watermark_column:
+            df = df.iloc[source_state.get("rows", 0) :]
+
+    new_state = {"rows": total_rows, "max_value": last_value}
+    if watermark_column and not df.empty:
+        new_state["max_value"] = _json_value(df[watermark_column].max())
+
+    print(f"Incremental delta for {data_path}: {len(df)} new rows")
+    return df, new_state
+
+
+def plan_run(
+    watermark: Optional[Dict[str, Any]],
+    has_checkpoint: bool,
+    delta_rows: int,
+    boosted_rounds: int,
+    n_estimators: int,
+    full_rebuild_every: int = 0,
+    max_delta_fraction: float = 0.0,
+    max_total_rounds: int = 0,
+    unseen_labels: bool = False,
+) -> Tuple[str, str]:
+    """Decides between an incremental run and a full rebuild.
+
+    Args:
+        full_rebuild_every (int): Rebuild after this many incremental runs (0: never).
+        max_delta_fraction (float): Rebuild once the rows appended since the last
+            rebuild exceed this fraction of the rows it was built on (0: never).
+        max_total_rounds (int): Rebuild when continuing would grow the model
+            beyond this many boosting rounds (0: never).
+        unseen_labels (bool): The delta has labels the checkpoint cannot predict,
+            which can only be learned by a rebuild.
+
+    Returns:
+        Tuple[str, str]: "incremental" or "full", and the reason.
+    """
+    if not has_checkpoint:
+        return "full", "no checkpoint"
+    if watermark is None:
+        return "full", "checkpoint has no watermark"
+    if unseen_labels:
+        return "full", "new rows contain labels unseen by the checkpoint"
+    if full_rebuild_every and watermark["runs_since_rebuild"] >= full_rebuild_every:
+        return "full", f"{full_rebuild_every} incremental runs since last rebuild"
+    if max_total_rounds and boosted_rounds + n_estimators > max_total_rounds:
+        return "full", f"model would exceed {max_total_rounds} boosting rounds"
+    if max_delta_fraction and watermark["rows_at_rebuild"]:
+        fraction = (watermark["rows_since_rebuild"] + delta_rows) / watermark[
+            "rows_at_rebuild"
+        ]
+        if fraction > max_delta_fraction:
+            return "full", f"appended rows are {fraction:.0%} of the rebuilt dataset"
+    return "incremental", f"{delta_rows} new rows"
+
+
+def continue_training(
+    model: xgb.XGBClassifier,
+    X: pd.DataFrame,
+    y: pd.Series,
+    num_boost_round: int,
+    params: Optional[Dict[str, Any]] = None,
+    callbacks: Optional[List[xgb.callback.TrainingCallback]] = None,
+) -> xgb.XGBClassifier:
+    """Keeps boosting the checkpointed model on the new rows only.
+
+    Uses the native API so that a delta missing some classes still trains against
+    the checkpoint's `num_class`. `params` override the checkpoint's training
+    parameters (e.g. nthread); the rest are kept from the checkpoint.
+    """
+    booster = xgb.train(
+        params or {},
+        xgb.DMatrix(X, label=y),
+        num_boost_round=num_boost_round,
+        xgb_model=model.get_booster(),
+        callbacks=callbacks,
+        verbose_eval=False,
+    )
+    # The checkpoint's early stopping attributes are copied along; left set,
+    # predict would only use the rounds up to the old best iteration
+    early_stopping_attrs = ("best_iteration", "best_score", "best_ntree_limit")
+    booster.set_attr(**dict.fromkeys(early_stopping_attrs))
+    # Loaded in place: the classifier keeps its parameters and n_classes_.
+    # load_model only sets the Python attributes, never clears them
+    model.get_booster().load_model(booster.save_raw("ubj"))
+    for attr in early_stopping_attrs:
+        model.get_booster().__dict__.pop(attr, None)
+    print(
+        f"XGBoost model trained incrementally on {len(X)} rows, "
+        f"now {booster.num_boosted_rounds()} rounds."
+    )
+    return model
+
+
+def test_continue_training():
+    """A continued early-stopped checkpoint predicts with all its rounds."""
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(rng.normal(size=(600, 4)), columns=list("abcd"))
+    y = pd.Series(np.argmax(X.to_numpy() @ rng.normal(size=(4, 3)), axis=1))
+    model = xgb.XGBClassifier(n_estimators=200, early_stopping_rounds=2)
+    model.fit(X[:400], y[:400], eval_set=[(X[400:500], y[400:500])], verbose=False)
+    assert model.get_booster().attr("best_iteration") is not None
+
+    model = continue_training(model, X[500:], y[500:], num_boost_round=10)
+    booster = model.get_booster()
+    assert booster.attributes() == {}
+    margin = booster.inplace_predict(X.to_numpy(), predict_type="margin")
+    all_rounds = np.argmax(margin, axis=1)
+    assert (model.predict(X) == all_rounds).all()
+    print(f"OK: {booster.num_boosted_rounds()} rounds, all used by predict")
+
+
+if __name__ == "__main__":
+    test_continue_training()
@@ -0,0 +1,236 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Streaming classification metrics.
+
+`EvaluationMetrics` is updated with one batch of raw margins at a time and only
+keeps sufficient statistics (confusion matrices, log-loss sum, calibration
+bins, batch latencies), so any number of rows can be evaluated in constant
+memory. Partial states computed on different workers or files are combined
+with `merge`.
+
+`to_dict` returns the report written to metrics.json: scalar metrics at the top
+level (these are what the pipeline logs and can gate on) plus the confusion
+matrix, calibration bins and per-slice metrics.
+"""
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+import numpy as np
+
+DEFAULT_CALIBRATION_BINS = 10
+_EPS = 1e-15
+
+
+def margin_to_proba(margin: np.ndarray) -> np.ndarray:
+    """Class probabilities from raw margins (softmax, or sigmoid for binary)."""
+    margin = np.asarray(margin, dtype=np.float64)
+    if margin.ndim == 1:
+        positive = 1.0 / (1.0 + np.exp(-margin))
+        return np.column_stack([1.0 - positive, positive])
+    shifted = margin - margin.max(axis=1, keepdims=True)
+    exp = np.exp(shifted)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def _confusion(y_true: np.ndarray, y_pred: np.ndarray, num_classes: int) -> np.ndarray:
+    index = y_true * num_classes + y_pred
+    return np.bincount(index, minlength=num_classes * num_classes).reshape(
+        num_classes, num_classes
+    )
+
+
+def _precision_recall_f1(confusion: np.ndarray):
+    true_positives = np.diag(confusion).astype(np.float64)
+    predicted = confusion.sum(axis=0)
+    actual = confusion.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(predicted > 0, true_positives / predicted, 0.0)
+        recall = np.where(actual > 0, true_positives / actual, 0.0)
+        f1 = np.where(
+            precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0
+        )
+    return precision, recall, f1, actual
+
+
+def _macro(values: np.ndarray, confusion: np.ndarray) -> float:
+    """Mean over the classes that occur as label or prediction (as sklearn does)."""
+    present = (confusion.sum(axis=0) + confusion.sum(axis=1)) > 0
+    return float(values[present].mean()) if present.any() else 0.0
+
+
+class EvaluationMetrics:
+    """Mergeable state of the evaluation metrics of a multi-class classifier."""
+
+    def __init__(
+        self, num_classes: int, calibration_bins: int = DEFAULT_CALIBRATION_BINS
+    ):
+        self.num_classes = max(num_classes, 2)
+        self.calibration_bins = calibration_bins
+        self.confusion = np.zeros((self.num_classes, self.num_classes), np.int64)
+        self.log_loss_sum = 0.0
+        # Per confidence bin: rows, sum of confidences, correct predictions
+        self.bin_count = np.zeros(calibration_bins, np.int64)
+        self.bin_confidence = np.zeros(calibration_bins, np.float64)
+        self.bin_correct = np.zeros(calibration_bins, np.int64)
+        self.slices: Dict[str, np.ndarray] = {}
+        self.batch_seconds = []
+        self.batch_rows = []
+
+    def update(
+        self,
+        y_true: np.ndarray,
+        margin: np.ndarray,
+        slice_values: Optional[np.ndarray] = None,
+    ) -> None:
+        """Adds a batch of labels and raw margins (as returned by
+        `Booster.inplace_predict(..., predict_type="margin")`)."""
+        y_true = np.asarray(y_true).astype(np.int64)
+        proba = margin_to_proba(margin)
+        y_pred = np.argmax(proba, axis=1)
+
+        self.confusion += _confusion(y_true, y_pred, self.num_classes)
+
+        true_proba = proba[np.arange(len(y_true)), y_true]
+        self.log_loss_sum += float(-np.log(np.clip(true_proba, _EPS, 1.0)).sum())
+
+        confidence = proba[np.arange(len(y_pred)), y_pred]
+        bins = np.minimum(
+            (confidence * self.calibration_bins).astype(np.int64),
+            self.calibration_bins - 1,
+        )
+        self.bin_count += np.bincount(bins, minlength=self.calibration_bins)
+        self.bin_confidence += np.bincount(
+            bins, weights=confidence, minlength=self.calibration_bins
+        )
+        self.bin_correct += np.bincount(
+            bins, weights=y_pred == y_true, minlength=self.calibration_bins
+        ).astype(np.int64)
+
+        if slice_values is not None:
+            slice_values = np.asarray(slice_values)
+            for value in np.unique(slice_values):
+                mask = slice_values == value
+                key = str(value)
+                if key not in self.slices:
+                    self.slices[key] = np.zeros_like(self.confusion)
+                self.slices[key] += _confusion(
+                    y_true[mask], y_pred[mask], self.num_classes
+                )
+
+    @contextmanager
+    def time_batch(self, rows: int) -> Iterator[None]:
+        """Records the prediction latency of a batch of `rows` rows."""
+        start = time.perf_counter()
+        yield
+        self.batch_seconds.append(time.perf_counter() - start)
+        self.batch_rows.append(rows)
+
+    def merge(self, other: "EvaluationMetrics") -> "EvaluationMetrics":
+        """Adds the state of `other` (e.g. another shard) to this one."""
+        if other.num_classes != self.num_classes:
+            raise ValueError(
+                f"Cannot merge metrics of {other.num_classes} and "
+                f"{self.num_classes} classes"
+            )
+        self.confusion += other.confusion
+        self.log_loss_sum += other.log_loss_sum
+        self.bin_count += other.bin_count
+        self.bin_confidence += other.bin_confidence
+        self.bin_correct += other.bin_correct
+        for key, confusion in other.slices.items():
+            if key in self.slices:
+                self.slices[key] += confusion
+            else:
+                self.slices[key] = confusion.copy()
+        self.batch_seconds.extend(other.batch_seconds)
+        self.batch_rows.extend(other.batch_rows)
+        return self
+
+    @property
+    def count(self) -> int:
+        return int(self.confusion.sum())
+
+    @property
+    def accuracy(self) -> float:
+        return float(np.trace(self.confusion) / max(self.count, 1))
+
+    def to_dict(self) -> Dict[str, Any]:
+        count = max(self.count, 1)
+        precision, recall, f1, support = _precision_recall_f1(self.confusion)
+        weights = support / count
+
+        report: Dict[str, Any] = {
+            "accuracy": self.accuracy,
+            "log_loss": self.log_loss_sum / count,
+            "macro_precision": _macro(precision, self.confusion),
+            "macro_recall": _macro(recall, self.confusion),
+            "macro_f1": _macro(f1, self.confusion),
+            "weighted_f1": float((f1 * weights).sum()),
+            "eval_rows": self.count,
+        }
+        for k in range(self.num_classes):
+            report[f"precision_class_{k}"] = float(precision[k])
+            report[f"recall_class_{k}"] = float(recall[k])
+            report[f"f1_class_{k}"] = float(f1[k])
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            bin_accuracy = np.where(
+                self.bin_count > 0, self.bin_correct / self.bin_count, 0.0
+            )
+            bin_confidence = np.where(
+                self.bin_count > 0, self.bin_confidence / self.bin_count, 0.0
+            )
+        report["expected_calibration_error"] = float(
+            (np.abs(bin_accuracy - bin_confidence) * self.bin_count).sum() / count
+        )
+
+        if self.batch_seconds:
+            latency_ms = np.array(self.batch_seconds) * 1000
+            report["batch_latency_p50_ms"] = float(np.percentile(latency_ms, 50))
+            report["batch_latency_p99_ms"] = float(np.percentile(latency_ms, 99))
+            report["predict_rows_per_s"] = float(
+                sum(self.batch_rows) / max(sum(self.batch_seconds), _EPS)
+            )
+
+        report["confusion_matrix"] = self.confusion.tolist()
+        report["calibration"] = [
+            {
+                "bin": f"{i / self.calibration_bins:.2f}-"
+                f"{(i + 1) / self.calibration_bins:.2f}",
+                "count": int(self.bin_count[i]),
+                "confidence": float(bin_confidence[i]),
+                "accuracy": float(bin_accuracy[i]),
+            }
+            for i in range(self.calibration_bins)
+        ]
+        if self.slices:
+            report["slices"] = {}
+            for key, confusion in sorted(self.slices.items()):
+                _, _, slice_f1, _ = _precision_recall_f1(confusion)
+                report["slices"][key] = {
+                    "count": int(confusion.sum()),
+                    "accuracy": float(np.trace(confusion) / max(confusion.sum(), 1)),
+                    "macro_f1": _macro(slice_f1, confusion),
+                }
+        return report
+
+
+def scalar_metrics(report: Dict[str, Any]) -> Dict[str, float]:
+    """The top-level numeric entries of a report, e.g. for logging."""
+    return {
+        k: v
+        for k, v in report.items()
+        if isinstance(v, (int, float)) and not isinstance(v, bool)
+    }
@@ -0,0 +1,143 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Asynchronous, batched TensorBoard scalar writer.
+
+`add_scalar` only appends to an in-memory queue. A background thread drains it
+and writes the scalars to the `SummaryWriter` in batches, every
+`flush_interval_s` seconds or as soon as `max_queue` scalars are pending, so the
+event file (possibly on GCSFuse) is never written from the boosting loop.
+"""
+import atexit
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from tensorboardX import SummaryWriter
+
+DEFAULT_FLUSH_INTERVAL_S = 5.0
+DEFAULT_MAX_QUEUE = 1000
+
+# Sentinel that tells the writer thread to stop once the queue is drained
+_CLOSE = object()
+
+# One writer per log directory, shared by the callbacks of a training run
+_WRITERS: Dict[str, "AsyncScalarWriter"] = {}
+_SETTINGS = {
+    "flush_interval_s": DEFAULT_FLUSH_INTERVAL_S,
+    "max_queue": DEFAULT_MAX_QUEUE,
+}
+
+
+class AsyncScalarWriter:
+    """Queues scalars in memory and writes them from a background thread."""
+
+    def __init__(
+        self,
+        log_dir: str,
+        flush_interval_s: float = DEFAULT_FLUSH_INTERVAL_S,
+        max_queue: int = DEFAULT_MAX_QUEUE,
+    ):
+        self.log_dir = log_dir
+        self.flush_interval_s = flush_interval_s
+        self.max_queue = max_queue
+        self._queue: "queue.Queue" = queue.Queue()
+        self._flush_requested = threading.Event()
+        self._closed = False
+        self._writer = SummaryWriter(log_dir=log_dir)
+        self._thread = threading.Thread(
+            target=self._run, name=f"AsyncScalarWriter({log_dir})", daemon=True
+        )
+        self._thread.start()
+
+    def add_scalar(self, tag: str, value: float, step: Optional[int] = None) -> None:
+        if self._closed:
+            raise RuntimeError(f"AsyncScalarWriter for {self.log_dir} is closed")
+        self._queue.put((tag, float(value), step, time.time()))
+        if self._queue.qsize() >= self.max_queue:
+            self._flush_requested.set()
+
+    def flush(self) -> None:
+        """Asks the writer thread to write everything queued so far."""
+        self._flush_requested.set()
+
+    def close(self) -> None:
+        """Writes the remaining scalars and closes the event file."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_CLOSE)
+        self._flush_requested.set()
+        self._thread.join()
+        self._writer.close()
+
+    def __enter__(self) -> "AsyncScalarWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _drain(self) -> Tuple[List[tuple], bool]:
+        batch, closing = [], False
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return batch, closing
+            if item is _CLOSE:
+                closing = True
+            else:
+                batch.append(item)
+
+    def _run(self) -> None:
+        while True:
+            self._flush_requested.wait(self.flush_interval_s)
+            self._flush_requested.clear()
+            batch, closing = self._drain()
+            for tag, value, step, walltime in batch:
+                self._writer.add_scalar(tag, value, step, walltime=walltime)
+            if batch:
+                self._writer.flush()
+            if closing:
+                return
+
+
+def configure(
+    flush_interval_s: Optional[float] = None, max_queue: Optional[int] = None
+) -> None:
+    """Sets the flush interval and queue size of the writers created afterwards."""
+    if flush_interval_s is not None:
+        _SETTINGS["flush_interval_s"] = flush_interval_s
+    if max_queue is not None:
+        _SETTINGS["max_queue"] = max_queue
+
+
+def get_writer(log_dir: str) -> AsyncScalarWriter:
+    """Returns the open writer for `log_dir`, creating it if needed."""
+    writer = _WRITERS.get(log_dir)
+    if writer is None or writer._closed:
+        writer = AsyncScalarWriter(log_dir, **_SETTINGS)
+        _WRITERS[log_dir] = writer
+    return writer
+
+
+def close_all() -> None:
+    """Flushes and closes every writer returned by `get_writer`."""
+    while _WRITERS:
+        _, writer = _WRITERS.popitem()
+        writer.close()
+
+
+# Don't lose queued scalars if the trainer exits without calling close_all
+atexit.register(close_all)
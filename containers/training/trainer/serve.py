@@ -0,0 +1,320 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Prediction server for `model.bst` with dynamic micro-batching.
+
+Implements the Vertex AI custom container contract: `POST {"instances": [...]}`
+on `AIP_PREDICT_ROUTE` answers `{"predictions": [...]}`, `GET AIP_HEALTH_ROUTE`
+answers 200 once the model is loaded, the port is `AIP_HTTP_PORT` and the model
+is read from `AIP_STORAGE_URI`. The predictions are those of the stock XGBoost
+prediction container (`Booster.predict`), so the training image can be used as
+`prediction_container_image_uri`.
+
+The model is loaded once. Request threads only parse JSON; a single batching
+thread concatenates the instances of concurrent requests into one NumPy batch
+(up to `max_batch_size` rows, waiting at most `max_latency_ms` for more once the
+first request arrived) and answers it with one `Booster.inplace_predict` call,
+or with the NumPy predictor of `model_compiled.npz` (`--engine compiled`).
+
+    python serve.py --model_dir gs://bucket/model --port 8080
+"""
+import argparse
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+
+import numpy as np
+import xgboost as xgb
+
+import compiled_model
+import resources
+
+DEFAULT_MAX_BATCH_SIZE = 1024
+DEFAULT_MAX_LATENCY_MS = 2.0
+
+
+def local_model_path(model_dir: str, filename: str = "model.bst") -> str:
+    """Local path of `filename` in a local directory or a gs:// prefix.
+
+    Prediction containers have no GCSFuse mount, so a gs:// file is downloaded
+    unless /gcs/ is mounted.
+    """
+    if model_dir.startswith("gs://"):
+        gcsfuse_dir = model_dir.replace("gs://", "/gcs/")
+        if os.path.exists(os.path.join(gcsfuse_dir, filename)):
+            return os.path.join(gcsfuse_dir, filename)
+        from google.cloud import storage
+
+        bucket_name, _, prefix = model_dir[len("gs://") :].partition("/")
+        blob_name = f"{prefix.rstrip('/')}/{filename}" if prefix else filename
+        local_path = os.path.join(tempfile.mkdtemp(), filename)
+        storage.Client().bucket(bucket_name).blob(blob_name).download_to_filename(
+            local_path
+        )
+        return local_path
+    return os.path.join(model_dir, filename)
+
+
+def load_booster(model_dir: str) -> xgb.Booster:
+    """Loads model.bst from a local directory or a gs:// prefix."""
+    model_path = local_model_path(model_dir)
+    print(f"Loading model from {model_path}")
+    booster = xgb.Booster()
+    booster.load_model(model_path)
+    return booster
+
+
+def load_compiled(model_dir: str) -> compiled_model.CompiledModel:
+    """Loads model_compiled.npz, written by `train.py --export_compiled`."""
+    model_path = local_model_path(model_dir, compiled_model.COMPILED_MODEL_FILENAME)
+    print(f"Loading compiled model from {model_path}")
+    return compiled_model.CompiledModel.load(model_path)
+
+
+class _Pending:
+    __slots__ = ("instances", "done", "result", "error")
+
+    def __init__(self, instances: np.ndarray):
+        self.instances = instances
+        self.done = threading.Event()
+        self.result: Optional[np.ndarray] = None
+        self.error: Optional[BaseException] = None
+
+
+class MicroBatcher:
+    """Answers concurrent `predict` calls with shared prediction calls."""
+
+    def __init__(
+        self,
+        model,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_latency_ms: float = DEFAULT_MAX_LATENCY_MS,
+    ):
+        """
+        Args:
+            model: An `xgb.Booster` (predicted with `inplace_predict`) or a
+                `compiled_model.CompiledModel`.
+            max_batch_size (int): Rows per prediction call; a larger request is
+                predicted on its own.
+            max_latency_ms (float): How long the first request of a batch may
+                wait for more requests. 0 only batches requests already queued.
+        """
+        self.model = model
+        self.num_features = model.num_features()
+        self._predict_batch = (
+            model.inplace_predict if isinstance(model, xgb.Booster) else model.predict
+        )
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.batches = 0
+        self.rows = 0
+        self._queue: "queue.Queue[_Pending]" = queue.Queue()
+        self._carry: Optional[_Pending] = None
+        self._thread = threading.Thread(target=self._run, name="batcher", daemon=True)
+        self._thread.start()
+
+    def predict(self, instances: np.ndarray) -> np.ndarray:
+        """Blocks until the batch holding `instances` is predicted."""
+        if instances.ndim != 2 or instances.shape[1] != self.num_features:
+            raise ValueError(
+                f"Expected instances of {self.num_features} features, got shape "
+                f"{instances.shape}"
+            )
+        pending = _Pending(instances)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _collect(self) -> List[_Pending]:
+        first = self._carry or self._queue.get()
+        self._carry = None
+        batch, rows = [first], len(first.instances)
+        deadline = time.perf_counter() + self.max_latency
+        while rows < self.max_batch_size:
+            try:
+                remaining = deadline - time.perf_counter()
+                pending = (
+                    self._queue.get(timeout=remaining)
+                    if remaining > 0
+                    else self._queue.get_nowait()
+                )
+            except queue.Empty:
+                break
+            if rows + len(pending.instances) > self.max_batch_size:
+                # Starts the next batch
+                self._carry = pending
+                break
+            batch.append(pending)
+            rows += len(pending.instances)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            try:
+                X = (
+                    batch[0].instances
+                    if len(batch) == 1
+                    else np.concatenate([p.instances for p in batch])
+                )
+                predictions = self._predict_batch(X)
+                offset = 0
+                for pending in batch:
+                    pending.result = predictions[offset : offset + len(pending.instances)]
+                    offset += len(pending.instances)
+            except Exception as e:
+                for pending in batch:
+                    pending.error = e
+            self.batches += 1
+            self.rows += sum(len(p.instances) for p in batch)
+            for pending in batch:
+                pending.done.set()
+
+
+def parse_instances(body: bytes) -> np.ndarray:
+    """The `instances` of a prediction request as a float32 matrix."""
+    request = json.loads(body)
+    instances = request["instances"]
+    return np.asarray(instances, dtype=np.float32).reshape(len(instances), -1)
+
+
+def make_handler(batcher, predict_route: str, health_route: str) -> type:
+    """Request handler answering with `batcher.predict(instances)`."""
+    class PredictionHandler(BaseHTTPRequestHandler):
+        # Keep-alive, clients reuse their connection
+        protocol_version = "HTTP/1.1"
+
+        def _send_json(self, status: int, payload: dict) -> None:
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == health_route:
+                self._send_json(200, {})
+            else:
+                self._send_json(404, {"error": f"Not found: {self.path}"})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path != predict_route:
+                self._send_json(404, {"error": f"Not found: {self.path}"})
+                return
+            try:
+                instances = parse_instances(body)
+                predictions = batcher.predict(instances)
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json(400, {"error": f"Invalid request: {e}"})
+                return
+            self._send_json(200, {"predictions": predictions.tolist()})
+
+        def log_message(self, format, *args):
+            # One line per request would dominate the latency
+            pass
+
+    return PredictionHandler
+
+
+class PredictionServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Concurrent clients connecting at once must not be refused
+    request_queue_size = 128
+
+
+def make_server(
+    model,
+    port: int,
+    host: str = "0.0.0.0",
+    max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+    max_latency_ms: float = DEFAULT_MAX_LATENCY_MS,
+    predict_route: str = "/predict",
+    health_route: str = "/health",
+) -> Tuple[ThreadingHTTPServer, MicroBatcher]:
+    batcher = MicroBatcher(model, max_batch_size, max_latency_ms)
+    handler = make_handler(batcher, predict_route, health_route)
+    return PredictionServer((host, port), handler), batcher
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve model.bst over HTTP.")
+    parser.add_argument(
+        "--model_dir",
+        type=str,
+        default=os.environ.get("AIP_STORAGE_URI"),
+        help="Directory (or gs:// prefix) of model.bst. Default: AIP_STORAGE_URI.",
+    )
+    parser.add_argument(
+        "--port", type=int, default=int(os.environ.get("AIP_HTTP_PORT", 8080))
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["booster", "compiled"],
+        default=os.environ.get("SERVING_ENGINE", "booster"),
+        help="booster: model.bst with XGBoost. compiled: model_compiled.npz with "
+        "the NumPy predictor of compiled_model.py.",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=DEFAULT_MAX_BATCH_SIZE,
+        help="Rows per inplace_predict call.",
+    )
+    parser.add_argument(
+        "--max_latency_ms",
+        type=float,
+        default=DEFAULT_MAX_LATENCY_MS,
+        help="How long a request may wait for others to share its batch.",
+    )
+    parser.add_argument(
+        "--nthread",
+        type=int,
+        default=None,
+        help="Prediction threads (default: the CPUs of the container).",
+    )
+    args = parser.parse_args()
+    if not args.model_dir:
+        parser.error("--model_dir or AIP_STORAGE_URI is required")
+
+    if args.engine == "compiled":
+        model = load_compiled(args.model_dir)
+    else:
+        model = load_booster(args.model_dir)
+        model.set_param({"nthread": args.nthread or resources.available_cpus()})
+    server, _ = make_server(
+        model,
+        args.port,
+        max_batch_size=args.max_batch_size,
+        max_latency_ms=args.max_latency_ms,
+        predict_route=os.environ.get("AIP_PREDICT_ROUTE", "/predict"),
+        health_route=os.environ.get("AIP_HEALTH_ROUTE", "/health"),
+    )
+    print(
+        f"Serving on port {args.port} (max_batch_size={args.max_batch_size}, "
+        f"max_latency_ms={args.max_latency_ms})"
+    )
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -18,21 +18,37 @@ import numpy as np
 import xgboost as xgb
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score
-from typing import Tuple, Dict, Any
+from typing import Tuple, Dict, Any, Optional, Sequence
 import json
+import hashlib
 import datetime
-from tensorboardX import SummaryWriter
 import tempfile
 import os
 from google.cloud import bigquery
+import cluster
+import compiled_model
+import data_sources
+import dataset_cache
+import distributed
+import external_memory
+import holdout
+import hpo
+import incremental
+import metrics
+import metrics_sink
+import resources
+
+# Read by the storage trigger, see functions/storage_trigger/cache_keys.py
+CHECKPOINT_SOURCE = "checkpoint_source.json"
 
 
 # https://github.com/dmlc/xgboost/issues/5727
+# Scalars are queued and written by a background thread (see metrics_sink.py)
 class TensorBoardCallback(xgb.callback.TrainingCallback):
     def __init__(self, experiment: str = "xgboost_experiment"):  # Default name
         self.experiment = experiment
         self.log_dir = f"runs/{self.experiment}"  # Simpler path
-        self.writer = SummaryWriter(log_dir=self.log_dir)  # Single writer
+        self.writer = metrics_sink.get_writer(self.log_dir)  # Single writer
 
     def after_iteration(
         self, model, epoch: int, evals_log: xgb.callback.TrainingCallback.EvalsLog
@@ -64,10 +80,20 @@ def print_environment_variables() -> None:
     print(output)
 
 
-def load_data(data_path: str) -> pd.DataFrame:
-    """Loads data from a CSV file."""
+def load_data(data_path: str, row_filter: Optional[str] = None) -> pd.DataFrame:
+    """Loads data from a CSV file, a Parquet file or a BigQuery table.
+
+    Parquet files and bq:// URIs are read as Arrow record batches, without
+    going through an intermediate CSV. `row_filter` is a SQL condition, only
+    supported for bq:// URIs (e.g. a partition window).
+    """
     try:
-        df = pd.read_csv(data_path)
+        if data_sources.is_columnar_source(data_path):
+            df = data_sources.load_frame(data_path, row_filter=row_filter)
+        elif row_filter:
+            raise ValueError("row_filter is only supported for bq:// sources")
+        else:
+            df = pd.read_csv(data_path)
         print(f"Data loaded from {data_path} successfully. Shape: {df.shape}")
         return df
     except FileNotFoundError:
@@ -78,15 +104,22 @@ def load_data(data_path: str) -> pd.DataFrame:
         exit(1)
 
 
-def preprocess_data(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.Series]:
-    """Preprocesses the data."""
+def preprocess_data(
+    df: pd.DataFrame, drop_columns: Sequence[str] = ()
+) -> Tuple[pd.DataFrame, pd.Series]:
+    """Preprocesses the data.
+
+    Args:
+        df (pd.DataFrame): The raw data.
+        drop_columns (Sequence[str]): Extra non-feature columns to drop, e.g. a
+            watermark column.
+    """
 
     # Sample preprocessing (replace with your actual preprocessing steps)
     df = df.dropna()  # Remove rows with NaN
 
     # Example: For Iris dataset
-    X = df.drop("target", axis=1)  # Features
-    y = df["target"]  # Labels
+    X, y = data_sources.split_features(df, "target", drop_columns)
 
     print("Data preprocessed successfully.")
     return X, y
@@ -101,35 +134,180 @@ def create_model_architecture(
     return model
 
 
+def get_throughput_params(
+    args: argparse.Namespace, sklearn_api: bool = True
+) -> Dict[str, Any]:
+    """Tree method, max_bin and a thread count bounded by the container's CPU quota.
+
+    With `tree_method="hist"`, `XGBClassifier.fit` builds a single
+    `QuantileDMatrix` for the training data (and references it for eval sets)
+    instead of a regular DMatrix.
+    """
+    nthread = args.nthread or resources.available_cpus()
+    params = {"tree_method": args.tree_method, "max_bin": args.max_bin}
+    params["n_jobs" if sklearn_api else "nthread"] = nthread
+    return params
+
+
+def get_row_filter(args: argparse.Namespace) -> Optional[str]:
+    """The partition window of a partitioned bq:// training table, if any."""
+    return data_sources.partition_filter(
+        getattr(args, "partition_window_days", 0),
+        getattr(args, "partition_start", None),
+        getattr(args, "partition_end", None),
+    )
+
+
+def split_test(
+    args: argparse.Namespace, X: pd.DataFrame, y: pd.Series
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.Series, pd.Series]:
+    """Splits off the `--test_fraction` test rows, the saved holdout.
+
+    Rows are assigned by a hash of their content (see
+    `external_memory.in_test_split`), so a table that grows between runs keeps
+    its test rows out of every run's training data: the holdout of a new model
+    holds no row a previous (champion) model was trained on.
+    """
+    mask = external_memory.in_test_split(X, y, getattr(args, "test_fraction", 0.2))
+    return X[~mask], X[mask], y[~mask], y[mask]
+
+
+def split_validation(
+    args: argparse.Namespace, X_train: pd.DataFrame, y_train: pd.Series
+) -> Tuple[pd.DataFrame, pd.Series, Optional[pd.DataFrame], Optional[pd.Series]]:
+    """Returns the training data and the validation set used for early stopping.
+
+    The validation set is read from `--validation_data_path` if given, otherwise
+    `--validation_fraction` of the training rows are held out. Returns None for
+    the validation set if early stopping is disabled.
+    """
+    if not getattr(args, "early_stopping_rounds", 0):
+        return X_train, y_train, None, None
+    if getattr(args, "validation_data_path", None):
+        X_valid, y_valid = preprocess_data(load_data(args.validation_data_path))
+        return X_train, y_train, X_valid, y_valid
+    if not args.validation_fraction:
+        return X_train, y_train, None, None
+    X_train, X_valid, y_train, y_valid = train_test_split(
+        X_train, y_train, test_size=args.validation_fraction, random_state=42
+    )
+    return X_train, y_train, X_valid, y_valid
+
+
 def train_model(
-    model: xgb.XGBClassifier, X_train: pd.DataFrame, y_train: pd.Series
+    model: xgb.XGBClassifier,
+    X_train: pd.DataFrame,
+    y_train: pd.Series,
+    X_valid: Optional[pd.DataFrame] = None,
+    y_valid: Optional[pd.Series] = None,
+    early_stopping_rounds: Optional[int] = None,
 ) -> xgb.XGBClassifier:
-    """Trains the XGBoost model."""
+    """Trains the XGBoost model.
+
+    With a validation set and `early_stopping_rounds`, boosting stops once the
+    validation metric has not improved for that many rounds, and the model is
+    trimmed to its best iteration.
+    """
+    fit_kwargs = {}
+    if X_valid is not None and early_stopping_rounds:
+        model.set_params(early_stopping_rounds=early_stopping_rounds)
+        fit_kwargs["eval_set"] = [(X_valid, y_valid)]
+        fit_kwargs["verbose"] = False
     model.fit(
         X_train,
         y_train,
-        # eval_metric="mlogloss",  # Specify the metric for monitoring
         callbacks=[TensorBoardCallback(experiment="exp_1")],  # Use simplified callback
+        **fit_kwargs,
     )
 
+    if fit_kwargs:
+        # Loaded in place: the classifier keeps its parameters and n_classes_
+        trimmed = trim_to_best_iteration(model.get_booster())
+        model.get_booster().load_model(trimmed.save_raw("ubj"))
+
     print("XGBoost model trained successfully.")
     return model
 
 
+def trim_to_best_iteration(booster: xgb.Booster) -> xgb.Booster:
+    """Drops the rounds boosted after the best one, model.bst keeps only these."""
+    best_iteration = int(booster.attr("best_iteration"))
+    best_score = booster.attr("best_score")
+    print(f"Best iteration: {best_iteration} (score {best_score})")
+    if best_iteration + 1 >= booster.num_boosted_rounds():
+        return booster
+    # Slicing does not copy the booster attributes, so set them again
+    trimmed = booster[: best_iteration + 1]
+    trimmed.set_attr(best_iteration=str(best_iteration), best_score=best_score)
+    return trimmed
+
+
+def get_training_summary(model: xgb.XGBClassifier, n_estimators: int) -> Dict[str, Any]:
+    """Boosting rounds of the trained model (or Booster), recorded in metrics.json."""
+    booster = model.get_booster() if hasattr(model, "get_booster") else model
+    summary = {"num_boosted_rounds": booster.num_boosted_rounds()}
+    best_iteration = booster.attr("best_iteration")
+    if best_iteration is not None:
+        summary["best_iteration"] = int(best_iteration)
+        summary["early_stopped"] = int(best_iteration) + 1 < n_estimators
+    return summary
+
+
 def evaluate_model(
-    model: xgb.XGBClassifier, X_test: pd.DataFrame, y_test: pd.Series
-) -> float:  # Or other suitable metric
-    """Evaluates the trained model."""
-    y_pred = model.predict(X_test)
-    accuracy = accuracy_score(y_test, y_pred)  # Example metric, change as needed
-    print(f"Model evaluation complete. Accuracy: {accuracy}")
-    return accuracy
+    model: xgb.XGBClassifier,
+    X_test: pd.DataFrame,
+    y_test: pd.Series,
+    slice_column: Optional[str] = None,
+    batch_size: int = 65536,
+) -> Dict[str, Any]:
+    """Evaluates the trained model.
+
+    Predicts the test set in batches and updates the streaming metrics of
+    `metrics.py` (accuracy, log-loss, per-class precision/recall/F1,
+    calibration, per-slice metrics and prediction latency).
+
+    Returns:
+        Dict[str, Any]: The metrics report, see `metrics.EvaluationMetrics.to_dict`.
+    """
+    booster = model.get_booster()
+    state = metrics.EvaluationMetrics(getattr(model, "n_classes_", len(np.unique(y_test))))
+    X = X_test.to_numpy(dtype=np.float32)
+    y = y_test.to_numpy()
+    slices = X_test[slice_column].to_numpy() if slice_column else None
+    for start in range(0, len(X), batch_size):
+        end = start + batch_size
+        with state.time_batch(len(X[start:end])):
+            margin = booster.inplace_predict(X[start:end], predict_type="margin")
+        state.update(
+            y[start:end],
+            margin,
+            slice_values=slices[start:end] if slices is not None else None,
+        )
+    report = state.to_dict()
+    print(f"Model evaluation complete. Accuracy: {report['accuracy']}")
+    print(f"Evaluation metrics: {metrics.scalar_metrics(report)}")
+    return report
 
 
 def save_model_artifacts(
-    model: xgb.XGBClassifier, model_dir: str, accuracy: float, tensorboard_log_dir=None
+    model: xgb.XGBClassifier,
+    model_dir: str,
+    accuracy: float,
+    tensorboard_log_dir=None,
+    training_summary: Optional[Dict[str, Any]] = None,
+    evaluation_metrics: Optional[Dict[str, Any]] = None,
+    export_compiled: bool = False,
+    compiled_sample: Optional[pd.DataFrame] = None,
+    holdout_data: Optional[Tuple[pd.DataFrame, pd.Series]] = None,
 ) -> None:
-    """Saves the trained model and other artifacts."""
+    """Saves the trained model and other artifacts.
+
+    `training_summary` (e.g. best_iteration) and the `evaluation_metrics`
+    report are added to metrics.json. With `export_compiled`, the model is also
+    compiled to model_compiled.npz (see compiled_model.py), verified on
+    `compiled_sample` rows. The held-out (X, y) split, if given, is saved under
+    holdout/ for later evaluations (see holdout.py).
+    """
 
     # GCSFuse conversion
     gs_prefix = "gs://"
@@ -145,13 +323,32 @@ def save_model_artifacts(
     print("Saving model artifacts to {}".format(gcs_model_path))
     model.save_model(gcs_model_path)
 
+    if export_compiled:
+        booster = model if isinstance(model, xgb.Booster) else model.get_booster()
+        sample = None
+        if compiled_sample is not None:
+            sample = compiled_sample.to_numpy(dtype=np.float32)
+        try:
+            compiled_model.export(booster, model_dir, sample)
+        except (NotImplementedError, ValueError) as e:
+            print(f"Compiled model not exported: {e}")
+
     print("Saving metrics to {}/metrics.json".format(model_dir))
     gcs_metrics_path = os.path.join(model_dir, "metrics.json")
-    metrics_dict = {"accuracy": accuracy}
+    metrics_dict = {
+        **(evaluation_metrics or {}),
+        "accuracy": accuracy,
+        **(training_summary or {}),
+    }
+    if holdout_data is not None:
+        holdout.save_holdout(model_dir, *holdout_data)
+        metrics_dict["holdout_rows"] = len(holdout_data[1])
     if tensorboard_log_dir:
-        tensorboard_writer = SummaryWriter(log_dir=tensorboard_log_dir)
+        tensorboard_writer = metrics_sink.get_writer(tensorboard_log_dir)
 
         tensorboard_writer.add_scalar("accuracy", accuracy)
+        for name, value in metrics.scalar_metrics(evaluation_metrics or {}).items():
+            tensorboard_writer.add_scalar(f"evaluation/{name}", value)
     with open(gcs_metrics_path, "w") as f:
         json.dump(metrics_dict, f)
 
@@ -221,15 +418,58 @@ def run_loop(**kwargs):
     for arg, value in vars(args).items():
         print(f"  {arg}: {value}")
 
-    # Load and preprocess data
-    df = load_data(args.data_path)
-    X, y = preprocess_data(df)
-    X_train, X_test, y_train, y_test = train_test_split(
-        X, y, test_size=0.2, random_state=42
-    )  # Split data
+    metrics_sink.configure(
+        flush_interval_s=getattr(args, "metrics_flush_interval_s", None),
+        max_queue=getattr(args, "metrics_max_queue", None),
+    )
+    try:
+        run_training(args)
+    finally:
+        # Write out the queued TensorBoard scalars before the job exits
+        metrics_sink.close_all()
 
-    if args.model_checkpoint_dir and check_file_exists_gcsfuse(
-        args.model_checkpoint_dir, "model.bst"
+
+def run_training(args: argparse.Namespace) -> None:
+    """Loads the data, trains, evaluates and saves the model."""
+    if getattr(args, "distributed", False):
+        run_distributed_loop(args)
+        return
+
+    if getattr(args, "external_memory", False):
+        run_external_memory_loop(args)
+        return
+
+    if getattr(args, "incremental", False):
+        run_incremental_loop(args)
+        return
+
+    # Load and preprocess data
+    row_filter = get_row_filter(args)
+    # The rows of a partition window change over time, so it is never cached
+    if getattr(args, "dataset_cache_dir", None) and not row_filter:
+        cache = dataset_cache.DatasetCache(
+            args.dataset_cache_dir, max_bytes=args.dataset_cache_max_bytes
+        )
+        X, y = cache.load_or_build(
+            args.data_path, lambda: preprocess_data(load_data(args.data_path))
+        )
+    else:
+        df = load_data(args.data_path, row_filter=row_filter)
+        X, y = preprocess_data(df)
+    X_train, X_test, y_train, y_test = split_test(args, X, y)
+    X_train, y_train, X_valid, y_valid = split_validation(args, X_train, y_train)
+
+    best_trial = None
+    if getattr(args, "search", "none") != "none":
+        best_trial = run_hyperparameter_search(args, X_train, y_train)
+        if best_trial is None:
+            print("Search shard finished, rank 0 trains and saves the final model.")
+            return
+
+    if (
+        best_trial is None
+        and args.model_checkpoint_dir
+        and check_file_exists_gcsfuse(args.model_checkpoint_dir, "model.bst")
     ):
         model = load_model_checkpoint(
             os.path.join(args.model_checkpoint_dir, "model.bst")
@@ -245,23 +485,368 @@ def run_loop(**kwargs):
             "eval_metric": "mlogloss",
             # "use_label_encoder": False,  # if necessary set to True
         }
+        params.update(get_throughput_params(args))
+        if best_trial:
+            params.update(best_trial["params"])
+            params["n_estimators"] = best_trial["rounds"]
+            print(f"Using the best hyperparameters from the search: {params}")
 
         # Create the model
         model = create_model_architecture(params)
 
     # Train, and evaluate model
-    model = train_model(model, X_train, y_train)
-    accuracy = evaluate_model(model, X_test, y_test)
+    model = train_model(
+        model,
+        X_train,
+        y_train,
+        X_valid,
+        y_valid,
+        early_stopping_rounds=args.early_stopping_rounds,
+    )
+    evaluation_metrics = evaluate_model(
+        model, X_test, y_test, slice_column=getattr(args, "slice_column", None)
+    )
+    accuracy = evaluation_metrics["accuracy"]
 
     # Save the model artifacts
 
     save_model_artifacts(
-        model, args.model_dir, accuracy, tensorboard_log_dir=args.tensorboard
+        model,
+        args.model_dir,
+        accuracy,
+        tensorboard_log_dir=args.tensorboard,
+        training_summary=get_training_summary(model, model.n_estimators),
+        evaluation_metrics=evaluation_metrics,
+        export_compiled=getattr(args, "export_compiled", False),
+        compiled_sample=X_test,
+        holdout_data=(X_test, y_test),
+    )
+
+    print("XGBoost training completed successfully.")
+
+    save_model_checkpoint(
+        model, args.model_checkpoint_dir, source=checkpoint_source(args)
+    )
+
+
+def run_hyperparameter_search(
+    args: argparse.Namespace, X_train: pd.DataFrame, y_train: pd.Series
+):
+    """Searches hyperparameters on a validation split carved out of X_train.
+
+    Returns:
+        The best trial, or None on replicas other than rank 0.
+    """
+    X_search, X_valid, y_search, y_valid = train_test_split(
+        X_train, y_train, test_size=0.2, random_state=42
+    )
+    base_params = {
+        "max_depth": args.max_depth,
+        "objective": "multi:softmax",
+        "num_class": len(y_train.unique()),
+        "eval_metric": "mlogloss",
+        **get_throughput_params(args, sklearn_api=False),
+    }
+    best_trial, _ = hpo.run_search(
+        args.search,
+        X_search,
+        y_search,
+        X_valid,
+        y_valid,
+        base_params,
+        model_dir=args.model_dir,
+        search_space=json.loads(args.search_space) if args.search_space else None,
+        num_trials=args.search_trials,
+        max_rounds=args.n_estimators,
+        min_rounds=args.search_min_rounds,
+        num_workers=args.search_workers,
+    )
+    return best_trial
+
+
+def run_incremental_loop(args: argparse.Namespace) -> None:
+    """Keeps boosting the checkpoint on the rows that arrived since the last run."""
+    drop_columns = [args.watermark_column] if args.watermark_column else []
+    watermark = incremental.load_watermark(args.model_checkpoint_dir)
+
+    model = None
+    boosted_rounds = 0
+    has_checkpoint = bool(args.model_checkpoint_dir) and check_file_exists_gcsfuse(
+        args.model_checkpoint_dir, "model.bst"
+    )
+    if has_checkpoint:
+        model = load_model_checkpoint(
+            os.path.join(args.model_checkpoint_dir, "model.bst")
+        )
+        boosted_rounds = model.get_booster().num_boosted_rounds()
+        print("Checkpoint loaded successfully.")
+
+    row_filter = get_row_filter(args)
+    df = None
+    if has_checkpoint and watermark is not None:
+        df, source_state = incremental.load_delta(
+            args.data_path,
+            watermark,
+            args.watermark_column,
+            load_data=load_data,
+            row_filter=row_filter,
+        )
+    mode, reason = incremental.plan_run(
+        watermark,
+        has_checkpoint,
+        delta_rows=len(df) if df is not None else 0,
+        boosted_rounds=boosted_rounds,
+        n_estimators=args.n_estimators,
+        full_rebuild_every=args.full_rebuild_every,
+        max_delta_fraction=args.max_delta_fraction,
+        max_total_rounds=args.max_total_rounds,
+        unseen_labels=df is not None
+        and not df.empty
+        and df["target"].max() >= getattr(model, "n_classes_", np.inf),
+    )
+    print(f"Training mode: {mode} ({reason})")
+
+    if mode == "incremental" and df.empty:
+        print("No new rows since the watermark, re-exporting the checkpoint.")
+        save_model_artifacts(
+            model,
+            args.model_dir,
+            watermark["last_accuracy"],
+            tensorboard_log_dir=args.tensorboard,
+            export_compiled=getattr(args, "export_compiled", False),
+        )
+        return
+
+    if mode == "full":
+        watermark = incremental.new_watermark()
+        df, source_state = incremental.load_delta(
+            args.data_path,
+            watermark,
+            args.watermark_column,
+            load_data=load_data,
+            row_filter=row_filter,
+        )
+
+    X, y = preprocess_data(df, drop_columns=drop_columns)
+    X_train, X_test, y_train, y_test = split_test(args, X, y)
+
+    if mode == "incremental":
+        model = incremental.continue_training(
+            model,
+            X_train,
+            y_train,
+            num_boost_round=args.n_estimators,
+            params=get_throughput_params(args, sklearn_api=False),
+            callbacks=[TensorBoardCallback(experiment="exp_1")],
+        )
+    else:
+        params = {
+            "n_estimators": args.n_estimators,
+            "max_depth": args.max_depth,
+            "objective": "multi:softmax",
+            "num_class": len(y.unique()),
+            "eval_metric": "mlogloss",
+            **get_throughput_params(args),
+        }
+        X_fit, y_fit, X_valid, y_valid = split_validation(args, X_train, y_train)
+        model = train_model(
+            create_model_architecture(params),
+            X_fit,
+            y_fit,
+            X_valid,
+            y_valid,
+            early_stopping_rounds=args.early_stopping_rounds,
+        )
+
+    evaluation_metrics = evaluate_model(
+        model, X_test, y_test, slice_column=args.slice_column
+    )
+    accuracy = evaluation_metrics["accuracy"]
+    save_model_artifacts(
+        model,
+        args.model_dir,
+        accuracy,
+        tensorboard_log_dir=args.tensorboard,
+        training_summary=get_training_summary(model, args.n_estimators),
+        evaluation_metrics=evaluation_metrics,
+        export_compiled=getattr(args, "export_compiled", False),
+        compiled_sample=X_test,
+        holdout_data=(X_test, y_test),
+    )
+
+    print("XGBoost training completed successfully.")
+
+    # Checkpoint first: a watermark must never point past the saved model
+    save_model_checkpoint(
+        model, args.model_checkpoint_dir, source=checkpoint_source(args)
+    )
+
+    watermark["sources"][args.data_path] = source_state
+    if mode == "full":
+        watermark["runs_since_rebuild"] = 0
+        watermark["rows_at_rebuild"] = len(df)
+        watermark["rows_since_rebuild"] = 0
+    else:
+        watermark["runs_since_rebuild"] += 1
+        watermark["rows_since_rebuild"] += len(df)
+    watermark["last_mode"] = mode
+    watermark["last_accuracy"] = accuracy
+    incremental.save_watermark(args.model_checkpoint_dir, watermark)
+
+
+def run_distributed_loop(args: argparse.Namespace) -> None:
+    """Trains one model across all replicas, each on its own shard of the data."""
+    info = cluster.get_cluster_info()
+    print(f"Distributed mode, rank {info.rank} of {info.world_size}")
+    if args.tree_method == "exact":
+        raise ValueError("Distributed training needs --tree_method hist or approx")
+
+    with distributed.distributed_context(info, port=args.tracker_port):
+        df = distributed.load_shard(
+            args.data_path,
+            info.rank,
+            info.world_size,
+            chunk_size=args.chunk_size,
+            row_filter=get_row_filter(args),
+        )
+        X, y = preprocess_data(df)
+        num_class = int(distributed.allreduce_max(y.max())) + 1
+        X_train, X_test, y_train, y_test = split_test(args, X, y)
+        X_train, y_train, X_valid, y_valid = split_validation(args, X_train, y_train)
+
+        matrix = xgb.QuantileDMatrix if args.tree_method == "hist" else xgb.DMatrix
+        dtrain = matrix(X_train, label=y_train)
+        evals = []
+        if X_valid is not None:
+            dvalid = (
+                xgb.QuantileDMatrix(X_valid, label=y_valid, ref=dtrain)
+                if args.tree_method == "hist"
+                else xgb.DMatrix(X_valid, label=y_valid)
+            )
+            evals = [(dvalid, "validation")]
+
+        xgb_model = None
+        if args.model_checkpoint_dir and check_file_exists_gcsfuse(
+            args.model_checkpoint_dir, "model.bst"
+        ):
+            xgb_model = load_model_checkpoint(
+                os.path.join(args.model_checkpoint_dir, "model.bst")
+            ).get_booster()
+            print("Checkpoint loaded successfully.")
+
+        params = {
+            "max_depth": args.max_depth,
+            "objective": "multi:softmax",
+            "num_class": num_class,
+            "eval_metric": "mlogloss",
+            **get_throughput_params(args, sklearn_api=False),
+        }
+        # Evaluation results are all-reduced, so every rank stops at the same round
+        booster = xgb.train(
+            params,
+            dtrain,
+            num_boost_round=args.n_estimators,
+            evals=evals,
+            early_stopping_rounds=args.early_stopping_rounds if evals else None,
+            xgb_model=xgb_model,
+            callbacks=[TensorBoardCallback(experiment="exp_1")]
+            if info.rank == 0
+            else None,
+            verbose_eval=False,
+        )
+        if evals:
+            booster = trim_to_best_iteration(booster)
+
+        state = metrics.EvaluationMetrics(num_class)
+        X_eval = X_test.to_numpy(dtype=np.float32)
+        with state.time_batch(len(X_eval)):
+            margin = booster.inplace_predict(X_eval, predict_type="margin")
+        state.update(y_test.to_numpy(), margin)
+        distributed.allreduce_metrics(state)
+
+    if info.rank != 0:
+        print(f"Rank {info.rank} done, rank 0 saves the model.")
+        return
+
+    evaluation_metrics = state.to_dict()
+    print(f"Model evaluation complete. Accuracy: {evaluation_metrics['accuracy']}")
+    save_model_artifacts(
+        booster,
+        args.model_dir,
+        evaluation_metrics["accuracy"],
+        tensorboard_log_dir=args.tensorboard,
+        training_summary={
+            **get_training_summary(booster, args.n_estimators),
+            "world_size": info.world_size,
+        },
+        evaluation_metrics=evaluation_metrics,
+        export_compiled=getattr(args, "export_compiled", False),
+    )
+
+    print("XGBoost training completed successfully.")
+
+    save_model_checkpoint(
+        booster, args.model_checkpoint_dir, source=checkpoint_source(args)
+    )
+
+
+def run_external_memory_loop(args: argparse.Namespace) -> None:
+    """Trains out-of-core: peak memory is bounded by `chunk_size`, not the data."""
+    print(f"External-memory mode, chunk size: {args.chunk_size} rows")
+    row_filter = get_row_filter(args)
+
+    xgb_model = None
+    if args.model_checkpoint_dir and check_file_exists_gcsfuse(
+        args.model_checkpoint_dir, "model.bst"
+    ):
+        xgb_model = load_model_checkpoint(
+            os.path.join(args.model_checkpoint_dir, "model.bst")
+        ).get_booster()
+        print("Checkpoint loaded successfully.")
+
+    params = {
+        "max_depth": args.max_depth,
+        "objective": "multi:softmax",
+        "num_class": external_memory.count_classes(
+            args.data_path, args.chunk_size, row_filter=row_filter
+        ),
+        "eval_metric": "mlogloss",
+        **get_throughput_params(args, sklearn_api=False),
+    }
+    booster = external_memory.train_external_memory(
+        params,
+        args.data_path,
+        num_boost_round=args.n_estimators,
+        chunk_size=args.chunk_size,
+        test_fraction=args.test_fraction,
+        cache_dir=args.external_memory_cache_dir,
+        xgb_model=xgb_model,
+        callbacks=[TensorBoardCallback(experiment="exp_1")],
+        row_filter=row_filter,
+    )
+    evaluation_metrics = external_memory.evaluate_external_memory(
+        booster,
+        args.data_path,
+        num_classes=params["num_class"],
+        chunk_size=args.chunk_size,
+        test_fraction=args.test_fraction,
+        row_filter=row_filter,
+    )
+
+    save_model_artifacts(
+        booster,
+        args.model_dir,
+        evaluation_metrics["accuracy"],
+        tensorboard_log_dir=args.tensorboard,
+        evaluation_metrics=evaluation_metrics,
+        export_compiled=getattr(args, "export_compiled", False),
     )
 
     print("XGBoost training completed successfully.")
 
-    save_model_checkpoint(model, args.model_checkpoint_dir)
+    save_model_checkpoint(
+        booster, args.model_checkpoint_dir, source=checkpoint_source(args)
+    )
 
 
 import pandas as pd
@@ -274,7 +859,11 @@ from google.cloud import bigquery
 
 
 def load_data_from_bq(bq_uri: str) -> str:
-    """Loads data from the bq_uri to a local csv file"""
+    """Loads data from the bq_uri to a local csv file.
+
+    Legacy path, only used with `--bq_read_mode=csv`. By default bq:// URIs are
+    read directly by `load_data` through the BigQuery Storage Read API.
+    """
 
     print(f"Starting data load from: {bq_uri}")
 
@@ -327,7 +916,10 @@ def load_data_from_bq(bq_uri: str) -> str:
 
 
 def save_model_checkpoint(
-    model: xgb.XGBClassifier, checkpoint_dir: str = None, epoch: int = None
+    model: xgb.XGBClassifier,
+    checkpoint_dir: str = None,
+    epoch: int = None,
+    source: Optional[Dict[str, Any]] = None,
 ):
     """Saves a checkpoint of the model if checkpoint_dir is provided.
 
@@ -336,6 +928,8 @@ def save_model_checkpoint(
         epoch (int, optional): The current epoch number (for filename).
         checkpoint_dir (str, optional): Directory to save checkpoints.
                                         If None, no checkpoint is saved.
+        source (Dict[str, Any], optional): The run that wrote model.bst (see
+            `checkpoint_source`), recorded next to it with its MD5.
     """
     # GCSFuse conversion
     gs_prefix = "gs://"
@@ -352,10 +946,38 @@ def save_model_checkpoint(
                 checkpoint_path = os.path.join(checkpoint_dir, "model.bst")
             model.save_model(checkpoint_path)
             print(f"Checkpoint saved to {checkpoint_path}")
+            if epoch is None:
+                write_checkpoint_source(checkpoint_dir, checkpoint_path, source)
     else:
         print("No checkpoint directory provided, not saving checkpoint.")
 
 
+def checkpoint_source(args: argparse.Namespace) -> Optional[Dict[str, Any]]:
+    """Which run writes the checkpoint, and from which checkpoint it started.
+
+    The storage trigger reuses the step cache key of that run for an identical
+    trigger (see functions/storage_trigger/cache_keys.py).
+    """
+    if not getattr(args, "checkpoint_fingerprint", None):
+        return None
+    return {"model_dir": args.model_dir, "resumed_from": args.checkpoint_fingerprint}
+
+
+def write_checkpoint_source(
+    checkpoint_dir: str, checkpoint_path: str, source: Optional[Dict[str, Any]]
+) -> None:
+    """Writes (or, without a source, removes) CHECKPOINT_SOURCE for model.bst."""
+    source_path = os.path.join(checkpoint_dir, CHECKPOINT_SOURCE)
+    if source is None:
+        if os.path.exists(source_path):
+            os.remove(source_path)
+        return
+    with open(checkpoint_path, "rb") as f:
+        md5 = hashlib.md5(f.read()).hexdigest()
+    with open(source_path, "w") as f:
+        json.dump({**source, "md5": md5}, f)
+
+
 def load_model_checkpoint(model_checkpoint_path: None) -> xgb.XGBClassifier:
 
     # GCSFuse conversion
@@ -391,6 +1013,13 @@ def main():
         type=str,
         help="Directory to load previously trained models.",
     )
+    parser.add_argument(
+        "--checkpoint_fingerprint",
+        type=str,
+        default=None,
+        help="Fingerprint of the checkpoint this run starts from, recorded with "
+        "the checkpoint it writes (set by the storage trigger).",
+    )
 
     # Add other hyperparameters as needed
     parser.add_argument(
@@ -399,22 +1028,247 @@ def main():
     parser.add_argument(
         "--max_depth", type=int, default=3, help="Maximum depth of trees"
     )
+    parser.add_argument(
+        "--early_stopping_rounds",
+        type=int,
+        default=10,
+        help="Stop when the validation metric has not improved for this many "
+        "rounds (0: train all n_estimators rounds).",
+    )
+    parser.add_argument(
+        "--validation_fraction",
+        type=float,
+        default=0.1,
+        help="Fraction of the training rows held out for early stopping, unless "
+        "--validation_data_path is given.",
+    )
+    parser.add_argument(
+        "--validation_data_path",
+        type=str,
+        default=None,
+        help="Separate validation data (CSV, Parquet or bq://) for early stopping.",
+    )
+    parser.add_argument(
+        "--slice_column",
+        type=str,
+        default=None,
+        help="Feature column whose values define the slices of the per-slice "
+        "evaluation metrics.",
+    )
+    parser.add_argument(
+        "--tree_method",
+        type=str,
+        choices=["hist", "approx", "exact", "auto"],
+        default="hist",
+        help="XGBoost tree method. hist trains on a QuantileDMatrix.",
+    )
+    parser.add_argument(
+        "--max_bin",
+        type=int,
+        default=256,
+        help="Maximum number of histogram bins per feature (hist/approx).",
+    )
+    parser.add_argument(
+        "--nthread",
+        type=int,
+        default=0,
+        help="Training threads (0: CPUs available to the container, "
+        "honouring its cgroup quota).",
+    )
     parser.add_argument(
         "--tensorboard",
         type=str,
         help="Tensorboard",
         default=os.environ.get("AIP_TENSORBOARD_LOG_DIR", None),
     )
+    parser.add_argument(
+        "--metrics_flush_interval_s",
+        type=float,
+        default=metrics_sink.DEFAULT_FLUSH_INTERVAL_S,
+        help="Seconds between background writes of the queued TensorBoard scalars.",
+    )
+    parser.add_argument(
+        "--metrics_max_queue",
+        type=int,
+        default=metrics_sink.DEFAULT_MAX_QUEUE,
+        help="Write the queued TensorBoard scalars as soon as this many are pending.",
+    )
+    parser.add_argument(
+        "--bq_read_mode",
+        type=str,
+        choices=["arrow", "csv"],
+        default="arrow",
+        help="How to read bq:// data: Arrow record batches via the Storage Read API, "
+        "or the legacy export to a temporary CSV.",
+    )
+    parser.add_argument(
+        "--partition_window_days",
+        type=int,
+        default=0,
+        help="Only train on the last N daily partitions of an ingestion-time "
+        "partitioned bq:// table (0: all partitions).",
+    )
+    parser.add_argument(
+        "--partition_start",
+        type=data_sources.partition_date,
+        default=None,
+        help="First partition date (YYYY-MM-DD) of a partitioned bq:// table.",
+    )
+    parser.add_argument(
+        "--partition_end",
+        type=data_sources.partition_date,
+        default=None,
+        help="Last partition date (YYYY-MM-DD) of a partitioned bq:// table.",
+    )
+    parser.add_argument(
+        "--export_compiled",
+        action="store_true",
+        help="Also write model_compiled.npz, flat node arrays with a NumPy "
+        "predictor, verified bit-exact against model.bst.",
+    )
+    parser.add_argument(
+        "--distributed",
+        action="store_true",
+        help="Train one model across all replicas of the job (Rabit), each "
+        "replica reading its shard of the data.",
+    )
+    parser.add_argument(
+        "--tracker_port",
+        type=int,
+        default=distributed.DEFAULT_TRACKER_PORT,
+        help="Port of the Rabit tracker started by rank 0 in distributed mode.",
+    )
+    parser.add_argument(
+        "--external_memory",
+        action="store_true",
+        help="Stream the data in chunks into an external-memory DMatrix "
+        "instead of loading it into a DataFrame.",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=external_memory.DEFAULT_CHUNK_SIZE,
+        help="Rows per chunk in external-memory mode.",
+    )
+    parser.add_argument(
+        "--test_fraction",
+        type=float,
+        default=0.2,
+        help="Fraction of rows hashed into the test split (the saved holdout).",
+    )
+    parser.add_argument(
+        "--external_memory_cache_dir",
+        type=str,
+        default=None,
+        help="Local directory for the external-memory DMatrix pages.",
+    )
+    parser.add_argument(
+        "--dataset_cache_dir",
+        type=str,
+        default=os.environ.get("DATASET_CACHE_DIR", None),
+        help="Local directory for the preprocessed dataset cache (disabled if unset).",
+    )
+    parser.add_argument(
+        "--dataset_cache_max_bytes",
+        type=int,
+        default=dataset_cache.DEFAULT_MAX_BYTES,
+        help="Total size of the dataset cache before LRU eviction.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only train on rows past the checkpoint's watermark, continuing "
+        "to boost the checkpointed model.",
+    )
+    parser.add_argument(
+        "--watermark_column",
+        type=str,
+        default=None,
+        help="Monotonic column (e.g. ingestion timestamp) used as watermark in "
+        "incremental mode. If unset, sources are treated as append-only and "
+        "tracked by row count.",
+    )
+    parser.add_argument(
+        "--full_rebuild_every",
+        type=int,
+        default=0,
+        help="Incremental mode: rebuild from scratch after this many incremental "
+        "runs (0: never).",
+    )
+    parser.add_argument(
+        "--max_delta_fraction",
+        type=float,
+        default=0.0,
+        help="Incremental mode: rebuild once rows appended since the last rebuild "
+        "exceed this fraction of the rebuilt dataset (0: never).",
+    )
+    parser.add_argument(
+        "--max_total_rounds",
+        type=int,
+        default=0,
+        help="Incremental mode: rebuild when the model would exceed this many "
+        "boosting rounds (0: never).",
+    )
+    parser.add_argument(
+        "--search",
+        type=str,
+        choices=["none", "grid", "random", "halving", "hyperband"],
+        default="none",
+        help="Hyperparameter search strategy. The final model is trained with the "
+        "best trial and leaderboard.json is written next to metrics.json.",
+    )
+    parser.add_argument(
+        "--search_space",
+        type=str,
+        default=None,
+        help='JSON search space, e.g. {"max_depth": [3, 5], '
+        '"learning_rate": {"min": 0.01, "max": 0.3, "log": true}}.',
+    )
+    parser.add_argument(
+        "--search_trials",
+        type=int,
+        default=20,
+        help="Number of candidates for random search and successive halving.",
+    )
+    parser.add_argument(
+        "--search_min_rounds",
+        type=int,
+        default=10,
+        help="Smallest boosting budget for successive halving/Hyperband; the "
+        "largest is --n_estimators.",
+    )
+    parser.add_argument(
+        "--search_workers",
+        type=int,
+        default=0,
+        help="Size of the local trial process pool (0: half the CPUs).",
+    )
     # ... add other hyperparameter arguments
 
     args = parser.parse_args()
 
+    # run_training dispatches on the first of these modes, the others would be
+    # silently ignored
+    modes = [
+        f"--{mode}"
+        for mode in ("distributed", "external_memory", "incremental")
+        if getattr(args, mode)
+    ]
+    if args.search != "none":
+        modes.append("--search")
+    if len(modes) > 1:
+        parser.error(f"{' and '.join(modes)} cannot be combined")
+
     if not args.model_dir:
         raise Exception(
             "You need to provide a directory where to store the model artifacts"
         )
 
-    if args.data_path and args.data_path.startswith("bq://"):
+    if (
+        args.data_path
+        and args.data_path.startswith("bq://")
+        and args.bq_read_mode == "csv"
+    ):
         args.data_path = load_data_from_bq(args.data_path)
 
     if not args.data_path:
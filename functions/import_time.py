@@ -0,0 +1,128 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Import time of the Cloud Functions' entry modules, against a budget.
+
+Every cold start of a function imports its `main.py`, so heavy imports at
+module level (Google Cloud client libraries, SDKs) add directly to the latency
+of the first event. This runs `python -X importtime -c "import main"` in a
+fresh interpreter per function, prints the heaviest imports and exits with
+status 1 if a function exceeds its budget:
+
+    python import_time.py                       # all functions, default budgets
+    python import_time.py storage_trigger --budget_ms 400 --repeat 5
+
+Run it in an environment with the function's requirements installed.
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from typing import List, NamedTuple, Tuple
+
+FUNCTIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+# Import of main.py, in milliseconds (the minimum over --repeat runs)
+DEFAULT_BUDGETS_MS = {
+    "storage_trigger": 600,
+    "submit_pipeline": 600,
+}
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+
+class ImportProfile(NamedTuple):
+    total_ms: float
+    # (cumulative ms, module) of the imports made directly by the entry module
+    top_level: List[Tuple[float, str]]
+
+
+def measure(function_dir: str, module: str = "main") -> ImportProfile:
+    """Imports `module` in a fresh interpreter with `-X importtime`."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=function_dir,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode:
+        raise RuntimeError(f"import {module} failed in {function_dir}:\n{result.stderr}")
+
+    # Children are listed (indented) before the module that imports them
+    children: List[Tuple[float, str]] = []
+    total_ms = 0.0
+    top_level: List[Tuple[float, str]] = []
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if not match:
+            continue
+        cumulative_ms = int(match.group(2)) / 1000
+        depth = len(match.group(3)) // 2
+        name = match.group(4)
+        if depth == 1:
+            children.append((cumulative_ms, name))
+        elif depth == 0:
+            if name == module:
+                total_ms = cumulative_ms
+                top_level = sorted(children, reverse=True)
+            children = []
+    return ImportProfile(total_ms=total_ms, top_level=top_level)
+
+
+def check(function: str, budget_ms: float, repeat: int = 3, module: str = "main") -> bool:
+    """Prints the import profile of a function; True if within budget."""
+    function_dir = os.path.join(FUNCTIONS_DIR, function)
+    profiles = [measure(function_dir, module) for _ in range(repeat)]
+    best = min(profiles, key=lambda profile: profile.total_ms)
+    within_budget = best.total_ms <= budget_ms
+    status = "OK" if within_budget else "OVER BUDGET"
+    print(
+        f"{function}: import {module} took {best.total_ms:.0f} ms "
+        f"(budget {budget_ms:.0f} ms) {status}"
+    )
+    for ms, name in best.top_level[:10]:
+        print(f"  {ms:8.1f} ms  {name}")
+    return within_budget
+
+
+def test_import_budget():
+    """Fails if any function's entry module imports slower than its budget."""
+    over_budget = [
+        function
+        for function, budget_ms in DEFAULT_BUDGETS_MS.items()
+        if not check(function, budget_ms)
+    ]
+    assert not over_budget, f"Import time over budget: {over_budget}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "functions", nargs="*", default=sorted(DEFAULT_BUDGETS_MS), help="Function dirs."
+    )
+    parser.add_argument(
+        "--budget_ms", type=float, default=None, help="Overrides the default budgets."
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--module", type=str, default="main")
+    args = parser.parse_args()
+
+    results = [
+        check(
+            function,
+            args.budget_ms or DEFAULT_BUDGETS_MS.get(function, 600),
+            repeat=args.repeat,
+            module=args.module,
+        )
+        for function in args.functions
+    ]
+    sys.exit(0 if all(results) else 1)
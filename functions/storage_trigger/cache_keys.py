@@ -0,0 +1,264 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Content-based cache keys for the dataset, training and evaluation steps.
+
+Vertex AI Pipelines reuses a cached step when its component and inputs are the
+same. The pipeline root (and with it the training output and model directory)
+is derived from a key over everything the trained model depends on:
+
+- the data: the MD5 of the uploaded object, or a snapshot of the table (rows
+  and last modification) when uploads are appended to a shared table,
+- the warm-start checkpoint: the generation of `model.bst`, if any,
+- the worker pool specs: training arguments, machine type, replica count and
+  the training image pinned to its digest.
+
+Identical inputs map to the same pipeline root, so the cached steps are reused.
+Every run overwrites the checkpoint, so the trainer records next to it which
+run wrote it (`CHECKPOINT_SOURCE`): when the checkpoint is the output of a run
+with the same data and specs, that run's key is reused (see `run_cache_key`).
+A key is only computed if the image digest can be resolved, a mutable tag
+alone could silently reuse a model trained by an older image.
+"""
+import base64
+import copy
+import hashlib
+import json
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Written by the trainer next to model.bst: {"model_dir", "resumed_from", "md5"}
+CHECKPOINT_SOURCE = "checkpoint_source.json"
+
+MANIFEST_TYPES = ", ".join(
+    [
+        "application/vnd.oci.image.index.v1+json",
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.docker.distribution.manifest.v2+json",
+    ]
+)
+
+
+def resolve_image_digest(image_uri: str, session=None) -> Optional[str]:
+    """Pins `image_uri` to its digest (`repository@sha256:...`).
+
+    The tag is resolved with the Docker Registry HTTP API of Artifact Registry.
+
+    Returns:
+        The pinned image URI, or None if the digest could not be resolved.
+    """
+    if "@sha256:" in image_uri:
+        return image_uri
+
+    repository, tag = image_uri, "latest"
+    if ":" in image_uri.rsplit("/", 1)[-1]:
+        repository, tag = image_uri.rsplit(":", 1)
+    host, path = repository.split("/", 1)
+
+    try:
+        if session is None:
+            from google.auth import default
+            from google.auth.transport.requests import AuthorizedSession
+
+            credentials, _ = default()
+            session = AuthorizedSession(credentials)
+        response = session.head(
+            f"https://{host}/v2/{path}/manifests/{tag}",
+            headers={"Accept": MANIFEST_TYPES},
+            timeout=10,
+        )
+        response.raise_for_status()
+        digest = response.headers["Docker-Content-Digest"]
+    except Exception as e:
+        logger.warning(f"Could not resolve the digest of {image_uri}: {e}")
+        return None
+    return f"{repository}@{digest}"
+
+
+def object_fingerprint(event_data: Dict[str, Any]) -> Optional[str]:
+    """Content hash of an uploaded object, from its storage event."""
+    if event_data.get("md5Hash"):
+        return f"md5:{base64.b64decode(event_data['md5Hash']).hex()}"
+    # Composite objects have no MD5
+    if event_data.get("crc32c"):
+        return f"crc32c:{event_data['crc32c']}:{event_data.get('size')}"
+    return None
+
+
+def table_fingerprint(bq_client, table_uri: str) -> str:
+    """Snapshot of a BigQuery table: its row count and last modification."""
+    table = bq_client.get_table(table_uri.replace("bq://", ""))
+    return f"table:{table.num_rows}:{table.modified.isoformat()}"
+
+
+def _checkpoint_blob(storage_client, checkpoint_dir: str, filename: str):
+    bucket_name, _, prefix = checkpoint_dir.replace("gs://", "").partition("/")
+    blob_name = f"{prefix.rstrip('/')}/{filename}" if prefix else filename
+    return storage_client.bucket(bucket_name).get_blob(blob_name)
+
+
+def checkpoint_fingerprint(storage_client, checkpoint_dir: Optional[str]) -> str:
+    """Generation of the warm-start checkpoint, which the trainer resumes from."""
+    if not checkpoint_dir:
+        return "none"
+    blob = _checkpoint_blob(storage_client, checkpoint_dir, "model.bst")
+    return f"generation:{blob.generation}" if blob else "none"
+
+
+def checkpoint_source(
+    storage_client, checkpoint_dir: Optional[str]
+) -> Optional[Dict[str, Any]]:
+    """The trainer's record of the run that wrote the current checkpoint, or
+    None if there is none or it belongs to an older `model.bst`."""
+    if not checkpoint_dir:
+        return None
+    source_blob = _checkpoint_blob(storage_client, checkpoint_dir, CHECKPOINT_SOURCE)
+    model_blob = _checkpoint_blob(storage_client, checkpoint_dir, "model.bst")
+    if source_blob is None or model_blob is None or not model_blob.md5_hash:
+        return None
+    source = json.loads(source_blob.download_as_text())
+    if source.get("md5") != base64.b64decode(model_blob.md5_hash).hex():
+        logger.info(f"{CHECKPOINT_SOURCE} does not describe the current checkpoint")
+        return None
+    return source
+
+
+def with_checkpoint_fingerprint(
+    worker_pool_specs: List[Dict[str, Any]], checkpoint: str
+) -> List[Dict[str, Any]]:
+    """A copy of the worker pool specs passing the checkpoint fingerprint to the
+    trainer, which records it in `CHECKPOINT_SOURCE`."""
+    specs = copy.deepcopy(worker_pool_specs)
+    for spec in specs:
+        spec["container_spec"]["args"] += ["--checkpoint_fingerprint", checkpoint]
+    return specs
+
+
+def pin_training_image(
+    worker_pool_specs: List[Dict[str, Any]], session=None
+) -> Optional[List[Dict[str, Any]]]:
+    """A copy of the worker pool specs with the image pinned to its digest,
+    or None if it could not be resolved."""
+    pinned = copy.deepcopy(worker_pool_specs)
+    for spec in pinned:
+        image_uri = resolve_image_digest(spec["container_spec"]["image_uri"], session)
+        if image_uri is None:
+            return None
+        spec["container_spec"]["image_uri"] = image_uri
+    return pinned
+
+
+def step_cache_key(
+    data_fingerprint: str,
+    checkpoint: str,
+    worker_pool_specs: List[Dict[str, Any]],
+) -> str:
+    """SHA-256 over the inputs the trained model depends on."""
+    payload = {
+        "data": data_fingerprint,
+        "checkpoint": checkpoint,
+        "worker_pool_specs": worker_pool_specs,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def run_cache_key(
+    storage_client,
+    data_fingerprint: str,
+    checkpoint_dir: Optional[str],
+    worker_pool_specs: List[Dict[str, Any]],
+    model_dir_for_key: Callable[[str], str],
+) -> Tuple[str, List[Dict[str, Any]]]:
+    """Step cache key of a run, and its worker pool specs.
+
+    If the checkpoint was written by the run whose model directory is
+    `model_dir_for_key` of the key this run would have had with that run's
+    starting checkpoint, both have the same data and specs: the training
+    output is already there, and that key is reused. Otherwise the key covers
+    the current checkpoint.
+    """
+    source = checkpoint_source(storage_client, checkpoint_dir)
+    if source:
+        checkpoint = source["resumed_from"]
+        specs = with_checkpoint_fingerprint(worker_pool_specs, checkpoint)
+        key = step_cache_key(data_fingerprint, checkpoint, specs)
+        if source["model_dir"].rstrip("/") == model_dir_for_key(key).rstrip("/"):
+            logger.info(f"The checkpoint was written by the run with key {key}")
+            return key, specs
+
+    checkpoint = checkpoint_fingerprint(storage_client, checkpoint_dir)
+    specs = worker_pool_specs
+    if checkpoint_dir:
+        specs = with_checkpoint_fingerprint(worker_pool_specs, checkpoint)
+    return step_cache_key(data_fingerprint, checkpoint, specs), specs
+
+
+def test_run_cache_key():
+    """Two identical triggers in a row share a key, although the first run
+    overwrote the checkpoint; new data or a replaced checkpoint do not."""
+    import fakes
+
+    storage_client = fakes.FakeStorageClient()
+    bucket = storage_client.bucket("bucket")
+    checkpoint_dir = "gs://bucket/checkpoints"
+    specs = [{"container_spec": {"image_uri": "image@sha256:0", "args": ["--a"]}}]
+
+    def model_dir_for_key(key):
+        return f"gs://bucket/pipeline_cached/{key[:16]}/model"
+
+    def trigger(data_fingerprint):
+        return run_cache_key(
+            storage_client, data_fingerprint, checkpoint_dir, specs, model_dir_for_key
+        )
+
+    def train(key, run_specs, model=b"model"):
+        """What the trainer does at the end of the run (see save_model_checkpoint)."""
+        args = run_specs[0]["container_spec"]["args"]
+        bucket.blob("checkpoints/model.bst").upload_from_string(model)
+        source = {
+            "model_dir": model_dir_for_key(key),
+            "resumed_from": args[args.index("--checkpoint_fingerprint") + 1],
+            "md5": hashlib.md5(model).hexdigest(),
+        }
+        bucket.blob(f"checkpoints/{CHECKPOINT_SOURCE}").upload_from_string(
+            json.dumps(source)
+        )
+
+    # No checkpoint yet, then one written by an earlier run on other data
+    first_key, first_specs = trigger("md5:a")
+    train(first_key, first_specs, b"model-a")
+    key, run_specs = trigger("md5:b")
+    assert key != first_key
+    train(key, run_specs, b"model-b")
+    assert bucket.generation("checkpoints/model.bst") == 3
+
+    # The identical trigger reuses the key, and the cached run writes nothing
+    assert trigger("md5:b") == (key, run_specs)
+    assert trigger("md5:b") == (key, run_specs)
+
+    # New data trains from the current checkpoint
+    new_key, new_specs = trigger("md5:c")
+    assert new_key != key
+    assert "generation:3" in new_specs[0]["container_spec"]["args"]
+
+    # A checkpoint replaced by hand no longer matches its record
+    bucket.blob("checkpoints/model.bst").upload_from_string(b"replaced")
+    assert trigger("md5:b")[0] != key
+    print("OK: identical triggers share a step cache key")
+
+
+if __name__ == "__main__":
+    test_run_cache_key()
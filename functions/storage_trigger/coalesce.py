@@ -0,0 +1,324 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Coalesces uploaded CSV files into batched BigQuery loads.
+
+Cloud Function instances share no memory, so the buffer lives in GCS: every
+finalized object adds a small "pending" marker under `prefix`. A batch is
+flushed once it holds `max_files` files or its oldest file has waited
+`window_seconds`. The instance that flushes takes a lock object (created with
+`if_generation_match=0`, so only one instance can hold it), loads every pending
+URI with one multi-URI load job appending to a single ingestion-time
+partitioned table, and deletes the markers. The caller then triggers one
+pipeline run for the whole batch. A stale lock is only deleted if it still has
+the generation it was read with, so two instances breaking it at once cannot
+both end up holding it.
+
+A batch whose window expired without a later upload is flushed by calling
+`flush` periodically (see `main.flush_pending`, e.g. from Cloud Scheduler).
+
+The clients are injected, see `fakes.py` for in-memory versions. The Google
+Cloud libraries are only imported when needed, to keep cold starts short.
+"""
+import json
+import logging
+import re
+import time
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+import ingest
+
+logger = logging.getLogger(__name__)
+
+LOCK_NAME = "flush.lock"
+# A lock older than this belongs to a crashed flush and may be broken
+LOCK_TIMEOUT_SECONDS = 600
+
+
+class Batch(NamedTuple):
+    uris: List[str]
+    output_rows: int
+    table_uri: str
+    # Profiles recorded by `add` (see validate.py), one per file that has one
+    profiles: Tuple[dict, ...] = ()
+
+
+class Coalescer:
+    def __init__(
+        self,
+        storage_client,
+        bq_client,
+        state_bucket: str,
+        table_id: str,
+        prefix: str = "coalesce",
+        window_seconds: float = 300,
+        max_files: int = 50,
+        clock: Callable[[], float] = time.time,
+        schema: Optional[list] = None,
+    ):
+        """
+        Args:
+            state_bucket (str): Bucket holding the pending markers and the lock.
+            table_id (str): project.dataset.table the batches are appended to.
+            window_seconds (float): Flush once the oldest pending file is this old.
+            max_files (int): Flush as soon as this many files are pending.
+            schema (List[bigquery.SchemaField], optional): Declared CSV schema.
+                If set, batches are appended with `ingest.append_files` (with the
+                source file column), otherwise loaded with schema autodetection.
+        """
+        self.storage_client = storage_client
+        self.bq_client = bq_client
+        self.bucket = storage_client.bucket(state_bucket)
+        self.table_id = table_id
+        self.prefix = prefix.rstrip("/")
+        self.window_seconds = window_seconds
+        self.max_files = max_files
+        self.clock = clock
+        self.schema = schema
+        self._lock_generation = None
+
+    def _pending_prefix(self) -> str:
+        return f"{self.prefix}/pending/"
+
+    def add(
+        self,
+        bucket_name: str,
+        file_name: str,
+        generation: str = "0",
+        profile: Optional[dict] = None,
+    ) -> None:
+        """Records an uploaded file as pending, with its optional profile."""
+        uri = f"gs://{bucket_name}/{file_name}"
+        safe_name = re.sub(r"[^a-zA-Z0-9_.-]", "_", f"{bucket_name}/{file_name}")
+        marker = self.bucket.blob(f"{self._pending_prefix()}{safe_name}-{generation}.json")
+        marker.upload_from_string(
+            json.dumps({"uri": uri, "added_at": self.clock(), "profile": profile}),
+            content_type="application/json",
+        )
+        logger.info(f"Pending: {uri}")
+
+    def _pending(self) -> List[dict]:
+        markers = []
+        for blob in self.storage_client.list_blobs(
+            self.bucket, prefix=self._pending_prefix()
+        ):
+            entry = json.loads(blob.download_as_text())
+            entry["blob"] = blob
+            markers.append(entry)
+        return sorted(markers, key=lambda entry: entry["added_at"])
+
+    def is_due(self, pending: List[dict]) -> bool:
+        if not pending:
+            return False
+        if len(pending) >= self.max_files:
+            return True
+        return self.clock() - pending[0]["added_at"] >= self.window_seconds
+
+    def _read_lock(self, lock) -> Optional[Tuple[int, float]]:
+        """The generation of the lock and the time it was taken at, or None if
+        it was released (or replaced) while being read."""
+        from google.api_core import exceptions
+
+        try:
+            lock.reload()
+            generation = lock.generation
+            locked_at = lock.download_as_text(if_generation_match=generation)
+        except (exceptions.NotFound, exceptions.PreconditionFailed):
+            return None
+        return generation, float(locked_at)
+
+    def _acquire_lock(self) -> bool:
+        from google.api_core import exceptions
+
+        lock = self.bucket.blob(f"{self.prefix}/{LOCK_NAME}")
+        try:
+            lock.upload_from_string(str(self.clock()), if_generation_match=0)
+            self._lock_generation = lock.generation
+            return True
+        except exceptions.PreconditionFailed:
+            pass
+        state = self._read_lock(lock)
+        if state is None:
+            return False
+        generation, locked_at = state
+        if self.clock() - locked_at < LOCK_TIMEOUT_SECONDS:
+            return False
+        logger.warning("Breaking a stale flush lock")
+        try:
+            lock.delete(if_generation_match=generation)
+        except (exceptions.NotFound, exceptions.PreconditionFailed):
+            # Another instance broke it first, and may hold a new lock by now
+            return False
+        return self._acquire_lock()
+
+    def _release_lock(self) -> None:
+        from google.api_core import exceptions
+
+        try:
+            self.bucket.blob(f"{self.prefix}/{LOCK_NAME}").delete(
+                if_generation_match=self._lock_generation
+            )
+        except (exceptions.NotFound, exceptions.PreconditionFailed):
+            logger.warning("The flush lock was broken while it was held")
+        self._lock_generation = None
+
+    def flush(self, force: bool = False) -> Optional[Batch]:
+        """Loads the pending files if the batch is due (or `force`).
+
+        Returns:
+            The loaded batch, or None if nothing was flushed.
+        """
+        if not self.is_due(self._pending()) and not force:
+            return None
+        if not self._acquire_lock():
+            logger.info("Another instance is flushing")
+            return None
+        try:
+            # Re-read under the lock: another instance may just have flushed
+            pending = self._pending()
+            if not pending or not (force or self.is_due(pending)):
+                return None
+            uris = [entry["uri"] for entry in pending[: self.max_files]]
+            profiles = tuple(
+                entry["profile"]
+                for entry in pending[: self.max_files]
+                if entry.get("profile")
+            )
+            output_rows = self._load(uris)
+            for entry in pending[: self.max_files]:
+                entry["blob"].delete()
+        finally:
+            self._release_lock()
+
+        return Batch(
+            uris=uris,
+            output_rows=output_rows,
+            table_uri=f"bq://{self.table_id}",
+            profiles=profiles,
+        )
+
+    def _load(self, uris: List[str]) -> int:
+        """Appends all `uris` to the partitioned table with one job."""
+        if self.schema:
+            return ingest.append_files(self.bq_client, self.table_id, uris, self.schema)
+
+        from google.cloud import bigquery
+
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.CSV,
+            autodetect=True,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            time_partitioning=bigquery.TimePartitioning(
+                type_=bigquery.TimePartitioningType.DAY
+            ),
+            schema_update_options=[
+                bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION
+            ],
+        )
+        load_job = self.bq_client.load_table_from_uri(
+            uris, self.table_id, job_config=job_config
+        )
+        load_job.result()
+        logger.info(
+            f"Loaded {load_job.output_rows} rows from {len(uris)} files to {self.table_id}"
+        )
+        return load_job.output_rows
+
+
+def test_coalescer():
+    """200 uploads in a minute become a handful of loads and pipeline runs."""
+    import fakes
+
+    logging.basicConfig(level=logging.INFO)
+    clock = fakes.FakeClock()
+    bq_client = fakes.FakeBigQueryClient()
+    publisher = fakes.FakePublisher()
+    coalescer = Coalescer(
+        fakes.FakeStorageClient(),
+        bq_client,
+        state_bucket="state-bucket",
+        table_id="project.dataset.uploaded_csv_coalesced",
+        window_seconds=120,
+        max_files=50,
+        clock=clock,
+    )
+
+    batches = []
+    for i in range(200):
+        coalescer.add("trigger-bucket", f"data/part-{i:03d}.csv", generation=str(i))
+        clock.advance(0.3)
+        batch = coalescer.flush()
+        if batch:
+            batches.append(batch)
+            publisher.publish("trigger-topic", batch.table_uri.encode("utf-8"))
+    assert [len(b.uris) for b in batches] == [50, 50, 50, 50], batches
+
+    # A partial batch waits for its window, then a periodic flush picks it up
+    for i in range(10):
+        coalescer.add("trigger-bucket", f"data/late-{i}.csv", generation=str(i))
+    assert coalescer.flush() is None
+    clock.advance(120)
+    batch = coalescer.flush()
+    assert batch is not None and len(batch.uris) == 10
+    publisher.publish("trigger-topic", batch.table_uri.encode("utf-8"))
+
+    assert len(bq_client.load_jobs) == 5
+    assert len(publisher.messages) == 5
+    assert all(
+        job["job_config"].write_disposition == "WRITE_APPEND"
+        for job in bq_client.load_jobs
+    )
+    print(f"OK: 210 uploads -> {len(publisher.messages)} pipeline runs")
+
+    # With a declared schema, a batch is a single INSERT ... SELECT _FILE_NAME
+    coalescer.schema = ingest.load_schema()
+    for i in range(50):
+        coalescer.add("trigger-bucket", f"data/typed-{i}.csv", generation=str(i))
+    batch = coalescer.flush()
+    assert batch is not None and batch.output_rows == 5000
+    assert len(bq_client.queries) == 1 and "_FILE_NAME" in bq_client.queries[0]["sql"]
+    print("OK: declared-schema batch appended with its source files")
+
+    # Two instances find the same stale lock: the first one breaks it and takes
+    # a new lock, the second one must not delete that new lock
+    storage_client = fakes.FakeStorageClient()
+    first, second = (
+        Coalescer(
+            storage_client,
+            fakes.FakeBigQueryClient(),
+            state_bucket="state-bucket",
+            table_id="project.dataset.uploaded_csv_coalesced",
+            clock=clock,
+        )
+        for _ in range(2)
+    )
+    lock_name = f"{first.prefix}/{LOCK_NAME}"
+    stale_since = clock() - 2 * LOCK_TIMEOUT_SECONDS
+    first.bucket.blob(lock_name).upload_from_string(str(stale_since))
+    read_lock = second._read_lock
+
+    def read_lock_then_lose_race(lock):
+        state = read_lock(lock)
+        assert first._acquire_lock()
+        return state
+
+    second._read_lock = read_lock_then_lose_race
+    assert not second._acquire_lock()
+    assert first.bucket.generations[lock_name] == first._lock_generation
+    first._release_lock()
+    assert lock_name not in first.bucket.objects
+    print("OK: a stale lock is broken by a single instance")
+
+
+if __name__ == "__main__":
+    test_coalescer()
@@ -0,0 +1,224 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""In-memory stand-ins for the GCS, BigQuery and Pub/Sub clients.
+
+They implement only the calls made by `coalesce.py` and `main.py`, so the
+coalescing logic can be exercised locally without a project.
+"""
+import base64
+import hashlib
+import itertools
+from typing import Dict, List, Optional
+
+from google.api_core import exceptions
+
+
+class FakeBlob:
+    def __init__(self, bucket: "FakeBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+        self.generation: Optional[int] = None
+
+    def _check_generation(self, if_generation_match: Optional[int]) -> None:
+        """Generation 0 stands for an object that does not exist, as in GCS."""
+        current = self.bucket.generation(self.name)
+        if if_generation_match is not None and if_generation_match != current:
+            raise exceptions.PreconditionFailed(
+                f"{self.name} has generation {current}, not {if_generation_match}"
+            )
+
+    def upload_from_string(
+        self, data, content_type: Optional[str] = None, if_generation_match=None
+    ) -> None:
+        self._check_generation(if_generation_match)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.bucket.objects[self.name] = data
+        self.generation = next(self.bucket._generations)
+        self.bucket.generations[self.name] = self.generation
+
+    @property
+    def size(self) -> Optional[int]:
+        data = self.bucket.objects.get(self.name)
+        return None if data is None else len(data)
+
+    @property
+    def md5_hash(self) -> Optional[str]:
+        """Base64-encoded MD5 of the content, as in google-cloud-storage."""
+        data = self.bucket.objects.get(self.name)
+        if data is None:
+            return None
+        return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+    def reload(self) -> None:
+        if self.name not in self.bucket.objects:
+            raise exceptions.NotFound(self.name)
+        self.generation = self.bucket.generation(self.name)
+
+    def download_as_bytes(
+        self,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        if_generation_match: Optional[int] = None,
+    ) -> bytes:
+        if self.name not in self.bucket.objects:
+            raise exceptions.NotFound(self.name)
+        self._check_generation(if_generation_match)
+        self.bucket.downloads += 1
+        self.generation = self.bucket.generation(self.name)
+        data = self.bucket.objects[self.name]
+        # `end` is inclusive, as in google-cloud-storage
+        return data[start or 0 : None if end is None else end + 1]
+
+    def download_as_text(self, if_generation_match: Optional[int] = None) -> str:
+        return self.download_as_bytes(
+            if_generation_match=if_generation_match
+        ).decode("utf-8")
+
+    def exists(self) -> bool:
+        return self.name in self.bucket.objects
+
+    def delete(self, if_generation_match: Optional[int] = None) -> None:
+        if self.name not in self.bucket.objects:
+            raise exceptions.NotFound(self.name)
+        self._check_generation(if_generation_match)
+        del self.bucket.objects[self.name]
+        self.bucket.generations.pop(self.name, None)
+
+
+class FakeBucket:
+    def __init__(self, name: str):
+        self.name = name
+        self.objects: Dict[str, bytes] = {}
+        self.generations: Dict[str, int] = {}
+        self.downloads = 0
+        self._generations = itertools.count(1)
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str) -> Optional[FakeBlob]:
+        if name not in self.objects:
+            return None
+        blob = FakeBlob(self, name)
+        blob.generation = self.generation(name)
+        return blob
+
+    def generation(self, name: str) -> int:
+        """Generation of an object (0: none); objects written directly to
+        `objects` get one on first use."""
+        if name not in self.objects:
+            return 0
+        if name not in self.generations:
+            self.generations[name] = next(self._generations)
+        return self.generations[name]
+
+
+class FakeStorageClient:
+    def __init__(self):
+        self.buckets: Dict[str, FakeBucket] = {}
+
+    def bucket(self, name: str) -> FakeBucket:
+        return self.buckets.setdefault(name, FakeBucket(name))
+
+    def list_blobs(self, bucket, prefix: str = "") -> List[FakeBlob]:
+        if isinstance(bucket, str):
+            bucket = self.bucket(bucket)
+        return [
+            FakeBlob(bucket, name)
+            for name in sorted(bucket.objects)
+            if name.startswith(prefix)
+        ]
+
+
+class FakeLoadJob:
+    def __init__(self, output_rows: int):
+        self.output_rows = output_rows
+
+    def result(self) -> "FakeLoadJob":
+        return self
+
+
+class FakeQueryJob:
+    def __init__(self, num_dml_affected_rows: int):
+        self.num_dml_affected_rows = num_dml_affected_rows
+
+    def result(self) -> "FakeQueryJob":
+        return self
+
+
+class FakeBigQueryClient:
+    """Records the load and query jobs; every source URI counts as
+    `rows_per_file` rows."""
+
+    def __init__(self, rows_per_file: int = 100):
+        self.rows_per_file = rows_per_file
+        self.load_jobs: List[dict] = []
+        self.queries: List[dict] = []
+        self.tables: Dict[str, object] = {}
+
+    def create_table(self, table, exists_ok: bool = False):
+        table_id = f"{table.project}.{table.dataset_id}.{table.table_id}"
+        if table_id in self.tables and not exists_ok:
+            raise exceptions.Conflict(f"Already Exists: {table_id}")
+        self.tables.setdefault(table_id, table)
+        return self.tables[table_id]
+
+    def query(self, sql: str, job_config=None) -> FakeQueryJob:
+        self.queries.append({"sql": sql, "job_config": job_config})
+        source_uris = []
+        for definition in (getattr(job_config, "table_definitions", None) or {}).values():
+            source_uris.extend(definition.source_uris)
+        return FakeQueryJob(self.rows_per_file * len(source_uris))
+
+    def load_table_from_uri(self, source_uris, destination, job_config=None):
+        if isinstance(source_uris, str):
+            source_uris = [source_uris]
+        self.load_jobs.append(
+            {
+                "source_uris": list(source_uris),
+                "destination": destination,
+                "job_config": job_config,
+            }
+        )
+        return FakeLoadJob(self.rows_per_file * len(source_uris))
+
+
+class FakeFuture:
+    def __init__(self, message_id: str):
+        self.message_id = message_id
+
+    def result(self, timeout=None) -> str:
+        return self.message_id
+
+
+class FakePublisher:
+    def __init__(self):
+        self.messages: List[dict] = []
+        self._ids = itertools.count(1)
+
+    def publish(self, topic: str, data: bytes, **attributes) -> FakeFuture:
+        self.messages.append({"topic": topic, "data": data, "attributes": attributes})
+        return FakeFuture(str(next(self._ids)))
+
+
+class FakeClock:
+    def __init__(self, now: float = 1_700_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
@@ -0,0 +1,104 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Appends uploaded CSV files to one partitioned training table.
+
+The CSV columns are declared in `schema.json` instead of being autodetected for
+every file. Each upload is read through a temporary external table and inserted
+into an ingestion-time partitioned table (daily `_PARTITIONTIME`), together with
+two bookkeeping columns:
+
+- `source_file`: the gs:// URI the row came from (`_FILE_NAME`).
+- `ingested_at`: when the row was appended, usable as the trainer's
+  `--watermark_column`.
+
+The trainer drops both columns from the features and can restrict training to
+a window of partitions (`--partition_window_days`, `--partition_start`).
+"""
+import json
+import logging
+import os
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.json")
+SOURCE_FILE_COLUMN = "source_file"
+INGESTED_AT_COLUMN = "ingested_at"
+
+
+# The BigQuery library is imported on first use (see main.py)
+
+
+def load_schema(path: str = SCHEMA_PATH) -> list:
+    """Reads the declared CSV schema (a BigQuery JSON schema) as a list of
+    `bigquery.SchemaField`."""
+    from google.cloud import bigquery
+
+    with open(path) as f:
+        return [bigquery.SchemaField.from_api_repr(field) for field in json.load(f)]
+
+
+def training_table_schema(schema: list) -> list:
+    from google.cloud import bigquery
+
+    return schema + [
+        bigquery.SchemaField(SOURCE_FILE_COLUMN, "STRING"),
+        bigquery.SchemaField(INGESTED_AT_COLUMN, "TIMESTAMP"),
+    ]
+
+
+def ensure_training_table(bq_client, table_id: str, schema: list) -> None:
+    """Creates the ingestion-time partitioned training table if it does not exist."""
+    from google.api_core import exceptions
+    from google.cloud import bigquery
+
+    table = bigquery.Table(table_id, schema=training_table_schema(schema))
+    table.time_partitioning = bigquery.TimePartitioning(
+        type_=bigquery.TimePartitioningType.DAY
+    )
+    try:
+        bq_client.create_table(table)
+        logger.info(f"Created partitioned training table {table_id}")
+    except exceptions.Conflict:
+        pass
+
+
+def append_files(bq_client, table_id: str, uris: List[str], schema: list) -> int:
+    """Appends the CSV files at `uris` to the training table with one query.
+
+    Returns:
+        int: The number of rows inserted.
+    """
+    from google.cloud import bigquery
+
+    ensure_training_table(bq_client, table_id, schema)
+
+    external_config = bigquery.ExternalConfig(bigquery.ExternalSourceFormat.CSV)
+    external_config.source_uris = list(uris)
+    external_config.schema = schema
+    external_config.options.skip_leading_rows = 1
+
+    columns = ", ".join(f"`{field.name}`" for field in schema)
+    sql = (
+        f"INSERT INTO `{table_id}` ({columns}, `{SOURCE_FILE_COLUMN}`, "
+        f"`{INGESTED_AT_COLUMN}`) "
+        f"SELECT {columns}, _FILE_NAME, CURRENT_TIMESTAMP() FROM upload"
+    )
+    job_config = bigquery.QueryJobConfig(table_definitions={"upload": external_config})
+    query_job = bq_client.query(sql, job_config=job_config)
+    query_job.result()
+
+    rows = query_job.num_dml_affected_rows or 0
+    logger.info(f"Appended {rows} rows from {len(uris)} files to {table_id}")
+    return rows
@@ -11,14 +11,18 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import functools
 import os
 import json
 import logging
 from cloudevents.http import CloudEvent
 import functions_framework
-from google.cloud import pubsub_v1, storage, bigquery
 from datetime import datetime
 import re
+import cache_keys
+import coalesce
+import ingest
+import validate
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -40,19 +44,87 @@ TENSORBOARD = os.environ.get("TENSORBOARD")
 REGION = os.environ.get("REGION", "us-central1")
 MACHINE_TYPE = os.environ.get("MACHINE_TYPE", "n1-standard-4")
 MODEL_CHECKPOINT_DIR = os.environ.get("MODEL_CHECKPOINT_DIR")
+# Continue boosting the checkpoint on new rows only (see trainer/incremental.py).
+# New rows of a table that is appended to are found by their ingested_at column,
+# which only INGESTION_MODE=partitioned adds, so it is required
+INCREMENTAL_TRAINING = os.environ.get("INCREMENTAL_TRAINING", "false").lower() == "true"
+# XGBoost tree method and histogram bins used by the trainer
+TREE_METHOD = os.environ.get("TREE_METHOD", "hist")
+MAX_BIN = os.environ.get("MAX_BIN", "256")
+# More than one replica trains a single model across replicas (--distributed)
+REPLICA_COUNT = int(os.environ.get("REPLICA_COUNT", "1"))
+if INCREMENTAL_TRAINING and REPLICA_COUNT > 1:
+    raise ValueError(
+        "INCREMENTAL_TRAINING cannot be combined with REPLICA_COUNT > 1, the "
+        "trainer does not continue a checkpoint across replicas"
+    )
+# Coalescing mode: buffer uploads and append them to one partitioned table in
+# batches, with one pipeline run per batch (see coalesce.py)
+COALESCE_UPLOADS = os.environ.get("COALESCE_UPLOADS", "false").lower() == "true"
+COALESCE_WINDOW_SECONDS = float(os.environ.get("COALESCE_WINDOW_SECONDS", "300"))
+COALESCE_MAX_FILES = int(os.environ.get("COALESCE_MAX_FILES", "50"))
+# Must not be the trigger bucket, the markers would trigger this function
+COALESCE_STATE_BUCKET = os.environ.get(
+    "COALESCE_STATE_BUCKET",
+    PIPELINE_ROOT.replace("gs://", "").split("/")[0] if PIPELINE_ROOT else None,
+)
+COALESCE_TABLE = os.environ.get("COALESCE_TABLE", f"{TABLE_PREFIX}coalesced")
+# table_per_file: one autodetected table per upload (default).
+# partitioned: append every upload to TRAINING_TABLE with the declared schema
+# of schema.json and a source_file column (see ingest.py)
+INGESTION_MODE = os.environ.get("INGESTION_MODE", "table_per_file")
+TRAINING_TABLE = os.environ.get("TRAINING_TABLE", "training_data")
+if INCREMENTAL_TRAINING and INGESTION_MODE != "partitioned":
+    raise ValueError(
+        "INCREMENTAL_TRAINING requires INGESTION_MODE=partitioned, the trainer "
+        "finds the new rows of a table by their ingested_at column"
+    )
+# Only train on the most recent partitions of TRAINING_TABLE (0: all)
+TRAINING_WINDOW_DAYS = int(os.environ.get("TRAINING_WINDOW_DAYS", "0"))
+# Reuse the cached dataset, training and evaluation steps of a run with the
+# same data, checkpoint, training arguments and image (see cache_keys.py). If
+# that run's model is still deployed, upload, comparison, deployment and load
+# test are skipped too, so a re-uploaded file finishes in seconds
+STEP_CACHING = os.environ.get("STEP_CACHING", "true").lower() == "true"
+# Reject malformed CSV files before loading them, and attach their profile to
+# the trigger message (see validate.py)
+VALIDATE_UPLOADS = os.environ.get("VALIDATE_UPLOADS", "true").lower() == "true"
+VALIDATION_MAX_BYTES = int(
+    os.environ.get("VALIDATION_MAX_BYTES", str(validate.DEFAULT_MAX_BYTES))
+)
+
+
+# Clients are created on first use and reused by warm invocations; importing
+# the Google Cloud libraries at module load would slow down every cold start
+@functools.lru_cache(maxsize=None)
+def get_publisher():
+    from google.cloud import pubsub_v1
+
+    return pubsub_v1.PublisherClient()
 
 
-# Initialize clients
-publisher = pubsub_v1.PublisherClient()
-storage_client = storage.Client(project=PROJECT_ID)
-bq_client = bigquery.Client(project=PROJECT_ID)
+@functools.lru_cache(maxsize=None)
+def get_storage_client():
+    from google.cloud import storage
+
+    return storage.Client(project=PROJECT_ID)
+
+
+@functools.lru_cache(maxsize=None)
+def get_bq_client():
+    from google.cloud import bigquery
+
+    return bigquery.Client(project=PROJECT_ID)
 
 
 def upload_to_bigquery(bucket_name, file_name):
     """Uploads a CSV file from Cloud Storage to BigQuery."""
+    from google.cloud import bigquery
+
     logger.info(f"Starting BigQuery upload for gs://{bucket_name}/{file_name}")
+    bq_client = get_bq_client()
 
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_storage_client().bucket(bucket_name)
     blob = bucket.blob(file_name)
     uri = f"gs://{bucket_name}/{file_name}"  # Correct URI
 
@@ -71,9 +143,11 @@ def upload_to_bigquery(bucket_name, file_name):
     dataset_ref = bq_client.dataset(BQ_DATASET)
     table_ref = dataset_ref.table(table_name)
 
+    # A re-upload replaces the table, so it always holds exactly this file
     job_config = bigquery.LoadJobConfig(
         source_format=bigquery.SourceFormat.CSV,
         autodetect=True,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
     )
 
     load_job = bq_client.load_table_from_uri(uri, table_ref, job_config=job_config)
@@ -83,26 +157,111 @@ def upload_to_bigquery(bucket_name, file_name):
     return f"bq://{PROJECT_ID}.{BQ_DATASET}.{table_name}"  # Correct BigQuery URI
 
 
-def trigger_pipeline(bq_table_uri):
-    """Triggers the Vertex AI pipeline with the BigQuery table URI."""
-
-    pipeline_root = f"{PIPELINE_ROOT}/pipeline_triggered_via_storage/{datetime.now().strftime('%Y%m%d%H%M%S')}"
-    worker_pool_specs = [
-        {
-            "machine_spec": {"machine_type": MACHINE_TYPE},
-            "replica_count": 1,
-            "container_spec": {
-                "image_uri": TRAINING_CONTAINER_IMAGE_URI,
-                "command": ["python", "train.py"],
-                "args": [
-                    "--data_path",
-                    bq_table_uri,
-                    "--model_checkpoint_dir",
-                    MODEL_CHECKPOINT_DIR,
-                ],
-            },
-        }
+def append_to_training_table(bucket_name, file_name):
+    """Appends a CSV file to the partitioned training table (INGESTION_MODE=partitioned)."""
+    uri = f"gs://{bucket_name}/{file_name}"
+    if not file_name.lower().endswith(".csv"):
+        logger.error(f"Not a CSV file: {uri}")
+        return None
+    if not get_storage_client().bucket(bucket_name).blob(file_name).exists():
+        logger.error(f"File not found: {uri}")
+        return None
+
+    table_id = f"{PROJECT_ID}.{BQ_DATASET}.{TRAINING_TABLE}"
+    ingest.append_files(get_bq_client(), table_id, [uri], ingest.load_schema())
+    return f"bq://{table_id}"
+
+
+def validate_upload(bucket_name, file_name):
+    """Validates and profiles an uploaded CSV file, streaming it from GCS.
+
+    Returns:
+        validate.ValidationResult: Errors, if any, and the profile.
+    """
+    blob = get_storage_client().bucket(bucket_name).blob(file_name)
+    schema = ingest.load_schema() if INGESTION_MODE == "partitioned" else None
+    result = validate.validate_object(
+        blob, schema=schema, max_bytes=VALIDATION_MAX_BYTES
+    )
+    uri = f"gs://{bucket_name}/{file_name}"
+    if result.ok:
+        logger.info(f"Validated {uri}: {result.profile.rows} rows")
+    else:
+        logger.error(f"Rejected {uri}: {'; '.join(result.errors)}")
+    return result
+
+
+def cached_pipeline_root(cache_key: str) -> str:
+    return f"{PIPELINE_ROOT}/pipeline_cached/{cache_key[:16]}"
+
+
+def trigger_pipeline(bq_table_uri, data_fingerprint=None, data_profile=None):
+    """Triggers the Vertex AI pipeline with the BigQuery table URI.
+
+    Args:
+        bq_table_uri (str): The training data.
+        data_fingerprint (str, optional): Content fingerprint of the training data
+            (see cache_keys.py). If given, and STEP_CACHING is enabled, the run
+            reuses the cached steps of a previous run with the same inputs.
+        data_profile (dict, optional): Profile of the uploaded data (see
+            validate.py), passed along in the message for drift checks.
+    """
+    training_args = [
+        "--data_path",
+        bq_table_uri,
+        "--model_checkpoint_dir",
+        MODEL_CHECKPOINT_DIR,
+        "--tree_method",
+        TREE_METHOD,
+        "--max_bin",
+        MAX_BIN,
     ]
+    if INCREMENTAL_TRAINING:
+        # Only the rows appended since the last run are read
+        training_args += [
+            "--incremental",
+            "--watermark_column",
+            ingest.INGESTED_AT_COLUMN,
+        ]
+    if REPLICA_COUNT > 1:
+        training_args.append("--distributed")
+    if INGESTION_MODE == "partitioned" and TRAINING_WINDOW_DAYS:
+        training_args += ["--partition_window_days", str(TRAINING_WINDOW_DAYS)]
+
+    worker_pool_spec = {
+        "machine_spec": {"machine_type": MACHINE_TYPE},
+        "replica_count": 1,
+        "container_spec": {
+            "image_uri": TRAINING_CONTAINER_IMAGE_URI,
+            "command": ["python", "train.py"],
+            "args": training_args,
+        },
+    }
+    worker_pool_specs = [worker_pool_spec]
+    if REPLICA_COUNT > 1:
+        # workerpool0 holds the single rank 0 replica, the others go to workerpool1
+        worker_pool_specs.append(
+            dict(worker_pool_spec, replica_count=REPLICA_COUNT - 1)
+        )
+
+    cache_key = None
+    if STEP_CACHING and data_fingerprint:
+        pinned_specs = cache_keys.pin_training_image(worker_pool_specs)
+        if pinned_specs:
+            cache_key, worker_pool_specs = cache_keys.run_cache_key(
+                get_storage_client(),
+                data_fingerprint,
+                MODEL_CHECKPOINT_DIR,
+                pinned_specs,
+                lambda key: f"{cached_pipeline_root(key)}/model",
+            )
+
+    if cache_key:
+        # Same inputs, same pipeline root: the cached steps' outputs are reused
+        pipeline_root = cached_pipeline_root(cache_key)
+        logger.info(f"Step cache key {cache_key}")
+    else:
+        pipeline_root = f"{PIPELINE_ROOT}/pipeline_triggered_via_storage/{datetime.now().strftime('%Y%m%d%H%M%S')}"
 
     pipeline_parameters = {
         "project": PROJECT_ID,
@@ -123,6 +282,11 @@ def trigger_pipeline(bq_table_uri):
         "existing_model": None,
         "parent_model_resource_name": None,
         "bq_training_data_uri": bq_table_uri,
+        "dataset_display_name": (
+            f"pipeline_dataset_{cache_key[:16]}" if cache_key else "pipeline_dataset"
+        ),
+        # Shared by all runs: each deployment is compared to the previous one
+        "load_test_baseline_uri": f"{PIPELINE_ROOT}/load_test/baseline.json",
     }
 
     request_data = {
@@ -133,16 +297,67 @@ def trigger_pipeline(bq_table_uri):
         "persistent_resource_name": PERSISTENT_RESOURCE_NAME,
         "pipeline_template_path": ARTIFACT_REGISTRY_REPO_KFP_URI,
         "service_account": RUNNER_SERVICE_ACCOUNT_EMAIL,
-        "enable_caching": False,
+        # None: per-step caching options of the compiled pipeline apply
+        "enable_caching": None if cache_key else False,
     }
+    if data_profile:
+        request_data["data_profile"] = data_profile
 
     message_json = json.dumps(request_data)
-    future = publisher.publish(
+    future = get_publisher().publish(
         TRIGGER_PIPELINE_PUBSUB_TOPIC, message_json.encode("utf-8")
     )
     print(f"Published message ID: {future.result()} to {TRIGGER_PIPELINE_PUBSUB_TOPIC}")
 
 
+def get_coalescer() -> coalesce.Coalescer:
+    partitioned = INGESTION_MODE == "partitioned"
+    return coalesce.Coalescer(
+        get_storage_client(),
+        get_bq_client(),
+        state_bucket=COALESCE_STATE_BUCKET,
+        table_id=f"{PROJECT_ID}.{BQ_DATASET}."
+        f"{TRAINING_TABLE if partitioned else COALESCE_TABLE}",
+        window_seconds=COALESCE_WINDOW_SECONDS,
+        max_files=COALESCE_MAX_FILES,
+        schema=ingest.load_schema() if partitioned else None,
+    )
+
+
+def table_data_fingerprint(bq_table_uri: str) -> str:
+    """Fingerprint of the rows a run on a shared, appended table trains on."""
+    fingerprint = cache_keys.table_fingerprint(get_bq_client(), bq_table_uri)
+    if TRAINING_WINDOW_DAYS:
+        # The partition window moves every day
+        fingerprint += f":{datetime.utcnow().date().isoformat()}"
+    return fingerprint
+
+
+def flush_and_trigger(coalescer: coalesce.Coalescer) -> str:
+    """Loads the pending batch if it is due and triggers one pipeline run for it."""
+    batch = coalescer.flush()
+    if batch is None:
+        return "Pending"
+    logger.info(f"Flushed {len(batch.uris)} files ({batch.output_rows} rows)")
+    data_profile = None
+    if batch.profiles:
+        merged = validate.CsvProfile.from_dict(batch.profiles[0])
+        for profile in batch.profiles[1:]:
+            merged.merge(validate.CsvProfile.from_dict(profile))
+        data_profile = merged.to_dict()
+    trigger_pipeline(
+        batch.table_uri, table_data_fingerprint(batch.table_uri), data_profile
+    )
+    return "Success!"
+
+
+@functions_framework.http
+def flush_pending(request) -> str:
+    """Flushes a batch whose window expired. Meant to be called periodically,
+    e.g. by Cloud Scheduler, when COALESCE_UPLOADS is enabled."""
+    return flush_and_trigger(get_coalescer())
+
+
 @functions_framework.cloud_event
 def main(cloud_event: CloudEvent) -> str:
 
@@ -150,10 +365,36 @@ def main(cloud_event: CloudEvent) -> str:
     bucket_name = data.get("bucket")
     file_name = data.get("name")
 
-    bq_table_uri = upload_to_bigquery(bucket_name, file_name)
+    if not file_name.lower().endswith(".csv"):
+        logger.error(f"Not a CSV file: gs://{bucket_name}/{file_name}")
+        return "Failed: Not a CSV file or file not found."
+
+    data_profile = None
+    if VALIDATE_UPLOADS:
+        validation = validate_upload(bucket_name, file_name)
+        if not validation.ok:
+            return f"Failed: Invalid CSV file: {'; '.join(validation.errors)}"
+        data_profile = validation.profile.to_dict()
+
+    if COALESCE_UPLOADS:
+        coalescer = get_coalescer()
+        coalescer.add(
+            bucket_name,
+            file_name,
+            generation=data.get("generation", "0"),
+            profile=data_profile,
+        )
+        return flush_and_trigger(coalescer)
+
+    if INGESTION_MODE == "partitioned":
+        bq_table_uri = append_to_training_table(bucket_name, file_name)
+        data_fingerprint = bq_table_uri and table_data_fingerprint(bq_table_uri)
+    else:
+        bq_table_uri = upload_to_bigquery(bucket_name, file_name)
+        data_fingerprint = cache_keys.object_fingerprint(data)
 
     if bq_table_uri:
-        trigger_pipeline(bq_table_uri)
+        trigger_pipeline(bq_table_uri, data_fingerprint, data_profile)
         return "Success!"
     else:
         return "Failed: Not a CSV file or file not found."
@@ -210,7 +451,10 @@ def test_main():
     result = main(cloud_event)
 
     # Verify the result
-    assert result == "Success!"
+    if COALESCE_UPLOADS:
+        assert result in ("Success!", "Pending")
+    else:
+        assert result == "Success!"
 
 
 if __name__ == "__main__":
@@ -0,0 +1,396 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Streaming validation and profiling of uploaded CSV files.
+
+The object is read with ranged downloads of `chunk_size` bytes and parsed row by
+row, so memory stays bounded by one chunk plus the per-column statistics,
+whatever the size of the file. A file is rejected as soon as `max_errors`
+problems are found:
+
+- a missing or empty header, duplicate column names, a missing target column,
+  or columns that differ from the declared schema,
+- a row with a different number of fields than the header,
+- a value that does not parse as a number in a numeric column,
+- an empty target.
+
+Files larger than `max_bytes` are only validated and profiled up to that
+offset (the profile is then marked as sampled).
+
+`CsvProfile` (row count, null rates, min, max and mean per column and the
+target class counts) is attached to the pipeline trigger message, for later
+drift checks. Profiles of several files merge (see `coalesce.py`).
+"""
+import codecs
+import csv
+import math
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_ERRORS = 10
+TARGET_COLUMN = "target"
+NUMERIC_TYPES = {"FLOAT", "FLOAT64", "INTEGER", "INT64", "NUMERIC", "BIGNUMERIC"}
+# Distinct target values kept in the profile
+MAX_TARGET_VALUES = 100
+
+
+def iter_object_chunks(
+    blob, chunk_size: int = DEFAULT_CHUNK_SIZE, max_bytes: Optional[int] = None
+) -> Iterator[bytes]:
+    """Downloads a GCS object with ranged reads of `chunk_size` bytes."""
+    if blob.size is None:
+        blob.reload()
+    size = blob.size if not max_bytes else min(blob.size, max_bytes)
+    for start in range(0, size, chunk_size):
+        end = min(start + chunk_size, size) - 1  # inclusive
+        yield blob.download_as_bytes(start=start, end=end)
+
+
+def iter_lines(
+    chunks: Iterator[bytes], encoding: str = "utf-8", truncated: bool = False
+) -> Iterator[str]:
+    """Splits decoded chunks into lines, carrying partial lines over.
+
+    Lines end at "\n" only (with an optional "\r" kept before it), like
+    BigQuery's; other line boundaries of `str.splitlines` stay inside values.
+    A quoted value spanning lines is reassembled by `csv.reader`. If the chunks
+    are `truncated`, a character cut at the end is dropped, not an error.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="strict")
+    pending = ""
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        # The last line may continue in the next chunk
+        pending = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if not truncated:
+        pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+class ColumnStats:
+    def __init__(self):
+        self.count = 0
+        self.nulls = 0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.total = 0.0
+
+    def update(self, value: Optional[float]) -> None:
+        self.count += 1
+        if value is None:
+            self.nulls += 1
+            return
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+        self.total += value
+
+    def merge(self, other: "ColumnStats") -> None:
+        self.count += other.count
+        self.nulls += other.nulls
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.total += other.total
+
+    def to_dict(self) -> Dict[str, Any]:
+        values = self.count - self.nulls
+        return {
+            "null_rate": self.nulls / self.count if self.count else 0.0,
+            "min": self.minimum if values else None,
+            "max": self.maximum if values else None,
+            "mean": self.total / values if values else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], count: int) -> "ColumnStats":
+        stats = cls()
+        stats.count = count
+        stats.nulls = round(data["null_rate"] * count)
+        if data["min"] is not None:
+            stats.minimum = data["min"]
+            stats.maximum = data["max"]
+            stats.total = data["mean"] * (count - stats.nulls)
+        return stats
+
+
+class CsvProfile:
+    """Mergeable per-column statistics of one or more CSV files."""
+
+    def __init__(self, columns: List[str], target_column: str = TARGET_COLUMN):
+        self.columns = list(columns)
+        self.target_column = target_column
+        self.rows = 0
+        self.bytes = 0
+        self.sampled = False
+        self.stats = {column: ColumnStats() for column in columns}
+        self.target_counts: Dict[str, int] = {}
+
+    def update_target(self, value: str, count: int = 1) -> None:
+        if value in self.target_counts or len(self.target_counts) < MAX_TARGET_VALUES:
+            self.target_counts[value] = self.target_counts.get(value, 0) + count
+
+    def merge(self, other: "CsvProfile") -> "CsvProfile":
+        self.rows += other.rows
+        self.bytes += other.bytes
+        self.sampled = self.sampled or other.sampled
+        for column, stats in other.stats.items():
+            if column not in self.stats:
+                self.columns.append(column)
+                self.stats[column] = ColumnStats()
+            self.stats[column].merge(stats)
+        for value, count in other.target_counts.items():
+            self.update_target(value, count)
+        return self
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "sampled": self.sampled,
+            "columns": {column: self.stats[column].to_dict() for column in self.columns},
+            "target_counts": dict(sorted(self.target_counts.items())),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "CsvProfile":
+        profile = cls(list(data["columns"]))
+        profile.rows = data["rows"]
+        profile.bytes = data["bytes"]
+        profile.sampled = data["sampled"]
+        profile.stats = {
+            column: ColumnStats.from_dict(stats, data["rows"])
+            for column, stats in data["columns"].items()
+        }
+        profile.target_counts = dict(data["target_counts"])
+        return profile
+
+
+class ValidationResult(NamedTuple):
+    errors: List[str]
+    profile: Optional[CsvProfile]
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+def _parse_number(value: str) -> Optional[float]:
+    value = value.strip()
+    if not value:
+        return None
+    number = float(value)
+    if math.isnan(number):
+        return None
+    return number
+
+
+def validate_csv(
+    lines: Iterator[str],
+    schema: Optional[list] = None,
+    target_column: str = TARGET_COLUMN,
+    max_errors: int = DEFAULT_MAX_ERRORS,
+    truncated: bool = False,
+) -> ValidationResult:
+    """Validates and profiles CSV lines.
+
+    Args:
+        lines: The lines of the file, e.g. from `iter_lines`.
+        schema: Declared columns (`bigquery.SchemaField`s, see ingest.py). The
+            header must match their names, and only the numeric ones must parse
+            as numbers. Without a schema every column must be numeric, as the
+            trainer expects.
+        target_column: Column holding the label, must be present and non-empty.
+        max_errors: Stop reading after this many errors.
+        truncated: The lines are a prefix of the file; the last row, most
+            likely cut, is not parsed.
+    """
+    reader = csv.reader(lines)
+    try:
+        header = [name.strip() for name in next(reader)]
+    except StopIteration:
+        return ValidationResult(["The file is empty"], None)
+    except (csv.Error, UnicodeDecodeError) as e:
+        return ValidationResult([f"Unreadable header: {e}"], None)
+
+    errors = []
+    if not any(header):
+        errors.append("Empty header")
+    duplicates = sorted({name for name in header if header.count(name) > 1})
+    if duplicates:
+        errors.append(f"Duplicate columns: {duplicates}")
+    if target_column not in header:
+        errors.append(f"Missing target column '{target_column}'")
+    if schema:
+        expected = [field.name for field in schema]
+        if header != expected:
+            errors.append(f"Columns {header} do not match the schema {expected}")
+        numeric = {
+            field.name for field in schema if field.field_type.upper() in NUMERIC_TYPES
+        }
+    else:
+        numeric = set(header)
+    if errors:
+        return ValidationResult(errors, None)
+
+    profile = CsvProfile(header, target_column)
+    target_index = header.index(target_column)
+    numeric_columns = [(i, name) for i, name in enumerate(header) if name in numeric]
+    # Line numbers are read before the next row is, see _drop_last
+    rows = ((reader.line_num, row) for row in reader)
+    if truncated:
+        rows = _drop_last(rows)
+    try:
+        for line, row in rows:
+            if not row:
+                continue
+            if len(row) != len(header):
+                errors.append(
+                    f"Line {line}: {len(row)} fields, the header has {len(header)}"
+                )
+            else:
+                profile.rows += 1
+                for i, name in numeric_columns:
+                    try:
+                        profile.stats[name].update(_parse_number(row[i]))
+                    except ValueError:
+                        errors.append(
+                            f"Line {line}: '{row[i]}' in {name} is not a number"
+                        )
+                target = row[target_index].strip()
+                if not target:
+                    errors.append(f"Line {line}: empty {target_column}")
+                else:
+                    profile.update_target(target)
+            if len(errors) >= max_errors:
+                errors.append(f"Stopped after {max_errors} errors")
+                break
+    except (csv.Error, UnicodeDecodeError) as e:
+        errors.append(f"Line {reader.line_num}: {e}")
+
+    if not errors and profile.rows == 0:
+        errors.append("The file has a header but no rows")
+    return ValidationResult(errors, profile)
+
+
+def validate_object(
+    blob,
+    schema: Optional[list] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+    max_errors: int = DEFAULT_MAX_ERRORS,
+) -> ValidationResult:
+    """Validates and profiles a CSV object of GCS, streaming it in chunks."""
+    blob.reload()
+    sampled = bool(max_bytes) and blob.size > max_bytes
+    lines = iter_lines(
+        iter_object_chunks(blob, chunk_size=chunk_size, max_bytes=max_bytes),
+        truncated=sampled,
+    )
+    result = validate_csv(
+        lines, schema=schema, max_errors=max_errors, truncated=sampled
+    )
+    if result.profile:
+        result.profile.bytes = blob.size
+        result.profile.sampled = sampled
+    return result
+
+
+def _drop_last(items: Iterator[Any]) -> Iterator[Any]:
+    previous = None
+    for item in items:
+        if previous is not None:
+            yield previous
+        previous = item
+
+
+def test_validate():
+    """Validates good and malformed files against in-memory GCS objects."""
+    import os
+    import time
+    import types
+
+    import fakes
+
+    sample_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "sample.csv"
+    )
+    with open(sample_path, "rb") as f:
+        sample = f.read()
+    bucket = fakes.FakeStorageClient().bucket("trigger-bucket")
+
+    def check(data: bytes, **kwargs) -> ValidationResult:
+        bucket.objects["upload.csv"] = data
+        return validate_object(bucket.blob("upload.csv"), **kwargs)
+
+    # Tiny chunks: rows are split across ranged reads
+    result = check(sample, chunk_size=7)
+    rows = sample.count(b"\n") - 1
+    assert result.ok and result.profile.rows == rows, result
+    assert bucket.downloads == -(-len(sample) // 7)
+    assert result.profile.to_dict()["columns"]["target"]["null_rate"] == 0.0
+
+    header, first_row = sample.split(b"\n")[:2]
+    assert check(b"").errors == ["The file is empty"]
+    assert "Missing target" in check(b"a,b\n1,2\n").errors[0]
+    assert "fields" in check(header + b"\n" + first_row + b",1\n").errors[0]
+    assert "not a number" in check(header + b"\n" + first_row.replace(b",", b",x", 1) + b"\n").errors[0]
+    assert "empty target" in check(header + b"\n" + first_row.rsplit(b",", 1)[0] + b",\n").errors[0]
+
+    # Only "\n" ends a line: quoted values may hold line breaks and other
+    # characters str.splitlines splits on, and "\r\n" endings are accepted
+    schema = [
+        types.SimpleNamespace(name=name, field_type=field_type)
+        for name, field_type in [("comment", "STRING"), ("target", "INTEGER")]
+    ]
+    quoted = (
+        'comment,target\r\n"two\nlines",1\r\n"a\x0cb\x1ec\x85d\u2028e",0\r\n'
+        '"\r\n",1\r\n'
+    ).encode("utf-8")
+    for chunk_size in (3, len(quoted)):
+        result = check(quoted, schema=schema, chunk_size=chunk_size)
+        assert result.ok and result.profile.rows == 3, result
+    # Sampled: the prefix ends inside a quoted value
+    multiline = b"comment,target\n" + b'"a\nb",1\n' * 200
+    result = check(multiline, schema=schema, max_bytes=333)
+    assert result.ok and result.profile.sampled, result
+
+    # The sample may end inside a multi-byte character
+    accents = "comment,target\n" + '"é€",1\n' * 100
+    for max_bytes in range(200, 206):
+        result = check(accents.encode("utf-8"), schema=schema, max_bytes=max_bytes)
+        assert result.ok and result.profile.sampled, (max_bytes, result)
+
+    # A bad multi-MB file is rejected after max_errors rows, not at the end
+    bad_rows = (first_row + b",1\n") * 200_000
+    start = time.perf_counter()
+    result = check(header + b"\n" + bad_rows, max_errors=5)
+    assert len(result.errors) == 6 and time.perf_counter() - start < 1.0
+
+    # Past max_bytes only a prefix is profiled
+    big = header + b"\n" + (first_row + b"\n") * 50_000
+    result = check(big, max_bytes=100_000, chunk_size=32_768)
+    assert result.ok and result.profile.sampled and 0 < result.profile.rows < 50_000
+
+    # Profiles of several files merge, e.g. for a coalesced batch
+    merged = CsvProfile.from_dict(check(sample).profile.to_dict())
+    merged.merge(CsvProfile.from_dict(check(sample).profile.to_dict()))
+    assert merged.rows == 2 * rows
+    print("OK:", {k: v for k, v in check(sample).profile.to_dict().items() if k != "columns"})
+
+
+if __name__ == "__main__":
+    test_validate()
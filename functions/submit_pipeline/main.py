@@ -12,11 +12,77 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+"""Submits the pipeline jobs requested by Pub/Sub messages.
+
+A message holds one submission:
+
+    {"project_id": ..., "location": ..., "pipeline_root": ...,
+     "pipeline_parameters": {...}, "persistent_resource_name": ...,
+     "pipeline_template_path": ..., "service_account": ..., "enable_caching": ...}
+
+or, with a "batch" list, many: each item overrides the fields of the message
+(its "pipeline_parameters" are merged into the message's), e.g. one item per
+customer segment or hyperparameter candidate. The jobs of a batch are submitted
+concurrently, at most "max_concurrency" at a time.
+"""
 import submit_pipeline_job
 import functions_framework
 import json
 import base64
 
+REQUIRED_FIELDS = [
+    "project_id",
+    "location",
+    "pipeline_root",
+    "pipeline_parameters",
+    "pipeline_template_path",
+    "service_account",
+]
+
+
+def to_submission(request_data, item=None):
+    """Keyword arguments of `submit_pipeline_job_with_persistent_resource` for
+    a message, or for one item of a batch message."""
+    fields = dict(request_data)
+    fields.pop("batch", None)
+    fields.pop("max_concurrency", None)
+    if item:
+        parameters = dict(fields.get("pipeline_parameters") or {})
+        parameters.update(item.get("pipeline_parameters") or {})
+        fields.update(item)
+        fields["pipeline_parameters"] = parameters
+
+    # Verify required parameters (Keep this check)
+    missing = [field for field in REQUIRED_FIELDS if not fields.get(field)]
+    if missing:
+        raise ValueError(f"Missing required parameters in Pub/Sub message: {missing}")
+
+    return {
+        "project_id": fields["project_id"],
+        "location": fields["location"],
+        "pipeline_root": fields["pipeline_root"],
+        "pipeline_parameters": fields["pipeline_parameters"],
+        "pipeline_template_path": fields["pipeline_template_path"],
+        "service_account": fields["service_account"],
+        "enable_caching": fields.get("enable_caching", False),
+        "persistent_resource_name": fields.get("persistent_resource_name"),
+    }
+
+
+def submit_batch(request_data):
+    """Submits every item of a batch message; returns the per-item results."""
+    submissions = [to_submission(request_data, item) for item in request_data["batch"]]
+    results = submit_pipeline_job.submit_pipeline_jobs(
+        submissions,
+        max_concurrency=request_data.get(
+            "max_concurrency", submit_pipeline_job.MAX_CONCURRENT_SUBMISSIONS
+        ),
+    )
+    for result in results:
+        status = result.name if result.ok else f"FAILED {result.error}"
+        print(f"Batch item {result.index}: {status} ({result.seconds:.2f}s)")
+    return results
+
 
 @functions_framework.cloud_event
 def main(cloud_event, test_json=None):
@@ -34,40 +100,20 @@ def main(cloud_event, test_json=None):
         else:
             request_data = test_json
 
-        # Access parameters directly from request_data
-        project_id = request_data.get("project_id")
-        location = request_data.get("location")
-        pipeline_root = request_data.get("pipeline_root")
-        pipeline_parameters = request_data.get("pipeline_parameters")
-        persistent_resource_name = request_data.get("persistent_resource_name")
-        pipeline_template_path = request_data.get("pipeline_template_path")
-        service_account = request_data.get("service_account")
-        enable_caching = request_data.get("enable_caching", False)
-
-        # Verify required parameters (Keep this check)
-        if not all(
-            [
-                project_id,
-                location,
-                pipeline_root,
-                pipeline_parameters,
-                pipeline_template_path,
-                service_account,
-            ]
-        ):
-            raise ValueError("Missing required parameters in Pub/Sub message.")
-
-        # Submit the pipeline job (Assuming submit_pipeline_job is defined elsewhere)
+        if request_data.get("batch"):
+            results = submit_batch(request_data)
+            failed = [result.index for result in results if not result.ok]
+            # Not raised: a redelivered message would resubmit the successful items
+            if failed:
+                return (
+                    f"Submitted {len(results) - len(failed)}/{len(results)} "
+                    f"pipeline jobs, failed items: {failed}",
+                    500,
+                )
+            return (f"Submitted {len(results)} pipeline jobs successfully", 200)
 
         submit_pipeline_job.submit_pipeline_job_with_persistent_resource(
-            project_id=project_id,
-            location=location,
-            pipeline_root=pipeline_root,
-            pipeline_parameters=pipeline_parameters,
-            pipeline_template_path=pipeline_template_path,
-            service_account=service_account,
-            enable_caching=enable_caching,
-            persistent_resource_name=persistent_resource_name,
+            **to_submission(request_data)
         )
         return (
             f"Pipeline job submitted successfully",
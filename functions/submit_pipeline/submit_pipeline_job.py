@@ -11,12 +11,148 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+"""Submits pipeline jobs that run on a persistent resource.
 
-from google.cloud import aiplatform as vertex
-import json
-from google.auth import default
-from google.auth.transport.requests import AuthorizedSession
+The request is built directly from the compiled pipeline template, without
+`vertex.init` and an `aiplatform.PipelineJob`. Everything that does not depend
+on the submission is set up once per process and reused by warm invocations:
+
+- the credentials and the pooled `AuthorizedSession` (which refreshes the
+  access token when it expires),
+- the parsed templates, keyed by `pipeline_template_path`. Templates behind a
+  mutable reference (an Artifact Registry tag such as `latest`) are fetched
+  again after `TEMPLATE_CACHE_TTL_SECONDS`.
+
+Only light modules are imported at module load; google-auth and requests
+are imported by the first submission.
+
+`submit_pipeline_jobs` submits many jobs concurrently over the shared session.
+Every submission is retried with exponential backoff on 429 and 5xx responses;
+the job ID is chosen by the client, so a retried request whose first attempt
+did create the job does not create a second one.
+"""
+import concurrent.futures
+import copy
 import json
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import yaml
+
+API_ENDPOINT = "https://{location}-aiplatform.googleapis.com/v1beta1"
+TEMPLATE_CACHE_TTL_SECONDS = float(os.environ.get("TEMPLATE_CACHE_TTL_SECONDS", "300"))
+DISPLAY_NAME = "pipeline_via_storage_function"
+MAX_CONCURRENT_SUBMISSIONS = int(os.environ.get("MAX_CONCURRENT_SUBMISSIONS", "8"))
+MAX_ATTEMPTS = int(os.environ.get("SUBMIT_MAX_ATTEMPTS", "5"))
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_lock = threading.Lock()
+_session = None
+# pipeline_template_path -> (fetched at, parsed template)
+_templates: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+
+def get_session():
+    """The process-wide authorized session, created on first use."""
+    global _session
+    with _lock:
+        if _session is None:
+            import requests
+            from google.auth import default
+            from google.auth.transport.requests import AuthorizedSession
+
+            credentials, _ = default(
+                scopes=["https://www.googleapis.com/auth/cloud-platform"]
+            )
+            _session = AuthorizedSession(credentials)
+            # One pooled connection per concurrent submission
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=MAX_CONCURRENT_SUBMISSIONS
+            )
+            _session.mount("https://", adapter)
+        return _session
+
+
+def _fetch_template(pipeline_template_path: str) -> Dict[str, Any]:
+    if pipeline_template_path.startswith(("https://", "http://")):
+        response = get_session().get(pipeline_template_path)
+        response.raise_for_status()
+        return yaml.safe_load(response.content)
+    if pipeline_template_path.startswith("gs://"):
+        response = get_session().get(
+            "https://storage.googleapis.com/" + pipeline_template_path[len("gs://") :]
+        )
+        response.raise_for_status()
+        return yaml.safe_load(response.content)
+    with open(pipeline_template_path) as f:
+        return yaml.safe_load(f)
+
+
+def load_template(pipeline_template_path: str) -> Dict[str, Any]:
+    """The parsed pipeline template, from the cache if still fresh."""
+    now = time.monotonic()
+    cached = _templates.get(pipeline_template_path)
+    if cached and now - cached[0] < TEMPLATE_CACHE_TTL_SECONDS:
+        return cached[1]
+    template = _fetch_template(pipeline_template_path)
+    _templates[pipeline_template_path] = (now, template)
+    return template
+
+
+def _set_enable_caching(pipeline_spec: Dict[str, Any], enable_caching: bool) -> None:
+    """Overrides the caching option of every task, as `PipelineJob` does."""
+    dags = [pipeline_spec["root"].get("dag", {})] + [
+        component.get("dag", {})
+        for component in pipeline_spec.get("components", {}).values()
+    ]
+    for dag in dags:
+        for task in dag.get("tasks", {}).values():
+            task["cachingOptions"] = {"enableCache": enable_caching}
+
+
+def build_pipeline_job(
+    template: Dict[str, Any],
+    pipeline_parameters: Dict[str, Any],
+    pipeline_root: str,
+    pipeline_template_path: str,
+    enable_caching: Optional[bool] = None,
+    display_name: str = DISPLAY_NAME,
+) -> Dict[str, Any]:
+    """The PipelineJob resource (REST representation) for a template.
+
+    Raises:
+        ValueError: If a parameter is not an input of the pipeline.
+    """
+    # Pipeline job JSON files wrap the spec, compiled YAML files are the spec
+    pipeline_spec = copy.deepcopy(template.get("pipelineSpec", template))
+    inputs = (
+        pipeline_spec.get("root", {})
+        .get("inputDefinitions", {})
+        .get("parameters", {})
+    )
+    unknown = set(pipeline_parameters) - set(inputs)
+    if unknown:
+        raise ValueError(f"Unknown pipeline parameters: {sorted(unknown)}")
+    if enable_caching is not None:
+        _set_enable_caching(pipeline_spec, enable_caching)
+
+    pipeline_job = {
+        "displayName": display_name,
+        "pipelineSpec": pipeline_spec,
+        "runtimeConfig": {
+            "gcsOutputDirectory": pipeline_root,
+            "parameterValues": {
+                k: v for k, v in pipeline_parameters.items() if v is not None
+            },
+        },
+    }
+    if pipeline_template_path.startswith("https://"):
+        pipeline_job["templateUri"] = pipeline_template_path
+    return pipeline_job
 
 
 def form_request(
@@ -27,23 +163,81 @@ def form_request(
     persistent_resource_name: str,
 ):
     # API Reference https://cloud.google.com/vertex-ai/docs/reference/rest/v1/projects.locations.pipelineJobs/create
-    endpoint = f"https://{location}-aiplatform.googleapis.com/v1beta1/projects/{project_id}/locations/{location}/pipelineJobs"
+    endpoint = (
+        API_ENDPOINT.format(location=location)
+        + f"/projects/{project_id}/locations/{location}/pipelineJobs"
+    )
 
     headers = {"Content-Type": "application/json"}
 
-    pipeline_spec = pipeline_job.to_dict()
+    pipeline_spec = pipeline_job
     pipeline_spec["serviceAccount"] = service_account
     pipeline_spec["runtimeConfig"]["defaultRuntime"] = {
         "persistentResourceRuntimeDetail": {
             "persistentResourceName": persistent_resource_name
         }
     }
-    # print(json.dumps(pipeline_spec, indent=2))
 
     # Make the POST request to create the job
     return endpoint, headers, pipeline_spec
 
 
+class SubmissionResult(NamedTuple):
+    index: int
+    name: Optional[str]
+    error: Optional[str]
+    seconds: float
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def new_pipeline_job_id(display_name: str = DISPLAY_NAME) -> str:
+    prefix = display_name.lower().replace("_", "-")[:80]
+    return f"{prefix}-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+def post_with_retry(
+    endpoint: str,
+    headers: Dict[str, str],
+    body: Dict[str, Any],
+    max_attempts: int = MAX_ATTEMPTS,
+    initial_backoff: float = 1.0,
+    max_backoff: float = 32.0,
+) -> Tuple[Any, int]:
+    """POSTs `body`, retrying 429/5xx responses and connection errors with
+    exponential backoff and full jitter (or the server's Retry-After).
+
+    Returns:
+        The last `requests.Response` and the number of attempts.
+    """
+    import requests
+
+    data = json.dumps(body)
+    for attempt in range(1, max_attempts + 1):
+        try:
+            response = get_session().post(endpoint, headers=headers, data=data)
+            if response.status_code not in RETRY_STATUS_CODES:
+                return response, attempt
+            retry_after = response.headers.get("Retry-After")
+        except requests.exceptions.ConnectionError:
+            if attempt == max_attempts:
+                raise
+            response, retry_after = None, None
+        if attempt == max_attempts:
+            return response, attempt
+        backoff = min(max_backoff, initial_backoff * 2 ** (attempt - 1))
+        delay = (
+            float(retry_after)
+            if retry_after and retry_after.isdigit()
+            else random.uniform(0, backoff)
+        )
+        reason = response.status_code if response is not None else "connection error"
+        print(f"Attempt {attempt} failed ({reason}), retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+
 def submit_pipeline_job_with_persistent_resource(
     project_id,
     location,
@@ -54,20 +248,22 @@ def submit_pipeline_job_with_persistent_resource(
     pipeline_root: str,
     enable_caching: bool = False,
 ):
+    """Creates a pipeline job on the persistent resource.
 
-    vertex.init(project=project_id, location=location, staging_bucket=pipeline_root)
-    display_name = "pipeline_via_storage_function"
+    Returns:
+        The resource name of the pipeline job.
+    """
     print(
-        f"Creating Pipeline Job with display_name={display_name} and the following params"
+        f"Creating Pipeline Job with display_name={DISPLAY_NAME} and the following params"
     )
     # print(json.dumps(pipeline_parameters, indent=2))
 
-    pipeline_job = vertex.PipelineJob(
-        display_name=display_name,
-        parameter_values=pipeline_parameters,
-        enable_caching=enable_caching,
-        template_path=pipeline_template_path,
+    pipeline_job = build_pipeline_job(
+        load_template(pipeline_template_path),
+        pipeline_parameters,
         pipeline_root=pipeline_root,
+        pipeline_template_path=pipeline_template_path,
+        enable_caching=enable_caching,
     )
 
     endpoint, headers, pipeline_spec = form_request(
@@ -78,17 +274,49 @@ def submit_pipeline_job_with_persistent_resource(
         pipeline_job=pipeline_job,
     )
 
-    # Get default credentials (may require authentication)
-    credentials, project_id = default()
-
-    # Create a session with authorized credentials
-    session = AuthorizedSession(credentials)
-    # Make the POST request to create the job
-
-    print("Will submit the request")
-    response = session.post(endpoint, headers=headers, data=json.dumps(pipeline_spec))
+    job_id = new_pipeline_job_id()
+    print(f"Will submit the request for {job_id}")
+    response, attempts = post_with_retry(
+        f"{endpoint}?pipelineJobId={job_id}", headers, pipeline_spec
+    )
+    if response.status_code == 409 and attempts > 1:
+        # An earlier attempt created the job, only its response was lost
+        return f"projects/{project_id}/locations/{location}/pipelineJobs/{job_id}"
+    response.raise_for_status()
 
-    # json.dumps(response.json(), indent=2)
     response_json = response.json()
 
     return response_json.get("name")
+
+
+def submit_pipeline_jobs(
+    submissions: List[Dict[str, Any]],
+    max_concurrency: int = MAX_CONCURRENT_SUBMISSIONS,
+) -> List[SubmissionResult]:
+    """Submits many pipeline jobs concurrently.
+
+    Args:
+        submissions: Keyword arguments of
+            `submit_pipeline_job_with_persistent_resource`, one dict per job.
+        max_concurrency: Maximum number of submissions in flight.
+
+    Returns:
+        One result per submission, in the same order. A failed submission does
+        not stop the others.
+    """
+
+    def submit(index: int, kwargs: Dict[str, Any]) -> SubmissionResult:
+        start = time.perf_counter()
+        try:
+            name = submit_pipeline_job_with_persistent_resource(**kwargs)
+            return SubmissionResult(index, name, None, time.perf_counter() - start)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            return SubmissionResult(index, None, error, time.perf_counter() - start)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        futures = [
+            pool.submit(submit, index, kwargs)
+            for index, kwargs in enumerate(submissions)
+        ]
+        return [future.result() for future in futures]
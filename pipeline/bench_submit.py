@@ -0,0 +1,156 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Per-submission latency of `submit_pipeline_job`, cold and warm.
+
+A local HTTP server stands in for Artifact Registry (serving a synthetic
+template of `--components` components) and for the Vertex AI API (answering
+job creations), each request delayed by `--latency_ms`. The credentials are
+anonymous, so credential discovery itself is not measured.
+
+- cold: the session and template caches are cleared before each submission,
+  as in a new Cloud Function instance,
+- warm: the same process submits again, reusing both.
+
+    python bench_submit.py --submissions 20 --latency_ms 30
+"""
+import argparse
+import http.server
+import json
+import statistics
+import threading
+import time
+from unittest import mock
+
+import yaml
+from google.auth.credentials import AnonymousCredentials
+
+import submit_pipeline_job
+
+PARAMETERS = ["project", "location", "pipeline_root", "bq_training_data_uri"]
+
+
+def synthetic_template(num_components: int) -> dict:
+    components = {
+        f"comp-step-{i}": {
+            "executorLabel": f"exec-step-{i}",
+            "inputDefinitions": {
+                "parameters": {f"p{j}": {"parameterType": "STRING"} for j in range(20)}
+            },
+        }
+        for i in range(num_components)
+    }
+    tasks = {
+        f"step-{i}": {
+            "componentRef": {"name": f"comp-step-{i}"},
+            "taskInfo": {"name": f"step-{i}"},
+            "cachingOptions": {},
+        }
+        for i in range(num_components)
+    }
+    return {
+        "pipelineInfo": {"name": "continuous-model-training-deployment"},
+        "schemaVersion": "2.1.0",
+        "components": components,
+        "root": {
+            "dag": {"tasks": tasks},
+            "inputDefinitions": {
+                "parameters": {p: {"parameterType": "STRING"} for p in PARAMETERS}
+            },
+        },
+    }
+
+
+def start_server(template_yaml: bytes, latency_s: float) -> http.server.HTTPServer:
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, body: bytes) -> None:
+            time.sleep(latency_s)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self._reply(template_yaml)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            self._reply(json.dumps({"name": "pipelineJobs/123"}).encode("utf-8"))
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def submit(template_path: str) -> float:
+    start = time.perf_counter()
+    submit_pipeline_job.submit_pipeline_job_with_persistent_resource(
+        project_id="project",
+        location="us-central1",
+        pipeline_parameters={p: "value" for p in PARAMETERS},
+        persistent_resource_name="projects/p/locations/l/persistentResources/r",
+        pipeline_template_path=template_path,
+        service_account="runner@project.iam.gserviceaccount.com",
+        pipeline_root="gs://bucket/root",
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--submissions", type=int, default=20)
+    parser.add_argument("--components", type=int, default=30)
+    parser.add_argument("--latency_ms", type=float, default=30)
+    args = parser.parse_args()
+
+    template_yaml = yaml.safe_dump(synthetic_template(args.components)).encode("utf-8")
+    server = start_server(template_yaml, args.latency_ms / 1000)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    template_path = f"{base_url}/project/repo/pipeline/latest"
+
+    with mock.patch.object(
+        submit_pipeline_job, "API_ENDPOINT", f"{base_url}/v1beta1"
+    ), mock.patch(
+        "google.auth.default", return_value=(AnonymousCredentials(), None)
+    ), mock.patch(
+        "builtins.print"
+    ):
+        cold = []
+        for _ in range(args.submissions):
+            submit_pipeline_job._session = None
+            submit_pipeline_job._templates.clear()
+            cold.append(submit(template_path))
+        warm = [submit(template_path) for _ in range(args.submissions)]
+    server.shutdown()
+
+    for name, latencies in (("cold", cold), ("warm", warm)):
+        print(
+            json.dumps(
+                {
+                    "mode": name,
+                    "submissions": len(latencies),
+                    "template_bytes": len(template_yaml),
+                    "p50_ms": round(statistics.median(latencies) * 1000, 2),
+                    "max_ms": round(max(latencies) * 1000, 2),
+                }
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -12,14 +12,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os
-from kfp import compiler
-
-from typing import Callable, Dict, Any, Optional, List
+"""Compiles the pipeline to a YAML package, with a content-addressed cache.
+
+Compiling imports KFP, the Google Cloud pipeline components and every custom
+component, which takes tens of seconds. `main` first computes a fingerprint of
+everything the compiled package depends on (the source of `pipeline.py` and
+`custom_components/*.py`, the kfp and google-cloud-pipeline-components
+versions, the pipeline name and the preset parameters) and reuses the package
+compiled for the same fingerprint, if any. `upload_pipeline_to_ar.py` uses the
+same cache entry to skip uploads of an unchanged package.
+"""
+import glob
+import hashlib
+import importlib.metadata
 import json
 import os
+import shutil
 import tempfile
-import pipeline
+from typing import Callable, Dict, Any, Optional, List
+
+PIPELINE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_DIR = os.environ.get(
+    "PIPELINE_COMPILE_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "pipeline_compile_cache"),
+)
+# Packages whose version changes the compiled YAML
+COMPILER_PACKAGES = ["kfp", "google-cloud-pipeline-components"]
 
 
 # Compile a pipeline function to a pipeline package.
@@ -44,8 +62,9 @@ def compile_pipeline(
         The path to the compiled pipeline package.
 
     """
-    tmp_dir = tempfile.gettempdir()
-    package_path = os.path.join(tmp_dir, filename)
+    package_path = filename
+    if not os.path.isabs(package_path):
+        package_path = os.path.join(tempfile.gettempdir(), filename)
     if pipeline_params:
         pipeline_params = {k: v for k, v in pipeline_params.items() if v is not None}
         print("Will use following pipeline params to compile the pipeline")
@@ -53,6 +72,8 @@ def compile_pipeline(
     else:
         pipeline_params = {}
 
+    from kfp import compiler
+
     compiler.Compiler().compile(
         pipeline_func=pipeline_func,
         pipeline_name=pipeline_name,
@@ -79,14 +100,91 @@ def edit_template(local_file_path: str):
     print(pipeline_spec)
 
 
+def _package_version(package: str) -> str:
+    try:
+        return importlib.metadata.version(package)
+    except importlib.metadata.PackageNotFoundError:
+        return "not-installed"
+
+
+def source_files() -> List[str]:
+    """The source files the compiled pipeline depends on."""
+    return [os.path.join(PIPELINE_DIR, "pipeline.py")] + sorted(
+        glob.glob(os.path.join(PIPELINE_DIR, "custom_components", "*.py"))
+    )
+
+
+def compile_fingerprint(
+    pipeline_name: str, parameters: Optional[Dict[str, Any]] = None
+) -> str:
+    """SHA-256 of everything the compiled pipeline package depends on."""
+    digest = hashlib.sha256()
+    for path in source_files():
+        digest.update(os.path.relpath(path, PIPELINE_DIR).encode("utf-8"))
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    for package in COMPILER_PACKAGES:
+        digest.update(f"{package}=={_package_version(package)}".encode("utf-8"))
+    parameters = {k: v for k, v in (parameters or {}).items() if v is not None}
+    digest.update(pipeline_name.encode("utf-8"))
+    digest.update(json.dumps(parameters, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
 def main(
     parameters: Optional[Dict[str, Any]] = None,
     pipeline_name="pipeline",
     filename="pipeline.yaml",
+    cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
 ):
-    return compile_pipeline(
-        pipeline_func=pipeline.continous_model_training_deployment_pipeline,
-        pipeline_name=pipeline_name,
-        filename=filename,
-        pipeline_params=parameters,
-    )
+    """Compiles the pipeline, or reuses the package compiled from the same sources
+    and parameters.
+
+    args:
+        parameters: Preset pipeline parameters.
+        pipeline_name: pipeline name to pass to the pipeline function.
+        filename: The name of the pipeline package.
+        cache_dir: Directory of the compile cache, None to always compile.
+
+    returns:
+        The path to the compiled pipeline package.
+    """
+    if not cache_dir:
+        import pipeline
+
+        return compile_pipeline(
+            pipeline_func=pipeline.continous_model_training_deployment_pipeline,
+            pipeline_name=pipeline_name,
+            filename=filename,
+            pipeline_params=parameters,
+        )
+
+    fingerprint = compile_fingerprint(pipeline_name, parameters)
+    entry_dir = os.path.join(cache_dir, fingerprint)
+    package_path = os.path.join(entry_dir, filename)
+    if os.path.exists(package_path):
+        print(f"Compile cache HIT {fingerprint[:12]}: reusing {package_path}")
+        return package_path
+
+    print(f"Compile cache MISS {fingerprint[:12]}: compiling the pipeline")
+    import pipeline
+
+    # Compile next to the entry and move it in place, so a concurrent or
+    # interrupted compile never leaves a partial package in the cache
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        compile_pipeline(
+            pipeline_func=pipeline.continous_model_training_deployment_pipeline,
+            pipeline_name=pipeline_name,
+            filename=os.path.join(tmp_dir, filename),
+            pipeline_params=parameters,
+        )
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another process cached the same fingerprint first
+            pass
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return package_path
@@ -0,0 +1,241 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from kfp.dsl import component
+from kfp.dsl import Output, Metrics
+from typing import NamedTuple
+
+
+@component(
+    base_image="python:3.11-slim",
+    packages_to_install=[
+        "google-cloud-aiplatform",
+        "google-cloud-storage",
+        "numpy",
+        "xgboost==1.7.6",
+    ],
+)
+def champion_challenger(
+    project: str,
+    model_dir: str,
+    metrics: Output[Metrics],
+    location: str = "us-central1",
+    endpoint_id: str = "",
+    champion_model_dirs: str = "",
+    max_champions: int = 3,
+    evaluation_passed: bool = True,
+    significance_level: float = 0.05,
+    require_improvement: bool = False,
+    batch_size: int = 65536,
+) -> NamedTuple("Output", [("deploy_decision", bool)]):
+    """Compares the new model (challenger) with the deployed ones (champions).
+
+    All models predict the holdout the trainer saved in `model_dir/holdout/`
+    in one pass over its batches. Each champion is compared with the challenger
+    on the same rows: accuracies, their difference and McNemar's test on the
+    rows only one of the two classifies correctly. The trainer assigns rows to
+    the holdout by a hash of their content, so champions trained on earlier
+    versions of a growing table have not seen them.
+
+    The model is deployed if `evaluation_passed` and, for every champion, the
+    challenger is not significantly worse (significantly better if
+    `require_improvement`). Without champions or holdout, `evaluation_passed`
+    decides.
+
+    Args:
+        model_dir: Artifacts of the challenger (model.bst and holdout/).
+        endpoint_id: Endpoint whose deployed model is a champion, together
+            with the latest versions of that model, up to `max_champions`.
+        champion_model_dirs: Champion artifact directories, separated by
+            commas, instead of looking them up from the endpoint.
+        evaluation_passed: Decision of the threshold gate (model_evaluation).
+    """
+    import json
+    import math
+    import os
+    import tempfile
+    from collections import namedtuple
+
+    import numpy as np
+    import xgboost as xgb
+
+    output = namedtuple("Output", ["deploy_decision"])
+
+    def normalize(uri):
+        return uri.rstrip("/")
+
+    def local_copy(uri, filename, directory):
+        """Local path of `uri`/`filename`, downloaded if on GCS (or None)."""
+        if not uri.startswith("gs://"):
+            path = os.path.join(uri, filename)
+            return path if os.path.exists(path) else None
+        from google.cloud import storage
+
+        bucket_name, _, prefix = uri.replace("gs://", "").partition("/")
+        blob_name = f"{prefix.rstrip('/')}/{filename}" if prefix else filename
+        blob = storage.Client(project=project).bucket(bucket_name).blob(blob_name)
+        if not blob.exists():
+            return None
+        path = os.path.join(directory, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        blob.download_to_filename(path)
+        return path
+
+    def find_champions():
+        """Artifact URIs of the deployed model and its latest versions."""
+        if champion_model_dirs:
+            return [normalize(d) for d in champion_model_dirs.split(",") if d]
+        if not endpoint_id:
+            return []
+        from google.cloud import aiplatform
+
+        aiplatform.init(project=project, location=location)
+        uris = []
+        for deployed in aiplatform.Endpoint(endpoint_id).list_models():
+            model_name = deployed.model.split("@")[0]
+            deployed_model = aiplatform.Model(
+                f"{model_name}@{deployed.model_version_id}"
+                if deployed.model_version_id
+                else model_name
+            )
+            uris.append(normalize(deployed_model.uri))
+            versions = aiplatform.models.ModelRegistry(model_name).list_versions()
+            for version in sorted(versions, key=lambda v: v.create_time, reverse=True):
+                uris.append(
+                    normalize(aiplatform.Model(f"{model_name}@{version.version_id}").uri)
+                )
+        champions = []
+        for uri in uris:
+            # The challenger may already be registered as a version
+            if uri != normalize(model_dir) and uri not in champions:
+                champions.append(uri)
+        return champions[:max_champions]
+
+    def mcnemar_p_value(only_challenger, only_champion):
+        """Two-sided McNemar test on the discordant pairs."""
+        n = only_challenger + only_champion
+        if n == 0:
+            return 1.0
+        if n <= 1000:
+            k = min(only_challenger, only_champion)
+            tail = sum(math.comb(n, i) for i in range(k + 1)) / 2.0**n
+            return min(1.0, 2 * tail)
+        statistic = (abs(only_challenger - only_champion) - 1) ** 2 / n
+        return math.erfc(math.sqrt(statistic / 2))
+
+    workdir = tempfile.mkdtemp()
+    manifest_path = local_copy(model_dir, "holdout/manifest.json", workdir)
+    champion_uris = find_champions()
+    print(f"--->Champions: {champion_uris}")
+    if manifest_path is None or not champion_uris:
+        print(
+            f"--->No {'holdout' if manifest_path is None else 'champion'} to "
+            f"compare with, deploy_decision = evaluation_passed ({evaluation_passed})"
+        )
+        return output(evaluation_passed)
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    shards = []
+    for shard in manifest["shards"]:
+        features = local_copy(model_dir, f"holdout/{shard['features']}", workdir)
+        labels = local_copy(model_dir, f"holdout/{shard['labels']}", workdir)
+        shards.append(
+            (np.load(features, mmap_mode="r"), np.load(labels, mmap_mode="r"))
+        )
+    num_features = len(manifest["feature_names"])
+
+    # The challenger is model 0
+    names, boosters = [], []
+    for uri in [model_dir] + champion_uris:
+        path = local_copy(uri, "model.bst", os.path.join(workdir, str(len(names))))
+        if path is None:
+            if not names:
+                raise FileNotFoundError(f"No model.bst in {model_dir}")
+            print(f"--->No model.bst in {uri}, skipped")
+            continue
+        booster = xgb.Booster()
+        booster.load_model(path)
+        if booster.num_features() != num_features:
+            if not names:
+                raise ValueError(
+                    f"{model_dir} expects {booster.num_features()} features, the "
+                    f"holdout has {num_features}"
+                )
+            print(f"--->{uri} expects {booster.num_features()} features, skipped")
+            continue
+        names.append(uri)
+        boosters.append(booster)
+    if len(boosters) < 2:
+        return output(evaluation_passed)
+
+    # correct[m, i]: model m classifies holdout row i correctly
+    rows = manifest["rows"]
+    correct = np.zeros((len(boosters), rows), dtype=bool)
+    offset = 0
+    for features, labels in shards:
+        for start in range(0, len(labels), batch_size):
+            X = features[start : start + batch_size]
+            y = labels[start : start + batch_size].astype(np.int64)
+            for m, booster in enumerate(boosters):
+                margin = booster.inplace_predict(X, predict_type="margin")
+                predicted = (
+                    np.argmax(margin, axis=1) if margin.ndim == 2 else margin > 0
+                )
+                correct[m, offset : offset + len(y)] = predicted == y
+            offset += len(y)
+
+    # Paired counts of every champion against the challenger, at once
+    challenger, champions = correct[0], correct[1:]
+    accuracies = correct.mean(axis=1)
+    only_challenger = (challenger & ~champions).sum(axis=1)
+    only_champion = (~challenger & champions).sum(axis=1)
+
+    metrics.log_metric("holdout_rows", rows)
+    metrics.log_metric("challenger_accuracy", float(accuracies[0]))
+    deploy = evaluation_passed
+    for i, name in enumerate(names[1:]):
+        p_value = mcnemar_p_value(int(only_challenger[i]), int(only_champion[i]))
+        delta = float(accuracies[0] - accuracies[i + 1])
+        significant = p_value < significance_level
+        if require_improvement:
+            passed = delta > 0 and significant
+        else:
+            passed = delta >= 0 or not significant
+        print(
+            f"--->Champion {i} ({name}): accuracy {accuracies[i + 1]:.4f}, "
+            f"delta {delta:+.4f}, only challenger right {only_challenger[i]}, only "
+            f"champion right {only_champion[i]}, McNemar p {p_value:.4g}: "
+            f"{'passed' if passed else 'failed'}"
+        )
+        metrics.log_metric(f"champion_{i}_accuracy", float(accuracies[i + 1]))
+        metrics.log_metric(f"champion_{i}_delta", delta)
+        metrics.log_metric(f"champion_{i}_p_value", p_value)
+        deploy = deploy and passed
+
+    print(f"--->deploy_decision: {deploy}")
+    return output(deploy)
+
+
+if __name__ == "__main__":
+    from kfp import local
+
+    # local.init(runner=local.DockerRunner(), pipeline_root="/tmp/pipeline_outputs")
+    local.init(runner=local.SubprocessRunner(), pipeline_root="/tmp/pipeline_outputs")
+    project_id = "your-project-id"
+    champion_challenger(
+        project=project_id,
+        model_dir="gs://your-project-id/pipeline_root/model",
+        endpoint_id=f"projects/{project_id}/locations/us-central1/endpoints/production",
+    )
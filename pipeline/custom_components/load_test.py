@@ -0,0 +1,409 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from kfp.dsl import component
+from kfp.dsl import Output, Metrics
+from typing import NamedTuple
+
+
+@component(
+    base_image="python:3.11-slim",
+    packages_to_install=[
+        "google-auth",
+        "google-cloud-aiplatform",
+        "google-cloud-bigquery[pandas]",
+        "google-cloud-storage",
+        "db-dtypes",
+    ],
+)
+def load_test(
+    project: str,
+    endpoint_id: str,
+    data_uri: str,
+    metrics: Output[Metrics],
+    location: str = "us-central1",
+    sample_size: int = 1000,
+    instances_per_request: int = 1,
+    target_qps: float = 20.0,
+    duration_seconds: float = 60.0,
+    concurrency: int = 32,
+    request_timeout_seconds: float = 10.0,
+    baseline_uri: str = "",
+    max_p99_regression: float = 0.2,
+    max_throughput_regression: float = 0.1,
+    max_error_rate: float = 0.01,
+    endpoint_url: str = "",
+    model_dir: str = "",
+    rollback_traffic_split: str = "",
+) -> NamedTuple(
+    "Output", [("p99_ms", float), ("throughput_qps", float), ("error_rate", float)]
+):
+    """Replays a sample of the training data against the endpoint at a target QPS.
+
+    Requests are sent on an open-loop schedule (request i at i / target_qps
+    seconds) by `concurrency` asyncio clients, each with a keep-alive
+    connection. Latencies are measured from the scheduled time, so a saturated
+    endpoint shows up as higher latency instead of fewer requests.
+
+    The pipeline fails if the error rate is above `max_error_rate`, or if p99
+    or throughput regress against the report of the previous deployment at
+    `baseline_uri` (measured with the same QPS and request size). A passing
+    report becomes the new baseline. Before failing, the model uploaded from
+    `model_dir` is undeployed and the endpoint's previous traffic split
+    restored, so a regressed model does not keep serving.
+
+    Args:
+        endpoint_id: Endpoint resource name (or ID in `project` and `location`).
+        data_uri: bq://project.dataset.table, or a CSV path.
+        baseline_uri: gs:// or local path of the previous report. Empty: no
+            regression check.
+        endpoint_url: Predict URL to test instead of the endpoint, e.g. a
+            local mock (no authentication).
+        model_dir: Artifacts of the model under test. Empty: no rollback.
+        rollback_traffic_split: Traffic split (JSON) of the endpoint before
+            the deployment, see model_deployed. Empty, or no models: the
+            model is the only one and is left deployed.
+    """
+    import asyncio
+    import json
+    import os
+    import ssl
+    import urllib.parse
+    from collections import Counter, namedtuple
+
+    import pandas as pd
+
+    non_feature_columns = ["target", "source_file", "ingested_at"]
+    histogram_bounds_ms = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+    def load_sample():
+        if data_uri.startswith("bq://"):
+            from google.cloud import bigquery
+
+            client = bigquery.Client(project=project)
+            df = client.list_rows(
+                data_uri.replace("bq://", ""), max_results=sample_size
+            ).to_dataframe()
+        else:
+            df = pd.read_csv(data_uri, nrows=sample_size)
+        df = df.drop(columns=[c for c in non_feature_columns if c in df.columns])
+        df = df.dropna()
+        if df.empty:
+            raise ValueError(f"No instances to replay in {data_uri}")
+        return df.values.tolist()
+
+    def read_report(uri):
+        if uri.startswith("gs://"):
+            from google.cloud import storage
+
+            bucket_name, blob_name = uri.replace("gs://", "").split("/", 1)
+            blob = storage.Client(project=project).bucket(bucket_name).blob(blob_name)
+            return json.loads(blob.download_as_text()) if blob.exists() else None
+        if not os.path.exists(uri):
+            return None
+        with open(uri) as f:
+            return json.load(f)
+
+    def roll_back():
+        """Undeploys the model from `model_dir`, restoring the previous split."""
+        previous_split = json.loads(rollback_traffic_split or "{}")
+        if not model_dir or not previous_split:
+            print("--->No previous deployment to restore, the model stays deployed")
+            return
+        from google.cloud import aiplatform
+
+        aiplatform.init(project=project, location=location)
+        endpoint = aiplatform.Endpoint(endpoint_id)
+        for deployed_model in endpoint.list_models():
+            model_name = deployed_model.model.split("@")[0]
+            model = aiplatform.Model(
+                f"{model_name}@{deployed_model.model_version_id}"
+                if deployed_model.model_version_id
+                else model_name
+            )
+            if model.uri.rstrip("/") == model_dir.rstrip("/"):
+                endpoint.undeploy(deployed_model.id, traffic_split=previous_split)
+                print(
+                    f"--->Undeployed {deployed_model.id}, traffic split restored: "
+                    f"{previous_split}"
+                )
+
+    def write_report(uri, report):
+        data = json.dumps(report, indent=2)
+        if uri.startswith("gs://"):
+            from google.cloud import storage
+
+            bucket_name, blob_name = uri.replace("gs://", "").split("/", 1)
+            storage.Client(project=project).bucket(bucket_name).blob(
+                blob_name
+            ).upload_from_string(data, content_type="application/json")
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(uri)), exist_ok=True)
+            with open(uri, "w") as f:
+                f.write(data)
+
+    if endpoint_url:
+        url, headers = endpoint_url, {}
+    else:
+        import google.auth
+        import google.auth.transport.requests
+
+        resource = endpoint_id
+        if "/" not in resource:
+            resource = f"projects/{project}/locations/{location}/endpoints/{endpoint_id}"
+        url = f"https://{location}-aiplatform.googleapis.com/v1/{resource}:predict"
+        credentials, _ = google.auth.default(
+            scopes=["https://www.googleapis.com/auth/cloud-platform"]
+        )
+        credentials.refresh(google.auth.transport.requests.Request())
+        headers = {"Authorization": f"Bearer {credentials.token}"}
+
+    parsed = urllib.parse.urlsplit(url)
+    https = parsed.scheme == "https"
+    host = parsed.hostname
+    port = parsed.port or (443 if https else 80)
+    path = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+
+    sample = load_sample()
+    bodies = []
+    for i in range(0, len(sample), instances_per_request):
+        body = json.dumps({"instances": sample[i : i + instances_per_request]}).encode(
+            "utf-8"
+        )
+        head = "".join(
+            [f"POST {path} HTTP/1.1\r\nHost: {host}\r\n"]
+            + [f"{k}: {v}\r\n" for k, v in headers.items()]
+            + [
+                "Content-Type: application/json\r\n",
+                f"Content-Length: {len(body)}\r\n\r\n",
+            ]
+        )
+        bodies.append(head.encode("latin-1") + body)
+    print(
+        f"--->Replaying {len(sample)} instances from {data_uri} to {url} at "
+        f"{target_qps} QPS for {duration_seconds}s"
+    )
+
+    async def post(reader, writer, request):
+        """Sends one request, returns (status, body, connection closed)."""
+        writer.write(request)
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by the server")
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            response_headers[key.strip().lower()] = value.strip().lower()
+        if response_headers.get("transfer-encoding") == "chunked":
+            payload = b""
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                payload += await reader.readexactly(size)
+                await reader.readline()
+        else:
+            payload = await reader.readexactly(
+                int(response_headers.get("content-length", 0))
+            )
+        return status, payload, response_headers.get("connection") == "close"
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        results = []
+        ssl_context = ssl.create_default_context() if https else None
+
+        async def client():
+            connection = None
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                scheduled, request = item
+                error = None
+                try:
+                    if connection is None:
+                        connection = await asyncio.wait_for(
+                            asyncio.open_connection(host, port, ssl=ssl_context),
+                            request_timeout_seconds,
+                        )
+                    status, payload, closed = await asyncio.wait_for(
+                        post(*connection, request), request_timeout_seconds
+                    )
+                    if status != 200:
+                        error = f"HTTP {status}"
+                    elif not json.loads(payload).get("predictions"):
+                        error = "no predictions"
+                    if closed:
+                        connection[1].close()
+                        connection = None
+                except (
+                    OSError,
+                    asyncio.TimeoutError,
+                    asyncio.IncompleteReadError,
+                    ValueError,
+                ) as e:
+                    error = type(e).__name__
+                    if connection is not None:
+                        connection[1].close()
+                        connection = None
+                results.append((loop.time() - scheduled, error))
+            if connection is not None:
+                connection[1].close()
+
+        clients = [asyncio.create_task(client()) for _ in range(concurrency)]
+        start = loop.time()
+        for i in range(max(int(target_qps * duration_seconds), 1)):
+            scheduled = start + i / target_qps
+            await asyncio.sleep(max(0.0, scheduled - loop.time()))
+            queue.put_nowait((scheduled, bodies[i % len(bodies)]))
+        for _ in clients:
+            queue.put_nowait(None)
+        await asyncio.gather(*clients)
+        return results, loop.time() - start
+
+    results, elapsed = asyncio.run(run())
+
+    latencies_ms = sorted(latency * 1000 for latency, error in results if error is None)
+    errors = Counter(error for _, error in results if error is not None)
+
+    def percentile(q):
+        if not latencies_ms:
+            return float("inf")
+        return latencies_ms[min(int(q * len(latencies_ms)), len(latencies_ms) - 1)]
+
+    histogram = Counter()
+    for latency in latencies_ms:
+        bound = next((b for b in histogram_bounds_ms if latency <= b), None)
+        histogram[f"le_{bound}" if bound else "inf"] += 1
+    report = {
+        "endpoint": url,
+        "target_qps": target_qps,
+        "instances_per_request": instances_per_request,
+        "requests": len(results),
+        "error_rate": sum(errors.values()) / max(len(results), 1),
+        "throughput_qps": len(latencies_ms) / elapsed,
+        "p50_ms": percentile(0.50),
+        "p90_ms": percentile(0.90),
+        "p99_ms": percentile(0.99),
+        "max_ms": latencies_ms[-1] if latencies_ms else float("inf"),
+        "latency_histogram_ms": {
+            key: histogram[key]
+            for key in [f"le_{b}" for b in histogram_bounds_ms] + ["inf"]
+        },
+        "errors": dict(errors),
+    }
+    print(f"--->Load test report: {json.dumps(report, indent=2)}")
+    scalars = ["requests", "error_rate", "throughput_qps", "p50_ms", "p90_ms"]
+    for key in scalars + ["p99_ms", "max_ms"]:
+        metrics.log_metric(key, report[key])
+    for key, count in report["latency_histogram_ms"].items():
+        metrics.log_metric(f"latency_{key}", count)
+
+    failures = []
+    if report["error_rate"] > max_error_rate:
+        failures.append(
+            f"error rate {report['error_rate']:.3f} > {max_error_rate} ({dict(errors)})"
+        )
+    baseline = read_report(baseline_uri) if baseline_uri else None
+    if baseline and (
+        baseline.get("target_qps") != target_qps
+        or baseline.get("instances_per_request") != instances_per_request
+    ):
+        print("--->Baseline was measured with another load, not compared")
+        baseline = None
+    if baseline:
+        print(
+            f"--->Baseline: p99 {baseline['p99_ms']:.1f} ms, "
+            f"{baseline['throughput_qps']:.1f} QPS"
+        )
+        if report["p99_ms"] > baseline["p99_ms"] * (1 + max_p99_regression):
+            failures.append(
+                f"p99 {report['p99_ms']:.1f} ms > baseline {baseline['p99_ms']:.1f} ms "
+                f"+ {max_p99_regression:.0%}"
+            )
+        if report["throughput_qps"] < baseline["throughput_qps"] * (
+            1 - max_throughput_regression
+        ):
+            failures.append(
+                f"throughput {report['throughput_qps']:.1f} QPS < baseline "
+                f"{baseline['throughput_qps']:.1f} QPS - {max_throughput_regression:.0%}"
+            )
+    if failures:
+        roll_back()
+        raise RuntimeError(f"Load test failed: {'; '.join(failures)}")
+
+    if baseline_uri:
+        write_report(baseline_uri, report)
+        print(f"--->Report saved as the new baseline: {baseline_uri}")
+    output = namedtuple("Output", ["p99_ms", "throughput_qps", "error_rate"])
+    return output(report["p99_ms"], report["throughput_qps"], report["error_rate"])
+
+
+if __name__ == "__main__":
+    # Runs the load test against a local mock endpoint
+    import json
+    import os
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    from kfp import local
+
+    class MockEndpoint(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        latency_seconds = 0.005
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            time.sleep(self.latency_seconds)
+            body = json.dumps(
+                {"predictions": [0.0] * len(request["instances"])}
+            ).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockEndpoint)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    data_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "sample.csv"
+    )
+
+    local.init(runner=local.SubprocessRunner(), pipeline_root="/tmp/pipeline_outputs")
+    kwargs = dict(
+        project="your-project-id",
+        endpoint_id="mock",
+        data_uri=data_path,
+        target_qps=50,
+        duration_seconds=5,
+        baseline_uri="/tmp/pipeline_outputs/load_test/baseline.json",
+        endpoint_url=f"http://127.0.0.1:{server.server_address[1]}/predict",
+    )
+    load_test(**kwargs)
+    # A slower deployment regresses p99 and fails the task
+    MockEndpoint.latency_seconds = 0.05
+    load_test(**kwargs)
@@ -0,0 +1,74 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from kfp.dsl import component
+from typing import NamedTuple
+
+
+@component(
+    base_image="python:3.11-slim",
+    packages_to_install=["google-cloud-aiplatform"],
+)
+def model_deployed(
+    project: str,
+    model_dir: str,
+    location: str = "us-central1",
+    endpoint_id: str = "",
+) -> NamedTuple("Output", [("deployed", bool), ("traffic_split", str)]):
+    """Whether a model uploaded from `model_dir` is deployed on the endpoint.
+
+    A run whose training step was a cache hit has the same pipeline root, and
+    so the same `model_dir`, as the run that trained the model: if that model
+    is still deployed, uploading and deploying it again would change nothing.
+
+    Also returns the endpoint's traffic split (JSON, deployed model ID to
+    percentage) before this run deploys anything, for load_test to restore.
+    """
+    import json
+    from collections import namedtuple
+
+    output = namedtuple("Output", ["deployed", "traffic_split"])
+    if not endpoint_id:
+        return output(False, "{}")
+
+    from google.cloud import aiplatform
+
+    aiplatform.init(project=project, location=location)
+    endpoint = aiplatform.Endpoint(endpoint_id)
+    traffic_split = json.dumps(dict(endpoint.traffic_split))
+    print(f"--->Traffic split of {endpoint_id}: {traffic_split}")
+    for deployed_model in endpoint.list_models():
+        model_name = deployed_model.model.split("@")[0]
+        model = aiplatform.Model(
+            f"{model_name}@{deployed_model.model_version_id}"
+            if deployed_model.model_version_id
+            else model_name
+        )
+        if model.uri.rstrip("/") == model_dir.rstrip("/"):
+            print(f"--->{model.resource_name} from {model_dir} is already deployed")
+            return output(True, traffic_split)
+    return output(False, traffic_split)
+
+
+if __name__ == "__main__":
+    from kfp import local
+
+    # local.init(runner=local.DockerRunner(), pipeline_root="/tmp/pipeline_outputs")
+    local.init(runner=local.SubprocessRunner(), pipeline_root="/tmp/pipeline_outputs")
+    project_id = "your-project-id"
+    model_deployed(
+        project=project_id,
+        model_dir="gs://your-project-id/pipeline_root/model",
+        endpoint_id=f"projects/{project_id}/locations/us-central1/endpoints/production",
+    )
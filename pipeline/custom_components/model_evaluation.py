@@ -27,7 +27,18 @@ def model_evaluation(
     project: str,
     model_dir: str,
     metrics: Output[Metrics],
+    metric_name: str = "accuracy",
+    threshold: float = 0.9,
+    higher_is_better: bool = True,
 ) -> NamedTuple("Output", [("deploy_decision", bool)]):
+    """Logs the trainer's metrics.json and gates deployment on one of them.
+
+    Args:
+        metric_name: Any scalar of metrics.json, e.g. accuracy, macro_f1,
+            log_loss, recall_class_1 or expected_calibration_error.
+        threshold: The model is deployed if the metric is above it (below it
+            when `higher_is_better` is False).
+    """
     from google.cloud import storage
     import json
     import os
@@ -57,16 +68,36 @@ def model_evaluation(
     obtained_metrics = json.loads(metrics_json)
     print(f"--->Successfully downloaded and parsed metrics.json: {obtained_metrics}")
     for k, v in obtained_metrics.items():
-        metrics.log_metric(k, v)
+        # Confusion matrix, calibration bins and slices stay in metrics.json
+        if isinstance(v, (int, float)):
+            metrics.log_metric(k, v)
+
+    # Written by the trainer when it ran a hyperparameter search (--search)
+    leaderboard_blob = bucket.blob(os.path.join(prefix, "leaderboard.json"))
+    if leaderboard_blob.exists():
+        trials = json.loads(leaderboard_blob.download_as_string().decode("utf-8"))[
+            "trials"
+        ]
+        best_trial = trials[0]
+        print(f"--->Leaderboard has {len(trials)} trials, best: {best_trial}")
+        metrics.log_metric("search_trials", len(trials))
+        metrics.log_metric("search_best_score", best_trial["score"])
+        metrics.log_metric("search_best_rounds", best_trial["rounds"])
+        for k, v in best_trial["params"].items():
+            metrics.log_metric(f"search_best_{k}", v)
 
-    # Check the accuracy value
+    # Check the gating metric
     output = namedtuple("Output", ["deploy_decision"])
-    if "accuracy" in obtained_metrics and obtained_metrics["accuracy"] > 0.9:
-        print(f"--->Model accuracy meets the threshold (above 0.9).")
+    value = obtained_metrics.get(metric_name)
+    comparison = "above" if higher_is_better else "below"
+    if isinstance(value, (int, float)) and (
+        value > threshold if higher_is_better else value < threshold
+    ):
+        print(f"--->Model {metric_name} ({value}) meets the threshold ({comparison} {threshold}).")
         return output(True)  # Return as a named tuple
     else:
         print(
-            f"--->Model accuracy ({obtained_metrics.get('accuracy', 'N/A')}) does not meet the threshold."
+            f"--->Model {metric_name} ({value if value is not None else 'N/A'}) does not meet the threshold ({comparison} {threshold})."
         )
         return output(False)  # Return as a named tuple
 
@@ -23,8 +23,10 @@ from google_cloud_pipeline_components.v1.dataset import TabularDatasetCreateOp
 
 from custom_components import (
     model_evaluation,
+    model_deployed,
+    champion_challenger,
     deploy_to_endpoint,
-    validate_infrastructure,
+    load_test,
 )
 
 
@@ -45,12 +47,27 @@ def continous_model_training_deployment_pipeline(
     parent_model_resource_name: str = None,
     production_endpoint_id: str = None,
     tensorboard: str = None,
+    evaluation_metric: str = "accuracy",
+    evaluation_threshold: float = 0.9,
+    evaluation_higher_is_better: bool = True,
+    max_champions: int = 3,
+    significance_level: float = 0.05,
+    require_improvement: bool = False,
+    dataset_display_name: str = "pipeline_dataset",
+    load_test_qps: float = 20.0,
+    load_test_duration_seconds: float = 60.0,
+    load_test_baseline_uri: str = "",
 ):
-
+    # The dataset, training and evaluation steps are cacheable: their inputs
+    # (dataset_display_name and pipeline_root, see
+    # functions/storage_trigger/cache_keys.py) change with the data, checkpoint,
+    # training arguments and image. Runs submitted with enable_caching=False
+    # still always re-run them. Steps with side effects are never cached, and
+    # are skipped when the (cached) model is already deployed.
     dataset_op = TabularDatasetCreateOp(
-        display_name="pipeline_dataset",
+        display_name=dataset_display_name,
         bq_source=bq_training_data_uri,
-    ).set_caching_options(False)
+    ).set_caching_options(True)
 
     custom_job_task = CustomTrainingJobOp(
         project=project,
@@ -62,83 +79,124 @@ def continous_model_training_deployment_pipeline(
         service_account=service_account,
         tensorboard=tensorboard,
     ).after(dataset_op)
-    custom_job_task.set_caching_options(False)
+    custom_job_task.set_caching_options(True)
 
-    # Import the unmanaged model
-    import_unmanaged_model_task = importer(
-        artifact_uri=model_artifact_dir,
-        artifact_class=artifact_types.UnmanagedContainerModel,
-        metadata={
-            "containerSpec": {
-                "imageUri": prediction_container_image_uri,
-            },
-            "displayName": "Import model",
-        },
+    model_evaluation_task = model_evaluation.model_evaluation(
+        project=project,
+        model_dir=model_artifact_dir,
+        metric_name=evaluation_metric,
+        threshold=evaluation_threshold,
+        higher_is_better=evaluation_higher_is_better,
+    )
+    model_evaluation_task.set_caching_options(True).after(custom_job_task)
+
+    # On a cache hit the training step returns the model of an earlier run, with
+    # the same model_artifact_dir; if it is still deployed, there is nothing to
+    # upload, compare or deploy
+    model_deployed_task = model_deployed.model_deployed(
+        project=project,
+        location=location,
+        model_dir=model_artifact_dir,
+        endpoint_id=production_endpoint_id,
     ).after(custom_job_task)
-    import_unmanaged_model_task.set_caching_options(False)
+    model_deployed_task.set_caching_options(False)
 
-    with dsl.If(existing_model == True, "Import existing model"):
-        # Import the parent model to upload as a version
-        import_registry_model_task = importer(
-            artifact_uri=parent_model_resource_name,
-            artifact_class=artifact_types.VertexModel,
-            metadata={"resourceName": parent_model_resource_name},
-        ).after(import_unmanaged_model_task)
-        # Upload the model as a version
-        model_version_upload_op = ModelUploadOp(
-            project=project,
-            location=location,
-            display_name="pipeline_model",
-            parent_model=import_registry_model_task.outputs["artifact"],
-            unmanaged_container_model=import_unmanaged_model_task.outputs["artifact"],
-            version_aliases=["default"],
-        ).set_caching_options(False)
+    with dsl.If(
+        model_deployed_task.outputs["deployed"] == False, "Model not deployed yet"
+    ):
+        # Import the unmanaged model
+        import_unmanaged_model_task = importer(
+            artifact_uri=model_artifact_dir,
+            artifact_class=artifact_types.UnmanagedContainerModel,
+            metadata={
+                "containerSpec": {
+                    "imageUri": prediction_container_image_uri,
+                },
+                "displayName": "Import model",
+            },
+        ).after(custom_job_task)
+        import_unmanaged_model_task.set_caching_options(False)
 
-    with dsl.Else("Create new model"):
-        # Upload the model
-        model_upload_op = ModelUploadOp(
-            project=project,
-            location=location,
-            display_name="pipeline_model",
-            unmanaged_container_model=import_unmanaged_model_task.outputs["artifact"],
-        ).set_caching_options(False)
+        with dsl.If(existing_model == True, "Import existing model"):
+            # Import the parent model to upload as a version
+            import_registry_model_task = importer(
+                artifact_uri=parent_model_resource_name,
+                artifact_class=artifact_types.VertexModel,
+                metadata={"resourceName": parent_model_resource_name},
+            ).after(import_unmanaged_model_task)
+            # Upload the model as a version
+            model_version_upload_op = ModelUploadOp(
+                project=project,
+                location=location,
+                display_name="pipeline_model",
+                parent_model=import_registry_model_task.outputs["artifact"],
+                unmanaged_container_model=import_unmanaged_model_task.outputs["artifact"],
+                version_aliases=["default"],
+            ).set_caching_options(False)
 
-    # Get the model (or model version)
-    model_resource = OneOf(
-        model_version_upload_op.outputs["model"], model_upload_op.outputs["model"]
-    )
+        with dsl.Else("Create new model"):
+            # Upload the model
+            model_upload_op = ModelUploadOp(
+                project=project,
+                location=location,
+                display_name="pipeline_model",
+                unmanaged_container_model=import_unmanaged_model_task.outputs["artifact"],
+            ).set_caching_options(False)
 
-    model_evaluation_task = model_evaluation.model_evaluation(
-        project=project,
-        model_dir=model_artifact_dir,
-    ).set_caching_options(False)
-    model_evaluation_task.set_caching_options(False).after(custom_job_task)
-    model_evaluation_result = model_evaluation_task.outputs["deploy_decision"]
+        # Get the model (or model version)
+        model_resource = OneOf(
+            model_version_upload_op.outputs["model"], model_upload_op.outputs["model"]
+        )
 
-    with dsl.If(model_evaluation_result == True or True, "Deploy model"):
-        import_endpoint_task = importer(
-            artifact_uri=production_endpoint_id,
-            artifact_class=artifact_types.VertexEndpoint,
-            metadata={"resourceName": production_endpoint_id},
-        )  # .after(import_unmanaged_model_task)
-        model_deploy_task = ModelDeployOp(
-            endpoint=import_endpoint_task.outputs["artifact"],
-            model=model_resource,
-            deployed_model_display_name="pipeline-model",
-            dedicated_resources_machine_type="n1-standard-4",
-            dedicated_resources_min_replica_count=1,
-            dedicated_resources_max_replica_count=1,
-            enable_access_logging=True,
-            service_account=service_account,
-            traffic_split={"0": 100},
-        ).set_caching_options(False)
-        deploy_to_endpoint.deploy_to_endpoint(
+        # Compares with the deployed model and its latest versions on the holdout;
+        # not cached, the champions change with every deployment
+        champion_challenger_task = champion_challenger.champion_challenger(
+            project=project,
+            location=location,
+            model_dir=model_artifact_dir,
             endpoint_id=production_endpoint_id,
-            model_dir=pipeline_root,
-        ).set_caching_options(False)
+            max_champions=max_champions,
+            evaluation_passed=model_evaluation_task.outputs["deploy_decision"],
+            significance_level=significance_level,
+            require_improvement=require_improvement,
+        )
+        champion_challenger_task.set_caching_options(False)
+        deploy_decision = champion_challenger_task.outputs["deploy_decision"]
+
+        with dsl.If(deploy_decision == True, "Deploy model"):
+            import_endpoint_task = importer(
+                artifact_uri=production_endpoint_id,
+                artifact_class=artifact_types.VertexEndpoint,
+                metadata={"resourceName": production_endpoint_id},
+            )  # .after(import_unmanaged_model_task)
+            model_deploy_task = ModelDeployOp(
+                endpoint=import_endpoint_task.outputs["artifact"],
+                model=model_resource,
+                deployed_model_display_name="pipeline-model",
+                dedicated_resources_machine_type="n1-standard-4",
+                dedicated_resources_min_replica_count=1,
+                dedicated_resources_max_replica_count=1,
+                enable_access_logging=True,
+                service_account=service_account,
+                traffic_split={"0": 100},
+            ).set_caching_options(False)
+            deploy_to_endpoint.deploy_to_endpoint(
+                endpoint_id=production_endpoint_id,
+                model_dir=pipeline_root,
+            ).set_caching_options(False)
 
-        validate_infrastructure.validate_infra(
-            project=project, endpoint_id=production_endpoint_id, location=location
-        ).after(model_deploy_task).set_caching_options(False)
+            # Fails the run if p99 or throughput regress against the last
+            # deployment, after undeploying the model and restoring the traffic
+            load_test.load_test(
+                project=project,
+                endpoint_id=production_endpoint_id,
+                data_uri=bq_training_data_uri,
+                location=location,
+                target_qps=load_test_qps,
+                duration_seconds=load_test_duration_seconds,
+                baseline_uri=load_test_baseline_uri,
+                model_dir=model_artifact_dir,
+                rollback_traffic_split=model_deployed_task.outputs["traffic_split"],
+            ).after(model_deploy_task).set_caching_options(False)
 
     return
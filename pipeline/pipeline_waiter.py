@@ -0,0 +1,371 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Waits for Vertex AI pipeline jobs to finish, without fixed-interval polling.
+
+`PipelineWaiter` checks the state of a job with exponential backoff and jitter,
+so a short job is seen finishing quickly and a long one costs few API calls.
+Many jobs are watched concurrently from one event loop (`wait_all`).
+
+A notification (e.g. a job state change routed from a Cloud Logging sink to a
+Pub/Sub subscription, see `subscribe_pubsub`) wakes the waiter of that job
+immediately; the state is then read from the API, so a lost or duplicated
+notification only costs latency, never correctness.
+
+The job state is read through a `JobStateSource`: `VertexJobStateSource` for
+the real API, `FakeJobStateSource` to run offline (see `test_waiter`).
+
+    python pipeline_waiter.py --region us-central1 projects/.../pipelineJobs/a ...
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import random
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Without notifications, a finished job is seen at most this late
+DEFAULT_MAX_DELAY = 10.0
+
+SUCCEEDED = "PIPELINE_STATE_SUCCEEDED"
+FAILED = "PIPELINE_STATE_FAILED"
+CANCELLED = "PIPELINE_STATE_CANCELLED"
+TERMINAL_STATES = {SUCCEEDED, FAILED, CANCELLED}
+
+
+class TaskTiming(NamedTuple):
+    task_name: str
+    state: str
+    start_time: Optional[datetime.datetime]
+    end_time: Optional[datetime.datetime]
+
+    @property
+    def duration_s(self) -> Optional[float]:
+        if not self.start_time or not self.end_time:
+            return None
+        return (self.end_time - self.start_time).total_seconds()
+
+
+class JobStatus(NamedTuple):
+    state: str
+    tasks: List[TaskTiming]
+
+
+class JobResult(NamedTuple):
+    resource_name: str
+    state: str
+    tasks: List[TaskTiming]
+    wait_seconds: float
+    polls: int
+
+    @property
+    def succeeded(self) -> bool:
+        return self.state == SUCCEEDED
+
+    def timings(self) -> Dict[str, Optional[float]]:
+        """Seconds per task, in the order the tasks started."""
+        tasks = sorted(
+            self.tasks,
+            key=lambda t: t.start_time or datetime.datetime.max.replace(
+                tzinfo=datetime.timezone.utc
+            ),
+        )
+        return {t.task_name: t.duration_s for t in tasks}
+
+
+class VertexJobStateSource:
+    """Reads pipeline job states with the async Vertex AI client."""
+
+    def __init__(self, region: str):
+        from google.cloud.aiplatform_v1.services.pipeline_service import (
+            PipelineServiceAsyncClient,
+        )
+
+        self.client = PipelineServiceAsyncClient(
+            client_options={"api_endpoint": f"{region}-aiplatform.googleapis.com"}
+        )
+
+    async def get(self, resource_name: str) -> JobStatus:
+        job = await self.client.get_pipeline_job(name=resource_name)
+        tasks = [
+            TaskTiming(
+                task_name=task.task_name,
+                state=task.state.name,
+                start_time=task.start_time or None,
+                end_time=task.end_time or None,
+            )
+            for task in job.job_detail.task_details
+        ]
+        return JobStatus(state=job.state.name, tasks=tasks)
+
+
+class FakeJobStateSource:
+    """Replays a scripted sequence of states per job; the last one repeats."""
+
+    def __init__(
+        self,
+        states: Dict[str, List[str]],
+        tasks: Optional[Dict[str, List[TaskTiming]]] = None,
+    ):
+        self.states = {name: list(sequence) for name, sequence in states.items()}
+        self.tasks = tasks or {}
+        self.calls: Dict[str, int] = {name: 0 for name in states}
+
+    async def get(self, resource_name: str) -> JobStatus:
+        sequence = self.states[resource_name]
+        index = min(self.calls[resource_name], len(sequence) - 1)
+        self.calls[resource_name] += 1
+        return JobStatus(
+            state=sequence[index], tasks=self.tasks.get(resource_name, [])
+        )
+
+
+class PipelineWaiter:
+    def __init__(
+        self,
+        source,
+        initial_delay: float = 2.0,
+        max_delay: float = DEFAULT_MAX_DELAY,
+        multiplier: float = 2.0,
+        timeout: Optional[float] = None,
+        rng: Optional[random.Random] = None,
+    ):
+        """
+        Args:
+            source: A `JobStateSource` (an object with `async get(name)`).
+            initial_delay (float): Seconds before the second state check.
+            max_delay (float): Upper bound of the delay between checks.
+            multiplier (float): Growth of the delay after each check.
+            timeout (float, optional): Give up waiting for a job after this long.
+            rng (random.Random, optional): Source of the jitter.
+        """
+        self.source = source
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.timeout = timeout
+        self.rng = rng or random.Random()
+        self._wakeups: Dict[str, asyncio.Event] = {}
+
+    def delay(self, attempt: int) -> float:
+        """Backoff before check `attempt` + 1, with jitter in [50%, 100%] so
+        concurrent waiters do not poll in lockstep."""
+        ceiling = min(self.max_delay, self.initial_delay * self.multiplier**attempt)
+        return ceiling * self.rng.uniform(0.5, 1.0)
+
+    def notify(self, resource_name: Optional[str] = None) -> None:
+        """Wakes the waiter of `resource_name`, a resource name or job ID
+        (all waiters if None).
+
+        Must be called from the event loop thread, see `subscribe_pubsub`.
+        """
+        for name, event in self._wakeups.items():
+            if resource_name in (None, name, name.rsplit("/", 1)[-1]):
+                event.set()
+
+    async def wait(self, resource_name: str) -> JobResult:
+        """Waits until the job reaches a terminal state.
+
+        Raises:
+            TimeoutError: If the job is still running after `timeout` seconds.
+        """
+        wakeup = self._wakeups.setdefault(resource_name, asyncio.Event())
+        start = time.monotonic()
+        attempt = 0
+        try:
+            while True:
+                status = await self.source.get(resource_name)
+                attempt += 1
+                logger.info(f"{resource_name}: {status.state}")
+                if status.state in TERMINAL_STATES:
+                    return JobResult(
+                        resource_name=resource_name,
+                        state=status.state,
+                        tasks=status.tasks,
+                        wait_seconds=time.monotonic() - start,
+                        polls=attempt,
+                    )
+
+                delay = self.delay(attempt - 1)
+                if self.timeout is not None:
+                    remaining = self.timeout - (time.monotonic() - start)
+                    if remaining <= 0:
+                        raise TimeoutError(
+                            f"{resource_name} still {status.state} after "
+                            f"{self.timeout}s"
+                        )
+                    delay = min(delay, remaining)
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=delay)
+                    logger.info(f"{resource_name}: notified")
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._wakeups.pop(resource_name, None)
+
+    async def wait_all(self, resource_names: Iterable[str]) -> List[JobResult]:
+        """Waits for several jobs concurrently, results in the same order."""
+        return list(await asyncio.gather(*(self.wait(n) for n in resource_names)))
+
+
+def _job_id_from_message(data: bytes) -> Optional[str]:
+    """The pipeline job ID in a log entry exported to Pub/Sub, if any."""
+    try:
+        entry = json.loads(data)
+    except ValueError:
+        return None
+    labels = entry.get("resource", {}).get("labels", {})
+    return labels.get("pipeline_job_id") or entry.get("labels", {}).get(
+        "pipeline_job_id"
+    )
+
+
+def subscribe_pubsub(waiter: PipelineWaiter, subscription_path: str):
+    """Wakes the waiters on every message of a Pub/Sub subscription.
+
+    The subscription is meant to receive the Vertex AI pipeline job state change
+    log entries (a Cloud Logging sink to a Pub/Sub topic). A message that names
+    no job wakes every waiter.
+
+    Returns:
+        The streaming pull future; call `cancel()` on it when done.
+    """
+    from google.cloud import pubsub_v1
+
+    loop = asyncio.get_running_loop()
+    subscriber = pubsub_v1.SubscriberClient()
+
+    def callback(message) -> None:
+        job_id = _job_id_from_message(message.data)
+        loop.call_soon_threadsafe(waiter.notify, job_id)
+        message.ack()
+
+    return subscriber.subscribe(subscription_path, callback=callback)
+
+
+async def _wait_and_report(args: argparse.Namespace) -> List[JobResult]:
+    waiter = PipelineWaiter(
+        VertexJobStateSource(args.region),
+        initial_delay=args.initial_delay,
+        max_delay=args.max_delay,
+        timeout=args.timeout,
+    )
+    streaming_pull = (
+        subscribe_pubsub(waiter, args.subscription) if args.subscription else None
+    )
+    try:
+        return await waiter.wait_all(args.resource_names)
+    finally:
+        if streaming_pull:
+            streaming_pull.cancel()
+
+
+def test_waiter():
+    """Three jobs watched concurrently, one of them woken by a notification."""
+    logging.basicConfig(level=logging.INFO)
+    t0 = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    tasks = [
+        TaskTiming(
+            "tabular-dataset-create",
+            "SUCCEEDED",
+            t0,
+            t0 + datetime.timedelta(seconds=40),
+        ),
+        TaskTiming(
+            "custom-training-job",
+            "SUCCEEDED",
+            t0 + datetime.timedelta(seconds=40),
+            t0 + datetime.timedelta(seconds=340),
+        ),
+    ]
+    running = "PIPELINE_STATE_RUNNING"
+    source = FakeJobStateSource(
+        {
+            "jobs/a": [running, running, SUCCEEDED],
+            "jobs/b": [running, FAILED],
+            "jobs/c": [running, SUCCEEDED],
+        },
+        tasks={"jobs/a": tasks},
+    )
+    waiter = PipelineWaiter(
+        source, initial_delay=0.01, max_delay=0.05, rng=random.Random(0)
+    )
+
+    async def run():
+        # jobs/c would sleep for a minute, the notification ends the wait early
+        slow = PipelineWaiter(
+            source, initial_delay=60, max_delay=60, rng=random.Random(0)
+        )
+        waiting = asyncio.ensure_future(slow.wait("jobs/c"))
+        await asyncio.sleep(0.01)
+        slow.notify("c")
+        results = await waiter.wait_all(["jobs/a", "jobs/b"])
+        return results + [await asyncio.wait_for(waiting, timeout=5)]
+
+    start = time.monotonic()
+    a, b, c = asyncio.run(run())
+    assert a.succeeded and a.polls == 3
+    assert b.state == FAILED and b.polls == 2
+    assert c.succeeded and c.polls == 2
+    assert time.monotonic() - start < 5
+    assert a.timings() == {"tabular-dataset-create": 40.0, "custom-training-job": 300.0}
+    assert all(d <= 0.05 for d in (waiter.delay(n) for n in range(10)))
+
+    # A job that never finishes times out
+    stuck = PipelineWaiter(
+        FakeJobStateSource({"jobs/d": [running]}), initial_delay=0.01, timeout=0.05
+    )
+    try:
+        asyncio.run(stuck.wait("jobs/d"))
+        raise AssertionError("expected a timeout")
+    except TimeoutError:
+        pass
+    print("OK:", {r.resource_name: (r.state, r.polls) for r in (a, b, c)})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wait for Vertex AI pipeline jobs.")
+    parser.add_argument("resource_names", nargs="*")
+    parser.add_argument("--region", type=str, default="us-central1")
+    parser.add_argument("--initial_delay", type=float, default=2.0)
+    parser.add_argument("--max_delay", type=float, default=DEFAULT_MAX_DELAY)
+    parser.add_argument("--timeout", type=float, default=None)
+    parser.add_argument(
+        "--subscription",
+        type=str,
+        default=None,
+        help="Pub/Sub subscription of the job state change notifications.",
+    )
+    parser.add_argument("--test", action="store_true", help="Run the offline test.")
+    args = parser.parse_args()
+    if args.test:
+        test_waiter()
+    else:
+        logging.basicConfig(level=logging.INFO)
+        for result in asyncio.run(_wait_and_report(args)):
+            print(
+                json.dumps(
+                    {
+                        "resource_name": result.resource_name,
+                        "state": result.state,
+                        "wait_seconds": round(result.wait_seconds, 1),
+                        "polls": result.polls,
+                        "task_seconds": result.timings(),
+                    }
+                )
+            )
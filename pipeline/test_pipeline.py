@@ -12,15 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
+import asyncio
 from pyexpat import model
-import time
 from typing import Dict, List
 
-from google.cloud import aiplatform as vertex
 from google.api_core.exceptions import NotFound
-from google.cloud.aiplatform_v1.types import pipeline_state
 
 import compile_pipeline
+import pipeline_waiter
 from upload_pipeline_to_ar import upload_to_artifact_registry
 import submit_pipeline_job
 from datetime import datetime
@@ -38,6 +37,9 @@ def wait_for_pipeline(
     """
     Waits for a Vertex AI pipeline to finish.
 
+    The job state is checked with exponential backoff (see pipeline_waiter.py)
+    and the duration of each task is logged once the job is done.
+
     Args:
         project_id (str): The Google Cloud project ID.
         region (str): The region where the pipeline is running.
@@ -46,36 +48,31 @@ def wait_for_pipeline(
     Returns:
         bool: True if the pipeline succeeded, False otherwise.
     """
+    logging.info(
+        f"https://console.cloud.google.com/vertex-ai/pipelines/locations/{region}/runs/{pipeline_job_resource_name.split('/')[-1]}?project={project_id}"
+    )
 
-    # Initialize the AIPlatform client
-    vertex.init(project=project_id, location=region)
+    async def wait():
+        waiter = pipeline_waiter.PipelineWaiter(
+            pipeline_waiter.VertexJobStateSource(region)
+        )
+        return await waiter.wait(pipeline_job_resource_name)
 
-    # Get the pipeline job
-    pipeline_job = vertex.PipelineJob.get(resource_name=pipeline_job_resource_name)
+    result = asyncio.run(wait())
     logging.info(
-        f"https://console.cloud.google.com/vertex-ai/pipelines/locations/{region}/runs/{pipeline_job.resource_name.split('/')[-1]}?project={project_id}"
+        f"Pipeline Job status: {result.state} after {result.wait_seconds:.0f}s "
+        f"({result.polls} status checks)"
     )
-    # Get the pipeline job's current status
-    while True:
-        status = pipeline_job.state
-        logging.info(f"Pipeline Job status: {status.name}")
-
-        if status in [
-            pipeline_state.PipelineState.PIPELINE_STATE_SUCCEEDED,
-            pipeline_state.PipelineState.PIPELINE_STATE_FAILED,
-            pipeline_state.PipelineState.PIPELINE_STATE_CANCELLED,
-        ]:
-            break  # Exit the loop if the job is finished
-        # Wait for a short time before checking again
-        time.sleep(10)  # Adjust the wait time as needed
+    for task_name, seconds in result.timings().items():
+        logging.info(f"  {task_name}: {seconds}s")
 
     # Do something based on the final status
-    if status == pipeline_state.PipelineState.PIPELINE_STATE_SUCCEEDED:
+    if result.state == pipeline_waiter.SUCCEEDED:
         logging.info("Pipeline succeeded")
         return True
-    elif status == pipeline_state.PipelineState.PIPELINE_STATE_CANCELLED:
+    elif result.state == pipeline_waiter.CANCELLED:
         raise Exception("Pipeline cancelled")
-    elif status == pipeline_state.PipelineState.PIPELINE_STATE_FAILED:
+    elif result.state == pipeline_waiter.FAILED:
         raise Exception("Pipeline failed")
 
 
@@ -92,7 +89,10 @@ def main(project_id: str, region: str, **kwargs):
     }
 
     logging.info("Compiling pipeline with preset params")
-    local_pipeline_file = compile_pipeline.main(parameters=preset_pipeline_params)
+    local_pipeline_file = compile_pipeline.main(
+        parameters=preset_pipeline_params,
+        cache_dir=kwargs.get("compile_cache_dir") or None,
+    )
     pipeline_root = kwargs.get("pipeline_root")
     pipeline_root = f"{pipeline_root}/pipeline_triggered_via_test_pipeline/{datetime.now().strftime('%Y%m%d%H%M%S')}"
 
@@ -117,10 +117,21 @@ def main(project_id: str, region: str, **kwargs):
                     bq_training_data_uri,
                     "--model_checkpoint_dir",
                     model_checkpoint_dir,
+                    "--tree_method",
+                    kwargs.get("tree_method"),
+                    "--max_bin",
+                    str(kwargs.get("max_bin")),
                 ],
             },
         }
     ]
+    replica_count = kwargs.get("replica_count") or 1
+    if replica_count > 1:
+        # workerpool0 holds the single rank 0 replica, the others go to workerpool1
+        worker_pool_specs[0]["container_spec"]["args"].append("--distributed")
+        worker_pool_specs.append(
+            dict(worker_pool_specs[0], replica_count=replica_count - 1)
+        )
 
     logging.info(f"Will use worker_pool_specs: {worker_pool_specs}")
     model_artifact_dir = f"{pipeline_root}/model"
@@ -137,13 +148,21 @@ def main(project_id: str, region: str, **kwargs):
     pipeline_parameters["worker_pool_specs"] = worker_pool_specs
     pipeline_parameters["bq_training_data_uri"] = bq_training_data_uri
     pipeline_parameters["pipeline_root"] = pipeline_root
+    # Shared by all runs: each deployment is compared to the previous one
+    pipeline_parameters["load_test_baseline_uri"] = (
+        f"{kwargs.get('pipeline_root')}/load_test/baseline.json"
+    )
 
     kwargs_that_are_not_pipeline_params = [
         "artifact_registry_repo_kfp_uri",
+        "compile_cache_dir",
         "machine_type",
+        "max_bin",
         "model_checkpoint_dir",
+        "replica_count",
         "tag",
         "training_container_image_uri",
+        "tree_method",
     ]
     for x in kwargs_that_are_not_pipeline_params:
         pipeline_parameters.pop(x)
@@ -180,8 +199,16 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--artifact_registry_repo_kfp_uri", type=str, required=True)
     parser.add_argument("--bq_training_data_uri", type=str, required=True)
+    parser.add_argument(
+        "--compile_cache_dir",
+        type=str,
+        default=compile_pipeline.DEFAULT_CACHE_DIR,
+        help="Reuse the compiled pipeline if its sources and preset parameters "
+        "did not change (empty: always compile).",
+    )
     parser.add_argument("--existing_model", type=str, required=False)
     parser.add_argument("--machine_type", type=str, default="n1-standard-4")
+    parser.add_argument("--max_bin", type=int, default=256)
     parser.add_argument(
         "--model_checkpoint_dir", type=str, required=False, default=None
     )
@@ -192,18 +219,22 @@ if __name__ == "__main__":
     parser.add_argument("--production_endpoint_id", type=str, default=None)
     parser.add_argument("--project_id", type=str, required=True)
     parser.add_argument("--region", type=str, required=True)
+    parser.add_argument("--replica_count", type=int, default=1)
     parser.add_argument("--runner_service_account_email", type=str, required=True)
     parser.add_argument("--tag", type=str, default=None)
     parser.add_argument("--tensorboard", type=str, default=None)
     parser.add_argument("--training_container_image_uri", type=str, required=True)
+    parser.add_argument("--tree_method", type=str, default="hist")
 
     args = parser.parse_args()
     logging.info(args)
     main(
         artifact_registry_repo_kfp_uri=args.artifact_registry_repo_kfp_uri,
         bq_training_data_uri=args.bq_training_data_uri,
+        compile_cache_dir=args.compile_cache_dir,
         existing_model=args.existing_model,
         machine_type=args.machine_type,
+        max_bin=args.max_bin,
         model_checkpoint_dir=args.model_checkpoint_dir,
         parent_model_resource_name=args.parent_model_resource_name,
         persistent_resource_name=args.persistent_resource_name,
@@ -212,8 +243,10 @@ if __name__ == "__main__":
         production_endpoint_id=args.production_endpoint_id,
         project_id=args.project_id,
         region=args.region,
+        replica_count=args.replica_count,
         runner_service_account_email=args.runner_service_account_email,
         tag=args.tag,
         tensorboard=args.tensorboard,
         training_container_image_uri=args.training_container_image_uri,
+        tree_method=args.tree_method,
     )
@@ -11,8 +11,56 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+"""Uploads the compiled pipeline package to Artifact Registry.
+
+Every successful upload is recorded in `uploads.json` next to the package,
+with the SHA-256 of the package. Uploading the same package to the same
+repository again (e.g. a compile cache hit, see `compile_pipeline.py`) only
+moves the tags to the version uploaded before.
+"""
+import hashlib
+import json
+import os
+from typing import Dict, List
+
+import requests
 from kfp.registry import RegistryClient
-from typing import List
+
+UPLOADS_FILE = "uploads.json"
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_uploads(local_pipeline_file: str) -> Dict[str, dict]:
+    path = os.path.join(os.path.dirname(local_pipeline_file), UPLOADS_FILE)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_uploads(local_pipeline_file: str, uploads: Dict[str, dict]) -> None:
+    path = os.path.join(os.path.dirname(local_pipeline_file), UPLOADS_FILE)
+    with open(path, "w") as f:
+        json.dump(uploads, f, indent=2)
+
+
+def _set_tags(
+    client: RegistryClient, template_name: str, version_name: str, tags: List[str]
+) -> None:
+    for tag in tags:
+        try:
+            client.create_tag(template_name, version_name, tag)
+        except requests.exceptions.HTTPError:
+            # The tag exists, e.g. "latest": point it at this version
+            client.update_tag(template_name, version_name, tag)
 
 
 def upload_to_artifact_registry(
@@ -20,6 +68,10 @@ def upload_to_artifact_registry(
 ):
     """
     Upload a pipeline package to Artifact Registry.
+
+    The upload is skipped if the same package was already uploaded to
+    `kfp_ar_image_uri`; only the tags are applied to the existing version.
+
     args:
         local_pipeline_file: The path to the pipeline package to upload.
         kfp_ar_image_uri: The URI of the Artifact Registry to upload to.
@@ -29,11 +81,27 @@ def upload_to_artifact_registry(
         The URI of the uploaded pipeline package.
     """
     client = RegistryClient(host=f"https://{kfp_ar_image_uri}")
-    template_name, version_name = client.upload_pipeline(
-        file_name=local_pipeline_file,
-        tags=tags,
-        extra_headers={"description": "Continuous Training Pipeline Template"},
-    )
+    package_sha256 = _sha256(local_pipeline_file)
+    uploads = _read_uploads(local_pipeline_file)
+    previous = uploads.get(kfp_ar_image_uri)
+
+    if previous and previous["sha256"] == package_sha256:
+        template_name = previous["template_name"]
+        version_name = previous["version_name"]
+        print(f"KFP Template {template_name} already uploaded, only tagging it")
+        _set_tags(client, template_name, version_name, tags)
+    else:
+        template_name, version_name = client.upload_pipeline(
+            file_name=local_pipeline_file,
+            tags=tags,
+            extra_headers={"description": "Continuous Training Pipeline Template"},
+        )
+        uploads[kfp_ar_image_uri] = {
+            "sha256": package_sha256,
+            "template_name": template_name,
+            "version_name": version_name,
+        }
+        _write_uploads(local_pipeline_file, uploads)
 
     print(f"KFP Template name: {template_name}")
     print(f"KFP Version name: {version_name}")
@@ -44,3 +112,4 @@ def upload_to_artifact_registry(
     print(f"Template URI: {uri}")
     for tag in tags:
         print(f"https://{kfp_ar_image_uri}/{template_name}/{tag}")
+    return uri